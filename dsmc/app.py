@@ -1,10 +1,16 @@
 
+import logging
+
 from tornado.web import URLSpec as url
 
 from arteria.web.app import AppService
 
-from dsmc.handlers.dsmc_handlers import VersionHandler, UploadHandler, StatusHandler, ReuploadHandler, CreateDirHandler, GenChecksumsHandler#, StopHandler
-from dsmc.lib.jobrunner import LocalQAdapter
+from dsmc.handlers.dsmc_handlers import VersionHandler, UploadHandler, StatusHandler, ReuploadHandler, CreateDirHandler, GenChecksumsHandler, WatchHandler, ResumeHandler, RetryHandler, VerifyHandler, RetrieveHandler, MetricsHandler, BaseDsmcHandler#, StopHandler
+from dsmc.lib.catalog import CatalogUpdater
+from dsmc.lib.jobrunner import LocalQAdapter, JobScheduler
+from dsmc.lib.jobstore import JobStore
+
+log = logging.getLogger(__name__)
 
 # FIXME: 1. Write test cases!!!
 # FIXME: 2. Refactor handlers
@@ -12,9 +18,6 @@ from dsmc.lib.jobrunner import LocalQAdapter
 # FIXME: 4. Integrate with Arteria workflows. 
 
 # TODO: Better logging. 
-#
-# TODO: Check how many TSM jobs we can queue, and how many can run in 
-# parallel. We should define this somewhere. 
 
 
 def routes(**kwargs):
@@ -29,7 +32,13 @@ def routes(**kwargs):
         url(r"/api/1.0/version", VersionHandler, name="version", kwargs=kwargs),
         url(r"/api/1.0/upload/([\w_-]+)", UploadHandler, name="start", kwargs=kwargs),
         url(r"/api/1.0/status/(\d*)", StatusHandler, name="status", kwargs=kwargs),
+        url(r"/api/1.0/watch", WatchHandler, name="watch", kwargs=kwargs),
         url(r"/api/1.0/reupload/([\w_-]+)", ReuploadHandler, name="reupload", kwargs=kwargs),
+        url(r"/api/1.0/resume/(\d*)", ResumeHandler, name="resume", kwargs=kwargs),
+        url(r"/api/1.0/retry/(\d*)", RetryHandler, name="retry", kwargs=kwargs),
+        url(r"/api/1.0/verify", VerifyHandler, name="verify", kwargs=kwargs),
+        url(r"/api/1.0/retrieve/([\w_-]+)", RetrieveHandler, name="retrieve", kwargs=kwargs),
+        url(r"/api/1.0/metrics", MetricsHandler, name="metrics", kwargs=kwargs),
         url(r"/api/1.0/create_dir/([\w_-]+)", CreateDirHandler, name="createdir", kwargs=kwargs),
         url(r"/api/1.0/gen_checksums/([\w_-]+)", GenChecksumsHandler, name="genchecksums", kwargs=kwargs)
         #url(r"/api/1.0/stop/([\d|all]*)", StopHandler, name="stop", kwargs=kwargs),
@@ -42,8 +51,34 @@ def start():
 
     app_svc = AppService.create(__package__)
 
-    number_of_cores_to_use = app_svc.config_svc["number_of_cores"]
-    whitelist = app_svc.config_svc["whitelisted_warnings"]
-    runner_service = LocalQAdapter(nbr_of_cores=number_of_cores_to_use, whitelisted_warnings=whitelist, interval=2, priority_method="fifo")
+    config = app_svc.config_svc
+    number_of_cores_to_use = config["number_of_cores"]
+    whitelist = config["whitelisted_warnings"]
+
+    # The scheduler decides when jobs may start, by the dsmc sessions, checksum
+    # workers and bandwidth they use. dsmc sessions barely use the CPU, so localq
+    # gets a core for each of them on top of the ones for calculating checksums.
+    scheduler = JobScheduler({"dsmc_sessions": config["max_concurrent_dsmc_sessions"],
+                              "checksum_workers": config["max_checksum_workers"],
+                              "bandwidth": config["bandwidth_budget_mb_per_second"]})
+    number_of_cores_to_use += config["max_concurrent_dsmc_sessions"]
+
+    # Jobs, and uploads that were interrupted, are remembered across restarts
+    job_store = JobStore(BaseDsmcHandler.job_store_path(app_svc.config_svc))
+
+    runner_service = LocalQAdapter(nbr_of_cores=number_of_cores_to_use, whitelisted_warnings=whitelist, interval=2,
+                                   priority_method="fifo", job_store=job_store, scheduler=scheduler)
+
+    for job in job_store.resumable():
+        log.info("Upload job {} of {} was interrupted, it can be resumed with POST /api/1.0/resume/{}".format(
+            job["job_id"], job["archive"], job["job_id"]))
+
+    # The catalog, and the manifests, are updated in the background when uploads finish,
+    # starting with the ones that finished before a restart
+    catalog_updater = CatalogUpdater(BaseDsmcHandler.open_catalog(config), runner_service,
+                                     workers=config["inventory_workers"],
+                                     manifest_dir=BaseDsmcHandler.manifest_dir(config))
+    catalog_updater.sweep()
 
-    app_svc.start(routes(config=app_svc.config_svc, runner_service = runner_service))
+    app_svc.start(routes(config=app_svc.config_svc, runner_service = runner_service,
+                         catalog_updater=catalog_updater))
@@ -1,38 +1,330 @@
+import ast
+import collections
+import hashlib
 import json
 import logging
 import os
 import datetime
 import uuid
-import subprocess
 import shutil
 import re 
 import pdb;
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
 
 from arteria.exceptions import ArteriaUsageException
 from arteria.web.state import State
 from arteria.web.handlers import BaseRestHandler
 
 from dsmc import __version__ as version
+from dsmc.lib import bundle, checksums
 from dsmc.lib.jobrunner import LocalQAdapter
+from dsmc.lib.jobstore import JobStore
+from dsmc.lib.query import DsmcQuery, DsmcQueryError
+from dsmc.lib.catalog import ArchiveCatalog
+from dsmc.lib.inventory import scan_tree
+from dsmc.lib.listing import FileListing, as_listing, diff_listings, parent_dirs
+from dsmc.lib.linktree import ExcludePatterns, create_link_tree, plan_link_tree
+from dsmc.lib.manifest import Manifest
+from dsmc.lib.metrics import NOT_TIMED, REGISTRY
+from dsmc.lib.progress import DsmcProgress
+from dsmc.lib.sharding import read_filelist, start_sharded, write_filelist
 
 log = logging.getLogger(__name__)
 
+HANDLER_STAGE_SECONDS = REGISTRY.histogram("arteria_dsmc_handler_stage_seconds",
+                                           "Seconds spent in each stage of the work of a handler",
+                                           ["handler", "stage"])
+REQUESTS = REGISTRY.counter("arteria_dsmc_requests_total", "Requests served", ["handler", "method", "code"])
+REQUEST_SECONDS = REGISTRY.histogram("arteria_dsmc_request_seconds", "Seconds spent serving requests",
+                                     ["handler", "method"])
+
 class BaseDsmcHandler(BaseRestHandler):
     """
     Base handler for checksum.
     """
 
-    def initialize(self, config, runner_service):
+    # Blocking work, like dsmc queries and scans of archives, is run in a pool
+    # of threads shared by all handlers, so that the IOLoop can keep serving
+    # other requests meanwhile.
+    _executor = None
+
+    # The `DsmcProgress` of the upload jobs started by the service, by job id in the
+    # order they were started. Only the latest finished ones are kept, see `track_progress`.
+    _progress = collections.OrderedDict()
+
+    FINISHED_PROGRESS_KEPT = 1000
+
+    def initialize(self, config, runner_service, catalog_updater=None):
         """
         Ensures that any parameters feed to this are available
         to subclasses.
 
         :param: config configuration used by the service
         :param: runner_service to use. Must fulfill `dsmc.lib.jobrunner.JobRunnerAdapter` interface
+        :param: catalog_updater a `dsmc.lib.catalog.CatalogUpdater` that updates the catalog when
+                upload jobs finish. Without it the jobs are only catalogued by the next
+                `CatalogUpdater.sweep`.
 
         """
         self.config = config
         self.runner_service = runner_service
+        self.catalog_updater = catalog_updater
+
+    def metrics_name(self):
+        """
+        :return: the name of the handler in the metrics, e.g. "reupload" for `ReuploadHandler`
+        """
+        return type(self).__name__.replace("Handler", "").lower()
+
+    def stage(self, name):
+        """
+        Time a stage of the work of the handler, e.g. `with self.stage("pdc_query"):`
+        :param name: of the stage
+        :return: a context manager that records the seconds spent in it
+        """
+        return HANDLER_STAGE_SECONDS.labels(self.metrics_name(), name).time()
+
+    def timed(self, name, func):
+        """
+        :return: a function that calls `func` as a stage of the work of the handler, e.g. to
+                 run it in the executor
+        """
+        def run(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return run
+
+    def on_finish(self):
+        REQUESTS.labels(self.metrics_name(), self.request.method, str(self.get_status())).inc()
+        REQUEST_SECONDS.labels(self.metrics_name(), self.request.method).observe(self.request.request_time())
+
+    @staticmethod
+    def open_catalog(config):
+        """
+        The local catalog of what has been archived to PDC. It is kept in the dsmc log directory.
+        :return: an `ArchiveCatalog`
+        """
+        db_path = os.path.join(config["dsmc_log_directory"], "pdc_catalog.sqlite")
+        max_age = datetime.timedelta(hours=config["pdc_catalog_max_age_hours"])
+        return ArchiveCatalog(db_path, max_age)
+
+    def archive_root(self):
+        """
+        :return: `path_to_archive_root` as an absolute path without a trailing slash, so that
+                 every handler gives the same path for an archive, e.g. in the catalog, the
+                 job store and the manifests
+        """
+        return os.path.abspath(self.config["path_to_archive_root"])
+
+    def archive_path(self, archive):
+        """
+        :param archive: the name of an archive, as given by a client
+        :return: the path to the archive, or None if the name isn't the name of a directory
+                 right below the archive root, e.g. ".", ".." or "foo/../../bar"
+        """
+        if not isinstance(archive, basestring):
+            return None
+
+        path_to_archive_root = self.archive_root()
+        path_to_archive = os.path.normpath(os.path.join(path_to_archive_root, archive))
+
+        if os.path.dirname(path_to_archive) != path_to_archive_root or os.path.basename(path_to_archive) != archive:
+            return None
+
+        return path_to_archive
+
+    def catalog(self):
+        """
+        :return: the `ArchiveCatalog` of the service, see `open_catalog`
+        """
+        return BaseDsmcHandler.open_catalog(self.config)
+
+    def track_job(self, job_id, archive, description, files=None, manifest=None):
+        """
+        Remember a started upload job, so that the catalog is updated when it finishes.
+        This blocks on SQLite, so it's run in the executor.
+        :param files: list of the files uploaded, or None if the whole archive is uploaded
+        :param manifest: `Manifest` of the archive when an upload of all of it started. It's what
+                         the catalog is filled with, and becomes the manifest of the archive,
+                         once the job is done.
+        """
+        if manifest:
+            # Kept before the job is tracked, as the job may be done already
+            manifest.write(Manifest.pending_path_for(BaseDsmcHandler.manifest_dir(self.config), job_id))
+
+        if self.catalog_updater:
+            self.catalog_updater.track_job(job_id, archive, description, files)
+        else:
+            self.catalog().track_job(job_id, archive, description, files)
+
+    def describe_job(self, job_id, archive, description):
+        """
+        Record what an upload job archives in the `JobStore`.
+        This blocks on SQLite, so it's run in the executor.
+        """
+        self.job_store().describe(job_id, archive, description)
+
+    def executor(self):
+        """
+        :return: the `ThreadPoolExecutor` to run blocking work in
+        """
+        # Handlers are created on the IOLoop thread, so this doesn't race
+        if BaseDsmcHandler._executor is None:
+            BaseDsmcHandler._executor = ThreadPoolExecutor(self.config["handler_threads"])
+        return BaseDsmcHandler._executor
+
+    def track_progress(self, job_id, dsmc_logs, total_bytes=None):
+        """
+        Follow the progress of an upload job in its dsmc logs
+        :param job_id: of the job
+        :param dsmc_logs: list of the dsmc logs of the job
+        :param total_bytes: the number of bytes the job will transfer, if known
+        """
+        BaseDsmcHandler._progress[int(job_id)] = DsmcProgress(dsmc_logs, total_bytes)
+
+        # Forget the progress of the jobs that finished longest ago
+        finished = [finished_id for finished_id, progress in BaseDsmcHandler._progress.items()
+                    if progress.final is not None]
+
+        for finished_id in finished[:max(0, len(finished) - BaseDsmcHandler.FINISHED_PROGRESS_KEPT)]:
+            BaseDsmcHandler._progress.pop(finished_id, None)
+
+    @gen.coroutine
+    def start_reupload(self, helper, path_to_archive, descr, reupload_files, reupload_bytes, uniq_id, dsmc_log_file,
+                       sessions=1):
+        """
+        Start a job that uploads files of an archive under the description of an earlier upload.
+        With more than one session the files are split into chunks of about the same number of
+        bytes, archived in parallel dsmc sessions and tracked as one group of jobs.
+        :param sessions: the number of parallel dsmc sessions to use
+        :return: tuple of the job id, and the chunks as returned by `ReuploadHelper.reupload_in_chunks`
+                 (None if the files are uploaded in one session) (through a Future)
+        """
+        chunks = None
+
+        if sessions > 1 and len(reupload_files) > 1:
+            file_sizes = yield self.executor().submit(ReuploadHelper.file_sizes, reupload_files)
+            job_id, chunks = yield self.executor().submit(helper.reupload_in_chunks, file_sizes, descr,
+                                                          self.archive_root(), dsmc_log_file, self.runner_service,
+                                                          sessions, resources=self.dsmc_resources())
+            dsmc_logs = [chunk["dsmc_log"] for chunk in chunks]
+        else:
+            job_id = yield self.executor().submit(helper.reupload, reupload_files, descr, uniq_id,
+                                                  self.archive_root(), dsmc_log_file, self.runner_service,
+                                                  resources=self.dsmc_resources(), estimated_bytes=reupload_bytes)
+            dsmc_logs = [dsmc_log_file]
+
+        log.debug("job_id {}".format(job_id))
+        yield self.executor().submit(self.track_job, job_id, path_to_archive, descr, reupload_files)
+        yield self.executor().submit(self.describe_job, job_id, path_to_archive, descr)
+        self.track_progress(job_id, dsmc_logs, total_bytes=reupload_bytes)
+
+        raise gen.Return((job_id, chunks))
+
+    def dsmc_sessions(self):
+        """
+        :return: the number of parallel dsmc sessions asked for by "sessions" in the body of
+                 the request, at most `max_dsmc_sessions`
+        :raises ValueError: if "sessions" isn't a positive integer
+        """
+        sessions = self.request_data().get("sessions", 1)
+
+        try:
+            nbr_of_sessions = int(sessions)
+        except (TypeError, ValueError):
+            raise ValueError("{!r} is not a number".format(sessions))
+
+        if nbr_of_sessions < 1:
+            raise ValueError("{} is less than 1".format(nbr_of_sessions))
+
+        return min(nbr_of_sessions, self.config["max_dsmc_sessions"])
+
+    def dsmc_resources(self):
+        """
+        :return: the resources used by one dsmc session, see `dsmc.lib.jobrunner.JobScheduler`
+        """
+        return {"dsmc_sessions": 1, "bandwidth": self.config["dsmc_session_mb_per_second"]}
+
+    def progress(self, job_id):
+        """
+        :return: the `DsmcProgress` of a job, or None if it isn't followed
+        """
+        return BaseDsmcHandler._progress.get(int(job_id))
+
+    @gen.coroutine
+    def job_status(self, job_id, state=None):
+        """
+        The status of a job: its state, the number of times it has logged each
+        dsmc warning, the progress of upload jobs, and the states of the jobs of
+        a group, see `StatusHandler`.
+        :param job_id: of the job
+        :param state: of the job, if already known
+        :return: dict of the status (through a Future)
+        """
+        status = {"state": state or self.runner_service.status(job_id)}
+
+        # Counts of the dsmc warnings logged by the job, up to its last status
+        warnings = self.runner_service.warnings(job_id)
+
+        if warnings is not None:
+            status["warnings"] = warnings
+
+        # E.g. the chunks of a reupload, so that a failed one can be retried
+        children = self.runner_service.children(job_id)
+
+        if children:
+            status["jobs"] = dict((child, self.runner_service.status(child)) for child in children)
+
+        progress = self.progress(job_id)
+
+        if progress:
+            # The logs of a finished job don't grow, so its progress is frozen
+            if status["state"] in (State.DONE, State.ERROR, State.CANCELLED):
+                yield self.executor().submit(progress.finish)
+            else:
+                yield self.executor().submit(progress.update)
+
+            status["progress"] = progress.as_dict()
+
+        raise gen.Return(status)
+
+    @staticmethod
+    def job_store_path(config):
+        """
+        :return: path to the database of the `JobStore`, kept in the dsmc log directory
+        """
+        return os.path.join(config["dsmc_log_directory"], "jobs.sqlite")
+
+    def job_store(self):
+        """
+        The record of the jobs started by the service, see `JobStore`
+        :return: a `JobStore`
+        """
+        return JobStore(BaseDsmcHandler.job_store_path(self.config))
+
+    @staticmethod
+    def manifest_dir(config):
+        """
+        :return: the directory where manifests of successfully uploaded archives are kept
+        """
+        return os.path.join(config["dsmc_log_directory"], "manifests")
+
+    def request_data(self):
+        """
+        :return: the JSON body of the request, or an empty dict if no body was sent
+        """
+        if self.request.body:
+            return json.loads(self.request.body)
+        else:
+            return {}
+
+    @staticmethod
+    def str2bool(value):
+        return str(value).lower() in ("true", "yes", "1")
 
 
 class VersionHandler(BaseDsmcHandler):
@@ -48,138 +340,322 @@ class VersionHandler(BaseDsmcHandler):
 
 
 class ReuploadHelper(object):
+
+    def __init__(self, stage=None):
+        """
+        :param stage: returns a context manager that times a stage of the work by its name, see
+                      `BaseDsmcHandler.stage`. The queries, listings, comparisons and filelists are
+                      timed as "pdc_query", "local_walk", "diff" and "write_filelist".
+        """
+        self.stage = stage or (lambda name: NOT_TIMED)
+
     """
     Does the same as 
             #dsmc q ar /proj/ngi2016001/incoming/${RUNFOLDER} | grep "/proj/ngi2016001/incoming" | awk '{print $3" "$NF}'
     """
-    # TODO: What to return if nothing is found? 
-    # TODO: Check that process completed successfully    
-    def get_pdc_descr(self, path_to_archive):     
+    def get_pdc_descr(self, path_to_archive):
         cmd = "dsmc q ar {}".format(path_to_archive)
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        dsmc_out, dsmc_err = p.communicate()
-        dsmc_out = dsmc_out.splitlines()
 
-        # if dsmc_err: 
-        #if process.returncode:
-            #raise RuntimeError('something bad happened')
+        latest_upload = None
+        nr_of_versions = 0
 
-        uploaded_versions = [line.strip() for line in dsmc_out if path_to_archive in line]
-        log.debug("Found the following uploaded versions of this archive: {}".format(uploaded_versions))
-        
-        # Uploads are chronologically sorted, with the latest upload last.
-        latest_upload = uploaded_versions[-1:][0] 
+        # Uploads aren't listed in chronological order, so pick the latest by
+        # the archive date. Raises DsmcQueryError if dsmc fails.
+        for archived in DsmcQuery(cmd, path_prefix=path_to_archive):
+            if not latest_upload or archived.archived_at >= latest_upload.archived_at:
+                latest_upload = archived
+            nr_of_versions += 1
+
+        log.debug("Found {} uploaded versions of this archive".format(nr_of_versions))
 
-        # We need the description of this upload: the last field. E.g.: 
+        if not latest_upload:
+            return None
+
+        # We need the description of this upload: the last field. E.g.:
         # 4,096  B  01/10/2017 16:47:24    /data/mm-xart002/runfolders/johanhe_test_150821_M00485_0220_000000000-AG2UJ_archive Never a33623ba-55ad-4034-9222-dae8801aa65e
-        latest_descr = latest_upload.split()[-1:][0]
+        latest_descr = latest_upload.description
         log.debug("Latest uploaded version is {} with description {}".format(latest_upload, latest_descr))
 
         return latest_descr
 
     """
-    Does the same as 
-         
+    Does the same as
+
     """
-    def get_pdc_filelist(self, path_to_archive, descr): 
+    def get_pdc_filelist(self, path_to_archive, descr, catalog=None):
+        """
+        :return: `dsmc.lib.listing.FileListing` of the objects uploaded under the description
+        """
         cmd = "dsmc q ar {} -subdir=yes -description={}".format(path_to_archive, descr)
 
-        # TODO: Check that process completed successfully
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
- 
-        dsmc_out, dsmc_err = p.communicate()
-        dsmc_out = dsmc_out.splitlines()
-        # if dsmc_err: 
-        #if process.returncode:
-            #raise RuntimeError('something bad happened')        
-
-        # Take out the bytes and the filename from the output
-        # convert raw output to bytes - first field in matched_lines
-        #
-        # Get the lines containing the path. Then take out the field nr 1 and 5
-        matched_lines = [line.strip() for line in dsmc_out if path_to_archive in line]
-        log.debug("RAW matched lines: {}".format(matched_lines))
-
         # NB uploaded list contains folders as well, but when we check local content
         # we only look at the files, and ignore the folders.
-        uploaded_files = {} #[line for line in matched_lines]
-
-        # Line looks like
-        #4,096  B  2017-07-27 17.48.34    /data/mm-xart002/runfolders/johanhe_test_150821_M00485_0220_000000000-AG2UJ_archive/Config Never e374bd6b-ab36-4f41-94d3-f4eaea9f30d4
-        # but sometimes it can be "4 096", depending on the OS locale. 
-        for line in matched_lines: 
-            elements = line.split()
-            
-            if "," in elements[0]: 
-                byte_size = elements[0].replace(",", "")
-                filename = elements[4]
-            elif elements[0] == "0": 
-                byte_size = 0
-                filename = elements[4]
-            else: 
-                byte_size = "{}{}".format(elements[0], elements[1])
-                filename = elements[5]
-            
-            # TODO: Check so that the key doesn't exist first?
-            # E.g. if uploaded twice with the same descr 
-            uploaded_files[filename] = byte_size
-        
-        log.debug("Previously uploaded files for the archive are: {}".format(uploaded_files))
+        uploaded_files = FileListing(path_to_archive)
+
+        # Lines are parsed as dsmc prints them, see `dsmc.lib.query`.
+        # Raises DsmcQueryError if dsmc fails.
+        def collect():
+            for archived in DsmcQuery(cmd, path_prefix=path_to_archive):
+                # TODO: Check so that the key doesn't exist first?
+                # E.g. if uploaded twice with the same descr
+                uploaded_files.add(archived.path, archived.size)
+                yield archived
+
+        # Refresh the local catalog from the same pass over the dsmc output
+        with self.stage("pdc_query"):
+            if catalog:
+                catalog.replace(path_to_archive, collect())
+            else:
+                for _ in collect():
+                    pass
+
+        log.debug("Found {} previously uploaded files for the archive".format(len(uploaded_files)))
 
         return uploaded_files
 
-    def get_local_filelist(self, path_to_archive): 
-        local_files = {}
-        for root, directories, filenames in os.walk(path_to_archive):
-            for filename in filenames:
-                full_path = os.path.join(root, filename)
-                local_size = os.path.getsize(full_path)
-                local_files[full_path] = str(local_size)
-        
-        log.debug("Local files for the archive are {}".format(local_files))
+    def get_pdc_latest_version(self, path_to_archive, catalog=None):
+        """
+        Does the work of `get_pdc_descr` and `get_pdc_filelist` in one dsmc
+        session: every uploaded version of the archive is listed once, grouped
+        by description, and the one archived last is picked.
+        :param path_to_archive: to look up
+        :param catalog: an `ArchiveCatalog` to refresh with all versions from the same query
+        :return: tuple of the description of the latest version (None if the archive has
+                 never been uploaded), and `dsmc.lib.listing.FileListing` of its files
+        :raises DsmcQueryError: if dsmc fails
+        """
+        cmd = "dsmc q ar {} -subdir=yes".format(path_to_archive)
+
+        # Description and (time of the last object archived, files) of every version
+        versions = {}
+
+        # With the trailing slash, e.g. foo_archive2 isn't taken for a part of foo_archive
+        def collect():
+            for archived in DsmcQuery(cmd, path_prefix=path_to_archive.rstrip("/") + "/"):
+                ReuploadHelper._add_to_versions(versions, path_to_archive, archived)
+                yield archived
+
+        with self.stage("pdc_query"):
+            if catalog:
+                catalog.replace(path_to_archive, collect())
+            else:
+                for _ in collect():
+                    pass
+
+        return ReuploadHelper._latest_version(path_to_archive, versions)
+
+    def get_pdc_latest_versions(self, path_to_archive_root, archives, catalog=None):
+        """
+        Like `get_pdc_latest_version`, for several archives in the same directory,
+        but in one dsmc session for all of them.
+        :param path_to_archive_root: the directory of the archives
+        :param archives: names of the archives to look up
+        :param catalog: an `ArchiveCatalog` to refresh with all versions of the archives
+        :return: dict of the path to each archive and the tuple returned by `get_pdc_latest_version`
+        :raises DsmcQueryError: if dsmc fails
+        """
+        path_to_archive_root = path_to_archive_root.rstrip("/")
+        paths = dict((archive, os.path.join(path_to_archive_root, archive)) for archive in archives)
+
+        # Quoted, so that the wildcard is expanded by dsmc rather than by the shell
+        cmd = "dsmc q ar '{}/*' -subdir=yes".format(path_to_archive_root)
+
+        versions = dict((path, {}) for path in paths.itervalues())
+
+        # The objects of an archive are written to the catalog as soon as dsmc moves on to
+        # another archive, one transaction at a time, rather than kept for all archives
+        batch_path, batch, written = None, [], set()
+
+        with self.stage("pdc_query"):
+            try:
+                for archived in DsmcQuery(cmd, path_prefix=path_to_archive_root + "/"):
+                    archive = archived.path[len(path_to_archive_root) + 1:].split("/", 1)[0]
+
+                    if archive not in paths:
+                        continue
+
+                    path = paths[archive]
+                    ReuploadHelper._add_to_versions(versions[path], path, archived)
+
+                    if catalog:
+                        if path != batch_path:
+                            ReuploadHelper._write_to_catalog(catalog, batch_path, batch, written)
+                            batch_path, batch = path, []
+
+                        batch.append(archived)
+
+                if catalog:
+                    ReuploadHelper._write_to_catalog(catalog, batch_path, batch, written)
+
+                    # Archives that have never been uploaded are catalogued as such too
+                    for path in paths.itervalues():
+                        if path not in written:
+                            ReuploadHelper._write_to_catalog(catalog, path, [], written)
+            except DsmcQueryError:
+                # The archives written so far may be missing objects that dsmc didn't get to
+                for path in written:
+                    catalog.mark_stale(path)
+                raise
+
+        return dict((path, ReuploadHelper._latest_version(path, versions[path])) for path in paths.itervalues())
+
+    @staticmethod
+    def _write_to_catalog(catalog, path_to_archive, archived_files, written):
+        """
+        Write objects of an archive listed by dsmc to the catalog, replacing what was known
+        about the archive the first time it's written
+        :param written: set of the archives written so far, updated
+        """
+        if path_to_archive is None:
+            return
+
+        if path_to_archive in written:
+            catalog.extend(path_to_archive, archived_files)
+        else:
+            catalog.replace(path_to_archive, archived_files)
+            written.add(path_to_archive)
+
+    @staticmethod
+    def _add_to_versions(versions, path_to_archive, archived):
+        version = versions.get(archived.description)
+        uploaded_files = version[1] if version else FileListing(path_to_archive)
+
+        # Objects outside the archive neither make nor date a version of it
+        if not uploaded_files.add(archived.path, archived.size):
+            return
+
+        if version is None:
+            versions[archived.description] = [archived.archived_at, uploaded_files]
+        elif archived.archived_at > version[0]:
+            version[0] = archived.archived_at
+
+    @staticmethod
+    def _latest_version(path_to_archive, versions):
+        if not versions:
+            return None, FileListing(path_to_archive)
+
+        latest_descr = max(versions, key=lambda descr: versions[descr][0])
+        uploaded_files = versions[latest_descr][1]
+
+        log.debug("Found {} uploaded versions of {}, the latest is {} with {} files".format(
+            len(versions), path_to_archive, latest_descr, len(uploaded_files)))
+
+        return latest_descr, uploaded_files
+
+    def get_local_inventory(self, path_to_archive, workers=1):
+        """
+        :return: dict of path and `dsmc.lib.inventory.LocalFile` for the files in the archive
+        """
+        return scan_tree(path_to_archive, workers=workers)
+
+    def get_local_filelist(self, path_to_archive, workers=1, inventory=None):
+        """
+        :return: `dsmc.lib.listing.FileListing` of the files in the archive
+        """
+        with self.stage("local_walk"):
+            if inventory is None:
+                inventory = self.get_local_inventory(path_to_archive, workers)
+
+            local_files = FileListing.from_inventory(path_to_archive, inventory)
+
+        log.debug("Found {} local files for the archive".format(len(local_files)))
 
         return local_files
 
+    def compare(self, local_files, uploaded_files):
+        """
+        :param local_files: `FileListing` as returned by `get_local_filelist`, or a dict of path and size
+        :param uploaded_files: `FileListing` as returned by `get_pdc_filelist`, or a dict of path and size
+        :return: `dsmc.lib.listing.ListingDiff` of the local files that haven't been uploaded,
+                 the local files whose size differs from the uploaded one, and the objects only
+                 found in PDC, by their path relative to the archive
+        """
+        with self.stage("diff"):
+            return diff_listings(as_listing(local_files), as_listing(uploaded_files))
+
     def get_files_to_reupload(self, local_files, uploaded_files):
-        # Sort both - then compare them. We do not need to sort them if we are using dicts!
-        # We consider local files to be the truth - obviously. So if there are more data uploaded 
-        # than present locally we ignore it. 
-        reupload_files = []
-        for k, v in local_files.iteritems(): 
-            if k in uploaded_files: 
-                log.debug("Local file has been uploaded {}".format(k))
-
-                if v != uploaded_files[k]: 
-                    log.info("::: ERROR ::: Local file size {} doesn't match remote file size {} for file {}".format(v, uploaded_files[k], k))
-                    reupload_files.append(k)
-                else: 
-                    log.debug("Local file size matches uploaded file size")
-            else: 
-                log.info("::: ERROR ::: Local file has NOT been uploaded {}".format(k))
-                reupload_files.append(k)
+        """
+        We consider local files to be the truth - obviously. So if there are more
+        data uploaded than present locally we ignore it.
+        :return: list of the paths of the local files that are missing, or differ in size, in PDC
+        """
+        local_files = as_listing(local_files)
+        difference = self.compare(local_files, uploaded_files)
+
+        return [local_files.absolute(rel_path) for rel_path in difference.missing + difference.size_mismatch]
 
-        return reupload_files
+    @staticmethod
+    def _files_and_bytes(difference, local_files):
+        """
+        :param difference: `ListingDiff` of the local files against PDC
+        :param local_files: the `FileListing` that was compared
+        :return: tuple of the paths of the files to reupload and their total size
+        """
+        rel_paths = difference.missing + difference.size_mismatch
+        return [local_files.absolute(rel_path) for rel_path in rel_paths], local_files.total_bytes(rel_paths)
 
     # TODO: Return something sensible. Error checking. 
-    def reupload(self, reupload_files, descr, uniq_id, run_dir, dsmc_log_file, runner_service):
-        log.info("Will now reupload the following files: {}".format(reupload_files))
+    def reupload(self, reupload_files, descr, uniq_id, run_dir, dsmc_log_file, runner_service, resources=None,
+                 estimated_bytes=None):
+        log.info("Will now reupload {} files under the description {}".format(len(reupload_files), descr))
 
         dsmc_reupload = os.path.join("/tmp", "arteria-dsmc-reupload-{}".format(uniq_id))
 
-        with open(dsmc_reupload, 'wa') as f:
-            for r in reupload_files:
-                f.write('"{}"\n'.format(r))
+        with self.stage("write_filelist"):
+            write_filelist(dsmc_reupload, reupload_files)
 
         log.debug("Written files to reupload to {}".format(dsmc_reupload))
 
         #dsmc archive -descr=${DESCR} -filelist=${FILELIST} 2>&1 | tee `pwd`/${FILELIST}.tsm_log
         cmd = "dsmc archive -filelist={} -description={}".format(dsmc_reupload, descr)
         log.debug("Running command {}".format(cmd))
-        job_id = runner_service.start(cmd, nbr_of_cores=1, run_dir=run_dir, stdout=dsmc_log_file, stderr=dsmc_log_file)
+        job_id = runner_service.start(cmd, nbr_of_cores=1, run_dir=run_dir, stdout=dsmc_log_file, stderr=dsmc_log_file,
+                                      resources=resources, estimated_bytes=estimated_bytes)
 
         return job_id
 
+    @staticmethod
+    def file_sizes(paths):
+        """
+        :param paths: of local files
+        :return: dict of path and size, of the link itself for broken links, and 0 for files
+                 that have gone missing
+        """
+        sizes = {}
+
+        for path in paths:
+            try:
+                sizes[path] = os.path.getsize(path)
+            except OSError:
+                try:
+                    sizes[path] = os.lstat(path).st_size
+                except OSError:
+                    sizes[path] = 0
+
+        return sizes
+
+    def reupload_in_chunks(self, file_sizes, descr, run_dir, dsmc_log_file, runner_service, nbr_of_chunks,
+                           resources=None):
+        """
+        Split the files to reupload into chunks of about the same number of bytes, and archive
+        them in parallel dsmc sessions under the description of the earlier upload, see
+        `dsmc.lib.sharding.start_sharded`. A chunk that fails can be retried on its own, see
+        `RetryHandler`.
+        :param file_sizes: dict of path and size of the files to reupload
+        :param nbr_of_chunks: the number of dsmc sessions to split the files over
+        :param resources: used by each dsmc session
+        :return: tuple of the job id of the group (None on failure), and a list of dicts of
+                 the job id, filelist, dsmc log, number of files and bytes of every chunk
+        """
+        log.info("Will now reupload {} files under the description {} in {} sessions".format(
+            len(file_sizes), descr, nbr_of_chunks))
+
+        with self.stage("write_filelist"):
+            job_id, chunks = start_sharded(runner_service, "dsmc archive", file_sizes.iteritems(), descr, run_dir,
+                                           dsmc_log_file, nbr_of_chunks, resources=resources)
+
+        return job_id, chunks
+
 class ReuploadHandler(BaseDsmcHandler):
     # TODO: Refactor out
     @staticmethod
@@ -191,13 +667,30 @@ class ReuploadHandler(BaseDsmcHandler):
         else:
             return False
 
+    @gen.coroutine
     def post(self, runfolder_archive): 
-        monitored_dir = self.config["path_to_archive_root"]
-        helper = ReuploadHelper()
+        """
+        Compare the archive with the last version uploaded to PDC, and start a
+        job that uploads the files that are missing or differ. The comparison is
+        done in a background thread, so several archives can be checked at once
+        without blocking other requests.
+
+        The body can contain `refresh`, true to query PDC and compare the whole
+        archive with it, even if the local catalog is fresh or nothing has changed
+        since the last upload, and `full_scan`, true to list the whole archive
+        even if there is a manifest of the last upload.
+
+        The body can also contain "sessions", to reupload the files in chunks of about the same
+        number of bytes in that many parallel dsmc sessions (at most `max_dsmc_sessions`). The
+        job id returned then tracks all of them, and the job id, filelist and dsmc log of every
+        chunk are returned under "chunks", so that a chunk that fails can be retried on its own.
+        """
+        monitored_dir = self.archive_root()
+        helper = ReuploadHelper(self.stage)
 
         if not UploadHandler._validate_runfolder_exists(runfolder_archive, monitored_dir):
             response_data = {"service_version": version, "state": State.ERROR}
-            self.set_status(500, reason="{} is not found under {}!".format(runfolder_archive, path_to_archive_root))
+            self.set_status(500, reason="{} is not found under {}!".format(runfolder_archive, monitored_dir))
             self.write_object(response_data)
             return     
 
@@ -217,25 +710,37 @@ class ReuploadHandler(BaseDsmcHandler):
                                                       uniq_id,
                                                       datetime.datetime.now().isoformat())            
 
-        #pdb.set_trace() 
-
-        # Step 1 - fetch the description of the last uploaded version of this archive
-        descr = helper.get_pdc_descr(path_to_archive)
+        request_data = self.request_data()
+        refresh = BaseDsmcHandler.str2bool(request_data.get("refresh", False))
+        full_scan = BaseDsmcHandler.str2bool(request_data.get("full_scan", False))
 
-        # Step 2 - check the difference of the uploaded version vs the local archive
-        # Step 2a, get filelist from PDC      
-        uploaded_files = helper.get_pdc_filelist(path_to_archive, descr)
+        try:
+            nbr_of_sessions = self.dsmc_sessions()
+        except ValueError, msg:
+            self.set_status(400, reason="Invalid number of sessions: {}".format(msg))
+            self.write_object({"service_version": version, "state": State.ERROR})
+            return
 
-        # 2b, Then, get the expected filelist from us
-        local_files = helper.get_local_filelist(path_to_archive)
+        try:
+            descr, reupload_files, reupload_bytes = yield self.executor().submit(
+                self._find_files_to_reupload, helper, path_to_archive, refresh, full_scan)
+        except DsmcQueryError, err:
+            log.info("Error when querying PDC: {}".format(err))
+            response_data = {"service_version": version, "state": State.ERROR, "dsmc_errors": err.errors}
+            self.set_status(500, reason="Error when querying PDC for {}".format(path_to_archive))
+            self.write_object(response_data)
+            return
 
-        # 2c, Check if we have to reupload anything
-        reupload_files = helper.get_files_to_reupload(local_files, uploaded_files)
+        if not descr:
+            response_data = {"service_version": version, "state": State.ERROR}
+            self.set_status(500, reason="No uploaded version of {} found in PDC!".format(path_to_archive))
+            self.write_object(response_data)
+            return
 
         # Step 3 - upload the missing files with the previous description
         if reupload_files: 
-            job_id = helper.reupload(reupload_files, descr, uniq_id, monitored_dir, dsmc_log_file, self.runner_service)
-            log.debug("job_id {}".format(job_id))
+            job_id, chunks = yield self.start_reupload(helper, path_to_archive, descr, reupload_files,
+                                                       reupload_bytes, uniq_id, dsmc_log_file, nbr_of_sessions)
         
             status_end_point = "{0}://{1}{2}".format(
             self.request.protocol,
@@ -249,19 +754,254 @@ class ReuploadHandler(BaseDsmcHandler):
                 "state": State.STARTED,
                 "dsmc_log": dsmc_log_file}
 
+            if chunks:
+                response_data["dsmc_log"] = [chunk["dsmc_log"] for chunk in chunks]
+                response_data["chunks"] = chunks
+
             self.set_status(202, reason="started reuploading")
+            self.write_object(response_data)
         else: 
             log.debug("Nothing to do - everything already uploaded.")
+            self._nothing_to_reupload(dsmc_log_file)
 
-            response_data = {
+    def _find_files_to_reupload(self, helper, path_to_archive, refresh, full_scan):
+        """
+        Compare the archive with what has been uploaded. This blocks on dsmc and
+        the file system, so it's run in the executor.
+        :return: tuple of the description of the last upload (None if the archive
+                 has never been uploaded), list of the files to reupload and their
+                 total size
+        :raises DsmcQueryError: if dsmc fails
+        """
+        catalog = self.catalog()
+
+        # If the archive has been uploaded successfully before, only the files in
+        # directories that have changed since then need to be compared with PDC.
+        manifest_path = Manifest.path_for(BaseDsmcHandler.manifest_dir(self.config), path_to_archive)
+        manifest = None
+
+        if not full_scan and os.path.exists(manifest_path):
+            try:
+                manifest = Manifest.read(manifest_path)
+            except ValueError, msg:
+                log.info("Doing a full scan of {}: {}".format(path_to_archive, msg))
+
+        if manifest:
+            with self.stage("manifest_scan"):
+                inventory, changed_files = manifest.incremental_scan(workers=self.config["inventory_workers"])
+
+            # Unless the operator wants PDC checked again, files can only have gone
+            # missing from PDC since the last upload
+            if not changed_files and not refresh:
+                log.debug("Nothing has changed in {} since the last upload.".format(path_to_archive))
+                return manifest.description, [], 0
+
+        # Only query PDC if the operator asks for it, or if our local catalog
+        # of what has been uploaded is missing or stale.
+        if not refresh and catalog.is_fresh(path_to_archive):
+            log.debug("Using the local catalog for {}".format(path_to_archive))
+
+            with self.stage("catalog_lookup"):
+                descr = catalog.latest_description(path_to_archive)
+                uploaded_files = catalog.filelist(path_to_archive, descr)
+        else:
+            # Step 1 - fetch the description and the filelist of the last uploaded
+            # version of this archive from PDC, in one query
+            descr, uploaded_files = helper.get_pdc_latest_version(path_to_archive, catalog=catalog)
+
+            if not descr:
+                return None, [], 0
+
+        # Step 2 - check the difference of the uploaded version vs the local archive
+
+        # 2b, Then, get the expected filelist from us
+        if manifest and manifest.description == descr and not refresh:
+            changed_inventory = dict((path, inventory[path]) for path in changed_files)
+            local_files = helper.get_local_filelist(path_to_archive, inventory=changed_inventory)
+        elif manifest:
+            local_files = helper.get_local_filelist(path_to_archive, inventory=inventory)
+        else:
+            local_files = helper.get_local_filelist(path_to_archive, workers=self.config["inventory_workers"])
+
+        # 2c, Check if we have to reupload anything
+        return (descr,) + ReuploadHelper._files_and_bytes(helper.compare(local_files, uploaded_files),
+                                                          as_listing(local_files))
+
+    def _nothing_to_reupload(self, dsmc_log_file):
+        response_data = {
             "service_version": version,
-            "link": status_end_point,
             "state": State.DONE,
             "dsmc_log": dsmc_log_file}
 
-            self.set_status(200, reason="nothing to reupload")
-        
-        self.write_object(response_data)     
+        self.set_status(200, reason="nothing to reupload")
+        self.write_object(response_data)
+
+class ResumeHandler(BaseDsmcHandler):
+    """
+    Resume uploads that were interrupted by a restart of the service.
+    """
+
+    def get(self, job_id):
+        """
+        List the uploads that were interrupted by a restart of the service, and
+        haven't been resumed yet.
+        """
+        self.write_object({"service_version": version, "resumable": self.job_store().resumable()})
+
+    def _find_remainder(self, helper, path_to_archive, descr):
+        # Compare what reached PDC under the description of the interrupted upload
+        # with the archive. This blocks on dsmc and the file system.
+        uploaded_files = helper.get_pdc_filelist(path_to_archive, descr)
+        local_files = helper.get_local_filelist(path_to_archive, workers=self.config["inventory_workers"])
+        return ReuploadHelper._files_and_bytes(helper.compare(local_files, uploaded_files), as_listing(local_files))
+
+    @gen.coroutine
+    def post(self, job_id):
+        """
+        Resume an interrupted upload, by archiving the files that didn't reach
+        PDC under the same description. The body can contain "sessions", to
+        upload them in chunks in parallel dsmc sessions, see `ReuploadHandler`.
+        :param job_id: of the interrupted upload, see `get`
+        """
+        job_store = self.job_store()
+        resumable = dict((job["job_id"], job) for job in job_store.resumable())
+
+        if not job_id or int(job_id) not in resumable:
+            response_data = {"service_version": version, "state": State.ERROR}
+            self.set_status(404, reason="There is no interrupted upload with id {} to resume".format(job_id))
+            self.write_object(response_data)
+            return
+
+        job = resumable[int(job_id)]
+        path_to_archive = job["archive"]
+        descr = job["description"]
+        helper = ReuploadHelper(self.stage)
+
+        try:
+            nbr_of_sessions = self.dsmc_sessions()
+        except ValueError, msg:
+            self.set_status(400, reason="Invalid number of sessions: {}".format(msg))
+            self.write_object({"service_version": version, "state": State.ERROR})
+            return
+
+        uniq_id = str(uuid.uuid4())
+        dsmc_log_file = "{}/dsmc_{}_{}-{}".format(self.config["dsmc_log_directory"],
+                                                  os.path.basename(path_to_archive),
+                                                  uniq_id,
+                                                  datetime.datetime.now().isoformat())
+
+        try:
+            reupload_files, reupload_bytes = yield self.executor().submit(self._find_remainder, helper,
+                                                                          path_to_archive, descr)
+        except DsmcQueryError, err:
+            log.info("Error when querying PDC: {}".format(err))
+            response_data = {"service_version": version, "state": State.ERROR, "dsmc_errors": err.errors}
+            self.set_status(500, reason="Error when querying PDC for {}".format(path_to_archive))
+            self.write_object(response_data)
+            return
+
+        if not reupload_files:
+            log.info("Everything in {} reached PDC before job {} was interrupted".format(path_to_archive, job_id))
+            job_store.mark_resumed(job_id, 0)
+
+            response_data = {"service_version": version, "state": State.DONE}
+            self.set_status(200, reason="nothing left to upload")
+            self.write_object(response_data)
+            return
+
+        log.info("Resuming upload job {} of {} with {} files".format(job_id, path_to_archive, len(reupload_files)))
+
+        new_job_id, chunks = yield self.start_reupload(helper, path_to_archive, descr, reupload_files,
+                                                       reupload_bytes, uniq_id, dsmc_log_file, nbr_of_sessions)
+        job_store.mark_resumed(job_id, new_job_id)
+
+        status_end_point = "{0}://{1}{2}".format(
+            self.request.protocol,
+            self.request.host,
+            self.reverse_url("status", new_job_id))
+
+        response_data = {
+            "job_id": new_job_id,
+            "service_version": version,
+            "link": status_end_point,
+            "state": State.STARTED,
+            "dsmc_log": dsmc_log_file}
+
+        if chunks:
+            response_data["dsmc_log"] = [chunk["dsmc_log"] for chunk in chunks]
+            response_data["chunks"] = chunks
+
+        self.set_status(202, reason="started resuming")
+        self.write_object(response_data)
+
+class RetryHandler(BaseDsmcHandler):
+    """
+    Retry a failed dsmc job that archived a filelist, e.g. a chunk of a reupload.
+    """
+
+    FILELIST = re.compile(r"-filelist=(\S+)")
+
+    @staticmethod
+    def _read_files(filelist):
+        # The files of the chunk and their total size, as they are now
+        files = read_filelist(filelist)
+        return files, sum(ReuploadHelper.file_sizes(files).itervalues())
+
+    @gen.coroutine
+    def post(self, job_id):
+        """
+        Archive the filelist of a failed dsmc job again, in a new job, under the
+        same description. When a chunk of a reupload split over several sessions
+        fails, see `ReuploadHandler`, only that chunk has to be run again. Its
+        filelist is kept next to its dsmc log. The group of the chunks keeps its
+        state, the retry is followed by the job id returned.
+        :param job_id: of the failed job, e.g. a chunk listed by the status of its group
+        """
+        job = self.job_store().job(job_id) if job_id else None
+        match = RetryHandler.FILELIST.search(job["cmd"] or "") if job else None
+
+        if not match or not job["description"] or self.runner_service.status(job_id) != State.ERROR:
+            response_data = {"service_version": version, "state": State.ERROR}
+            self.set_status(404, reason="There is no failed dsmc job with id {} to retry".format(job_id))
+            self.write_object(response_data)
+            return
+
+        filelist = match.group(1)
+
+        if not os.path.isfile(filelist):
+            response_data = {"service_version": version, "state": State.ERROR}
+            self.set_status(404, reason="The filelist {} of job {} is gone".format(filelist, job_id))
+            self.write_object(response_data)
+            return
+
+        files, retry_bytes = yield self.executor().submit(RetryHandler._read_files, filelist)
+        retry_log = "{}-retry-{}".format(job["stdout"], datetime.datetime.now().isoformat())
+
+        log.info("Retrying job {} with the {} files in {}".format(job_id, len(files), filelist))
+
+        new_job_id = self.runner_service.start(job["cmd"], nbr_of_cores=1, run_dir=job["run_dir"], stdout=retry_log,
+                                               stderr=retry_log, resources=self.dsmc_resources(),
+                                               estimated_bytes=retry_bytes)
+        yield self.executor().submit(self.track_job, new_job_id, job["archive"], job["description"], files)
+        yield self.executor().submit(self.describe_job, new_job_id, job["archive"], job["description"])
+        self.track_progress(new_job_id, [retry_log], total_bytes=retry_bytes)
+
+        status_end_point = "{0}://{1}{2}".format(
+            self.request.protocol,
+            self.request.host,
+            self.reverse_url("status", new_job_id))
+
+        response_data = {
+            "job_id": new_job_id,
+            "service_version": version,
+            "link": status_end_point,
+            "state": State.STARTED,
+            "retry_of": int(job_id),
+            "filelist": filelist,
+            "dsmc_log": retry_log}
+
+        self.set_status(202, reason="started retrying")
+        self.write_object(response_data)
 
 class UploadHandler(BaseDsmcHandler):
 
@@ -290,22 +1030,56 @@ class UploadHandler(BaseDsmcHandler):
         return os.path.isdir(log_dir)
 
 
+    @staticmethod
+    def _measure(path_to_runfolder, description, workers, progress):
+        """
+        Fill in the number of bytes an upload will transfer
+        :param description: the dsmc description of the upload
+        :param progress: the `DsmcProgress` of the upload
+        :return: `Manifest` of the runfolder, or None if it couldn't be listed
+        """
+        try:
+            manifest, inventory = Manifest.create(path_to_runfolder, description, workers)
+        except (IOError, OSError), msg:
+            log.info("Could not measure {}: {}".format(path_to_runfolder, msg))
+            return None
+
+        progress.total_bytes = sum(local_file.size for local_file in inventory.itervalues())
+        return manifest
+
+    def _measure_and_track(self, job_id, path_to_runfolder, description):
+        """
+        Measure a runfolder being uploaded in one session, and track the upload with
+        the manifest taken meanwhile, see `track_job`
+        """
+        # Until the job is tracked, the catalog mustn't be trusted for the runfolder
+        self.catalog().mark_stale(path_to_runfolder)
+
+        manifest = UploadHandler._measure(path_to_runfolder, description, self.config["inventory_workers"],
+                                          self.progress(job_id))
+        self.track_job(job_id, path_to_runfolder, description, manifest=manifest)
+
     """
     Start a dsmc process.
 
     The request needs to pass the path the md5 sum file to check in "path_to_md5_sum_file". This path
     has to point to a file in the runfolder.
 
+    The request can pass "sessions" to archive the runfolder in that many parallel
+    dsmc sessions (at most `max_dsmc_sessions`). The job id returned then tracks
+    all of them.
+
     :param runfolder: name of the runfolder we want to start archiving
 
     """
+    @gen.coroutine
     def post(self, runfolder_archive):
 
-        monitored_dir = self.config["path_to_archive_root"]
+        monitored_dir = self.archive_root()
 
         if not UploadHandler._validate_runfolder_exists(runfolder_archive, monitored_dir):
             response_data = {"service_version": version, "state": State.ERROR}
-            self.set_status(500, reason="{} is not found under {}!".format(runfolder_archive, path_to_archive_root))
+            self.set_status(500, reason="{} is not found under {}!".format(runfolder_archive, monitored_dir))
             self.write_object(response_data)
             return
 
@@ -326,12 +1100,48 @@ class UploadHandler(BaseDsmcHandler):
        # cmd = "export DSM_LOG={} && dsmc archive {} -subdir=yes -desc={}".format(dsmc_log_file,
        #                                                                          runfolder,
        #                                                                          description)
-        
-        cmd = "dsmc archive {}/ -subdir=yes -description={}".format(path_to_runfolder, uniq_id)
-        # FIXME: echo is just used when testing return codes locally. 
-        #cmd = "echo 'ANS1809W ANS2000W Test run started.' && echo ANS9999W && echo ANS1809W && exit 8" #false
-        #cmd = "echo 'ANS1809W Test run started.' && echo ANS1809W && exit 8"
-        job_id = self.runner_service.start(cmd, nbr_of_cores=1, run_dir=monitored_dir, stdout=dsmc_log_file, stderr=dsmc_log_file)
+
+        try:
+            nbr_of_sessions = self.dsmc_sessions()
+        except ValueError, msg:
+            self.set_status(400, reason="Invalid number of sessions: {}".format(msg))
+            self.write_object({"service_version": version, "state": State.ERROR})
+            return
+
+        if nbr_of_sessions > 1:
+            # The runfolder is split by the sizes of its files, so it has to be measured first
+            dirs = {}
+            inventory = yield self.executor().submit(self.timed("local_walk", scan_tree), path_to_runfolder,
+                                                     workers=self.config["inventory_workers"], dirs=dirs)
+            total_bytes = sum(local_file.size for local_file in inventory.itervalues())
+
+            # Archiving a filelist doesn't create the directories by itself,
+            # so they go with the first shard to keep e.g. empty directories.
+            job_id, shards = yield self.executor().submit(
+                self.timed("write_filelist", start_sharded), self.runner_service, "dsmc archive",
+                ((path, local_file.size) for path, local_file in inventory.iteritems()),
+                uniq_id, monitored_dir, dsmc_log_file, nbr_of_sessions,
+                resources=self.dsmc_resources(), first_shard_extra=dirs)
+
+            dsmc_log_file = [shard["dsmc_log"] for shard in shards]
+            self.track_progress(job_id, dsmc_log_file, total_bytes=total_bytes)
+            yield self.executor().submit(self.track_job, job_id, path_to_runfolder, uniq_id,
+                                         manifest=Manifest.from_scan(path_to_runfolder, uniq_id, inventory, dirs))
+        else:
+            cmd = "dsmc archive {}/ -subdir=yes -description={}".format(path_to_runfolder, uniq_id)
+            # FIXME: echo is just used when testing return codes locally. 
+            #cmd = "echo 'ANS1809W ANS2000W Test run started.' && echo ANS9999W && echo ANS1809W && exit 8" #false
+            #cmd = "echo 'ANS1809W Test run started.' && echo ANS1809W && exit 8"
+            job_id = self.runner_service.start(cmd, nbr_of_cores=1, run_dir=monitored_dir, stdout=dsmc_log_file, stderr=dsmc_log_file,
+                                               resources=self.dsmc_resources())
+            self.track_progress(job_id, [dsmc_log_file])
+
+            # Answer right away, and measure the runfolder meanwhile, so that the status can
+            # tell when the upload will be done. The job is tracked with what was measured.
+            self.executor().submit(self.timed("local_walk", self._measure_and_track), job_id, path_to_runfolder,
+                                   uniq_id)
+
+        yield self.executor().submit(self.describe_job, job_id, path_to_runfolder, uniq_id)
 
         status_end_point = "{0}://{1}{2}".format(
             self.request.protocol,
@@ -353,9 +1163,30 @@ class GenChecksumsHandler(BaseDsmcHandler):
     # TODO: Add helper functions - refactor with other base class 
 
     def post(self, runfolder_archive):
-        path_to_archive_root = os.path.abspath(self.config["path_to_archive_root"])
+        """
+        Start a job that calculates checksums for all files in the archive.
+
+        The body can contain `algorithms`, a list of the digests to calculate
+        (md5, sha256 and xxh64 if xxhash is installed; md5 is the default), and
+        `check_gzip`, true to also check that all .gz files decompress completely.
+        All of it is done in one pass over the files.
+        """
+        path_to_archive_root = self.archive_root()
         checksum_log = os.path.abspath(os.path.join(self.config["dsmc_log_directory"], "checksum.log"))
-        
+
+        request_data = self.request_data()
+        algorithms = request_data.get("algorithms", ["md5"])
+        check_gzip = BaseDsmcHandler.str2bool(request_data.get("check_gzip", False))
+
+        unknown_algorithms = [algorithm for algorithm in algorithms if algorithm not in checksums.ALGORITHMS]
+
+        if not algorithms or unknown_algorithms:
+            response_data = {"service_version": version, "state": State.ERROR}
+            self.set_status(400, reason="Unsupported checksum algorithms {}, use one or more of {}".format(
+                unknown_algorithms, sorted(checksums.ALGORITHMS)))
+            self.write_object(response_data)
+            return
+
         if not UploadHandler._validate_runfolder_exists(runfolder_archive, path_to_archive_root):
             response_data = {"service_version": version, "state": State.ERROR}
             self.set_status(500, reason="{} is not found under {}!".format(runfolder_archive, path_to_archive_root))
@@ -364,10 +1195,24 @@ class GenChecksumsHandler(BaseDsmcHandler):
 
         path_to_archive = os.path.join(path_to_archive_root, runfolder_archive)
         filename = "checksums_prior_to_pdc.md5"
-        
-        cmd = "cd {} && /usr/bin/find -L . -type f ! -path '{}' -exec /usr/bin/md5sum {{}} + > {}".format(path_to_archive, filename, filename)
+
+        # The job can't use more cores than the runner has.
+        workers = min(self.config["checksum_workers"], self.config["number_of_cores"])
+
+        # Checksums of files that haven't changed since the last time are taken from the cache
+        checksum_cache = os.path.abspath(os.path.join(self.config["dsmc_log_directory"], "checksum_cache.sqlite"))
+
+        cmd = "{} -m dsmc.lib.checksums {} --output {} --workers {} --cache {}".format(
+            sys.executable, path_to_archive, filename, workers, checksum_cache)
+
+        if algorithms != ["md5"]:
+            cmd += " --algorithms {}".format(" ".join(algorithms))
+        if check_gzip:
+            cmd += " --check-gzip"
+
         log.debug("Will now execute command {}".format(cmd))
-        job_id = self.runner_service.start(cmd, nbr_of_cores=1, run_dir=path_to_archive_root, stdout=checksum_log, stderr=checksum_log) 
+        job_id = self.runner_service.start(cmd, nbr_of_cores=workers, run_dir=path_to_archive_root, stdout=checksum_log, stderr=checksum_log,
+                                           resources={"checksum_workers": workers})
 
         status_end_point = "{0}://{1}{2}".format(
             self.request.protocol,
@@ -378,11 +1223,275 @@ class GenChecksumsHandler(BaseDsmcHandler):
             "job_id": job_id,
             "service_version": version,
             "link": status_end_point,
-            "state": State.STARTED}
+            "state": State.STARTED,
+            "checksum_files": [checksums.output_name_for(filename, algorithm) for algorithm in algorithms]}
+
+        # Gzip files that fail the check are listed in the report, and fail the job
+        if check_gzip:
+            response_data["gzip_report"] = checksums.gzip_report_name_for(filename)
 
         self.set_status(202, reason="started processing")
         self.write_object(response_data)
 
+class VerifyHandler(BaseDsmcHandler):
+    """
+    Compare several archives with what has been uploaded to PDC, in one dsmc session.
+    """
+
+    def _verify(self, helper, archives):
+        """
+        List the archives and query PDC for all of them at once. This blocks on
+        dsmc and the file system, so it's run in the executor.
+        :return: dict of archive name and dict of the comparison, with the files to
+                 reupload and their size under "reupload_files" and "reupload_bytes"
+        :raises DsmcQueryError: if dsmc fails
+        """
+        # dsmc reports absolute paths
+        path_to_archive_root = self.archive_root()
+        latest_versions = helper.get_pdc_latest_versions(path_to_archive_root, archives, catalog=self.catalog())
+        summaries = {}
+
+        for archive in archives:
+            path_to_archive = os.path.join(path_to_archive_root, archive)
+            descr, uploaded_files = latest_versions[path_to_archive]
+            local_files = helper.get_local_filelist(path_to_archive, workers=self.config["inventory_workers"])
+            difference = helper.compare(local_files, uploaded_files)
+            reupload_files, reupload_bytes = ReuploadHelper._files_and_bytes(difference, local_files)
+
+            summaries[archive] = {
+                "description": descr,
+                "local_files": len(local_files),
+                "uploaded_files": len(uploaded_files),
+                "missing": len(difference.missing),
+                "size_mismatches": len(difference.size_mismatch),
+                "remote_only": len(difference.remote_only),
+                "reupload_files": reupload_files,
+                "reupload_bytes": reupload_bytes}
+
+        return summaries
+
+    @gen.coroutine
+    def post(self):
+        """
+        Compare archives under `path_to_archive_root` with the last version of
+        each uploaded to PDC. The body lists the names of the archives under
+        `archives`, and can set `reupload` to true to start a reupload job for
+        every archive that has files missing or differing in PDC, and `sessions`
+        to split each reupload over parallel dsmc sessions, see `ReuploadHandler`.
+
+        For every archive the description of its last upload is returned (null
+        if it has never been uploaded), together with the number of local and
+        uploaded files, the number of files missing in PDC, the number of files
+        whose size differs, the number of objects only found in PDC, the number of
+        bytes to reupload, and the id of the reupload job if one was started.
+        """
+        request_data = self.request_data()
+        archives = request_data.get("archives")
+        path_to_archive_root = self.archive_root()
+
+        if not archives or not isinstance(archives, list):
+            response_data = {"service_version": version, "state": State.ERROR}
+            self.set_status(400, reason="Give the names of the archives to verify as a list under 'archives'")
+            self.write_object(response_data)
+            return
+
+        not_found = [archive for archive in archives
+                     if not self.archive_path(archive) or not os.path.isdir(self.archive_path(archive))]
+
+        if not_found:
+            response_data = {"service_version": version, "state": State.ERROR, "not_found": not_found}
+            self.set_status(404, reason="Not found under {}: {}".format(path_to_archive_root,
+                                                                         ", ".join(map(unicode, not_found))))
+            self.write_object(response_data)
+            return
+
+        reupload = BaseDsmcHandler.str2bool(request_data.get("reupload", False))
+        helper = ReuploadHelper(self.stage)
+
+        try:
+            nbr_of_sessions = self.dsmc_sessions()
+        except ValueError, msg:
+            self.set_status(400, reason="Invalid number of sessions: {}".format(msg))
+            self.write_object({"service_version": version, "state": State.ERROR})
+            return
+
+        try:
+            summaries = yield self.executor().submit(self._verify, helper, sorted(set(archives)))
+        except DsmcQueryError, err:
+            log.info("Error when querying PDC: {}".format(err))
+            response_data = {"service_version": version, "state": State.ERROR, "dsmc_errors": err.errors}
+            self.set_status(500, reason="Error when querying PDC for {} archives".format(len(archives)))
+            self.write_object(response_data)
+            return
+
+        for archive, summary in sorted(summaries.iteritems()):
+            reupload_files = summary.pop("reupload_files")
+
+            if reupload and reupload_files and summary["description"]:
+                uniq_id = str(uuid.uuid4())
+                dsmc_log_file = "{}/dsmc_{}_{}-{}".format(self.config["dsmc_log_directory"], archive, uniq_id,
+                                                          datetime.datetime.now().isoformat())
+                path_to_archive = os.path.join(path_to_archive_root, archive)
+                summary["job_id"], chunks = yield self.start_reupload(helper, path_to_archive,
+                                                                      summary["description"], reupload_files,
+                                                                      summary["reupload_bytes"], uniq_id,
+                                                                      dsmc_log_file, nbr_of_sessions)
+                summary["dsmc_log"] = dsmc_log_file
+
+                if chunks:
+                    summary["dsmc_log"] = [chunk["dsmc_log"] for chunk in chunks]
+                    summary["chunks"] = chunks
+
+        response_data = {"service_version": version, "state": State.DONE, "archives": summaries}
+        self.set_status(200, reason="Finished verifying")
+        self.write_object(response_data)
+
+
+class RetrieveHandler(BaseDsmcHandler):
+    """
+    Restore an archive from PDC, in parallel dsmc sessions.
+    """
+
+    # The checksum file written before the upload, see `GenChecksumsHandler`
+    CHECKSUM_FILE = "checksums_prior_to_pdc.md5"
+
+    def _find_files_to_retrieve(self, helper, path_to_archive, descr, refresh):
+        """
+        List what was archived under the description, or under the latest upload if no
+        description is given. This blocks on dsmc, so it's run in the executor.
+        :return: tuple of the description (None if nothing was found), and a `FileListing`
+                 of the files archived under it, without the directories
+        :raises DsmcQueryError: if dsmc fails
+        """
+        catalog = self.catalog()
+
+        if not refresh and catalog.is_fresh(path_to_archive):
+            log.debug("Using the local catalog for {}".format(path_to_archive))
+
+            with self.stage("catalog_lookup"):
+                descr = descr or catalog.latest_description(path_to_archive)
+                archived = catalog.filelist(path_to_archive, descr) if descr else None
+        elif descr:
+            archived = helper.get_pdc_filelist(path_to_archive, descr)
+        else:
+            descr, archived = helper.get_pdc_latest_version(path_to_archive, catalog=catalog)
+
+        if not descr or not archived:
+            return None, None
+
+        # dsmc lists the directories as well, but they are created by retrieving their files
+        dirs = parent_dirs(archived)
+        return descr, FileListing(path_to_archive, dict((rel_path, size) for rel_path, size in archived.iteritems()
+                                                        if rel_path not in dirs))
+
+    @gen.coroutine
+    def post(self, runfolder_archive):
+        """
+        Retrieve an archive from PDC to where it was archived from, under
+        `path_to_archive_root`, and check the retrieved files against the
+        checksum file archived with it.
+
+        The files archived under the description `description` in the body, or
+        else under the latest upload, are split into filelists of about the same
+        number of bytes and retrieved in `sessions` parallel dsmc sessions (at
+        most `max_dsmc_sessions`). Once all of them are done, a job checks the
+        files against `checksums_prior_to_pdc.md5` in parallel, unless `verify`
+        is false, and lists the files that failed in
+        `checksums_prior_to_pdc.verify_errors`.
+
+        Local files are kept, unless `replace` is true. The body can also set
+        `refresh` to true to query PDC even if the local catalog is fresh.
+        """
+        path_to_archive_root = self.archive_root()
+        path_to_archive = os.path.join(path_to_archive_root, runfolder_archive)
+
+        request_data = self.request_data()
+        descr = request_data.get("description")
+        refresh = BaseDsmcHandler.str2bool(request_data.get("refresh", False))
+        replace = BaseDsmcHandler.str2bool(request_data.get("replace", False))
+        verify = BaseDsmcHandler.str2bool(request_data.get("verify", True))
+        helper = ReuploadHelper(self.stage)
+
+        try:
+            nbr_of_sessions = self.dsmc_sessions()
+        except ValueError, msg:
+            self.set_status(400, reason="Invalid number of sessions: {}".format(msg))
+            self.write_object({"service_version": version, "state": State.ERROR})
+            return
+
+        try:
+            descr, files = yield self.executor().submit(self._find_files_to_retrieve, helper, path_to_archive,
+                                                        descr, refresh)
+        except DsmcQueryError, err:
+            log.info("Error when querying PDC: {}".format(err))
+            response_data = {"service_version": version, "state": State.ERROR, "dsmc_errors": err.errors}
+            self.set_status(500, reason="Error when querying PDC for {}".format(path_to_archive))
+            self.write_object(response_data)
+            return
+
+        if not descr or not files:
+            response_data = {"service_version": version, "state": State.ERROR}
+            self.set_status(404, reason="Nothing of {} was found in PDC".format(path_to_archive))
+            self.write_object(response_data)
+            return
+
+        dsmc_log_file = "{}/dsmc_retrieve_{}_{}-{}".format(self.config["dsmc_log_directory"], runfolder_archive,
+                                                           str(uuid.uuid4()), datetime.datetime.now().isoformat())
+
+        # Without a destination, the files are retrieved to where they were archived from
+        job_id, shards = yield self.executor().submit(
+            self.timed("write_filelist", start_sharded), self.runner_service, "dsmc retrieve",
+            files.absolute_items(), descr, path_to_archive_root, dsmc_log_file, nbr_of_sessions,
+            options="-replace={}".format("all" if replace else "no"), resources=self.dsmc_resources())
+
+        dsmc_logs = [shard["dsmc_log"] for shard in shards]
+
+        log.info("Retrieving {} files of {} under the description {} in job {}".format(len(files), path_to_archive,
+                                                                                      descr, job_id))
+
+        status_end_point = "{0}://{1}{2}".format(
+            self.request.protocol,
+            self.request.host,
+            self.reverse_url("status", job_id))
+
+        response_data = {
+            "job_id": job_id,
+            "service_version": version,
+            "link": status_end_point,
+            "state": State.STARTED,
+            "description": descr,
+            "files": len(files),
+            "bytes": files.total_bytes(),
+            "dsmc_log": dsmc_logs}
+
+        if verify and RetrieveHandler.CHECKSUM_FILE in files:
+            # The job can't use more cores than the runner has.
+            workers = min(self.config["checksum_workers"], self.config["number_of_cores"])
+            verify_log = "{}-verify".format(dsmc_log_file)
+            cmd = "{} -m dsmc.lib.checksums {} --output {} --workers {} --verify".format(
+                sys.executable, path_to_archive, RetrieveHandler.CHECKSUM_FILE, workers)
+
+            verify_job_id = self.runner_service.start_after(job_id, cmd, nbr_of_cores=workers,
+                                                            run_dir=path_to_archive_root, stdout=verify_log,
+                                                            stderr=verify_log,
+                                                            resources={"checksum_workers": workers},
+                                                            estimated_bytes=files.total_bytes())
+
+            response_data["verify_job_id"] = verify_job_id
+            response_data["verify_link"] = "{0}://{1}{2}".format(
+                self.request.protocol,
+                self.request.host,
+                self.reverse_url("status", verify_job_id))
+            response_data["verify_report"] = os.path.join(
+                path_to_archive, checksums.verify_report_name_for(RetrieveHandler.CHECKSUM_FILE))
+        elif verify:
+            log.info("{} wasn't archived with {}, the retrieved files can't be checked".format(
+                RetrieveHandler.CHECKSUM_FILE, path_to_archive))
+
+        self.set_status(202, reason="started retrieving")
+        self.write_object(response_data)
+
+
 class CreateDirHandler(BaseDsmcHandler):
     # TODO: Refactor
     """
@@ -440,31 +1549,23 @@ class CreateDirHandler(BaseDsmcHandler):
         else: 
             return True
 
+    @staticmethod
+    def _as_list(value):
+        """
+        Exclusions may be given as lists, or as the strings of lists, e.g. "['.txt', '.bar']"
+        """
+        if isinstance(value, basestring):
+            return ast.literal_eval(value) if value.strip() else []
+        return value or []
+
     """ 
     Symlink _archive dir to runfolder, and filter out some stuff. 
     """
     @staticmethod
-    def _create_archive(oldtree, newtree, exclude_dirs=[], exclude_extensions=[]): 
+    def _create_archive(oldtree, newtree, excludes, workers=1, bundle_below=None, max_bundle_bytes=bundle.MAX_BUNDLE_BYTES):
         try: 
-            content = os.listdir(oldtree)
-
-            for entry in content: 
-                oldpath = os.path.join(oldtree, entry)
-                newpath = os.path.join(newtree, entry)
-
-                if os.path.isdir(oldpath) and entry not in exclude_dirs:
-                    os.mkdir(newpath)
-                    CreateDirHandler._create_archive(oldpath, newpath, exclude_dirs, exclude_extensions)
-                elif os.path.isfile(oldpath):
-                    _, ext = os.path.splitext(oldpath)
-
-                    if ext not in exclude_extensions: 
-                        os.symlink(oldpath, newpath)
-                    else: 
-                        log.debug("Skipping {} because it is excluded".format(oldpath))
-                else: 
-                    log.debug("Skipping {} because it is excluded".format(oldpath))
-        except OSError, msg: 
+            return create_link_tree(oldtree, newtree, excludes, workers, bundle_below, max_bundle_bytes)
+        except (IOError, OSError), msg: 
             errmsg = "Error when creating archive directory: {}".format(msg)
             log.debug(errmsg)
             raise ArteriaUsageException(errmsg)       
@@ -473,23 +1574,52 @@ class CreateDirHandler(BaseDsmcHandler):
     Create a directory to be used for archiving.
 
     :param runfolder: name of the runfolder we want to create an archive dir of
-    :param exclude: list of patterns to use when excluding files and/or dirs 
+    :param exclude: list of patterns to use when excluding files and/or dirs, see
+                    `dsmc.lib.linktree.ExcludePatterns`
+    :param exclude_dirs: list of names of directories to exclude
+    :param exclude_extensions: list of extensions of files to exclude
     :param remove: boolean to indicate if we should remove previous archive 
-
+    :param dry_run: boolean to only tell what the archive dir would contain, without
+                    creating it. Besides the counts, a histogram of the files by size
+                    and the largest files are returned.
+    :param bundle_below: bundle the files smaller than this many bytes into tar files in the
+                         archive dir, instead of linking them, see `dsmc.lib.bundle`
+    :param max_bundle_bytes: the size at which a bundle is closed
+
+    The response tells how many files, of how many bytes, the archive dir links to.
     """
+    @gen.coroutine
     def post(self, runfolder):
 
         monitored_dir = self.config["monitored_directory"]
         path_to_runfolder = os.path.abspath(os.path.join(monitored_dir, runfolder))
         #TODO: On Irma we want /proj/ngi2016001/nobackup/arteria/pdc_archive_links
-        path_to_archive_root = self.config["path_to_archive_root"]
+        path_to_archive_root = self.archive_root()
         path_to_archive = os.path.abspath(os.path.join(path_to_archive_root, runfolder) + "_archive")
 
         request_data = json.loads(self.request.body)
         # TODO: Catch when no data is included
-        remove = eval(request_data["remove"]) # str2bool
-        exclude_dirs = request_data["exclude_dirs"]
-        exclude_extensions = request_data["exclude_extensions"]
+        remove = BaseDsmcHandler.str2bool(request_data.get("remove", False))
+        dry_run = BaseDsmcHandler.str2bool(request_data.get("dry_run", False))
+
+        try:
+            bundle_below = int(request_data.get("bundle_below") or 0) or None
+            max_bundle_bytes = int(request_data.get("max_bundle_bytes") or bundle.MAX_BUNDLE_BYTES)
+        except ValueError, msg:
+            response_data = {"service_version": version, "state": State.ERROR}
+            self.set_status(400, reason="Invalid bundle size: {}".format(msg))
+            self.write_object(response_data)
+            return
+
+        try:
+            excludes = ExcludePatterns(CreateDirHandler._as_list(request_data.get("exclude")),
+                                       CreateDirHandler._as_list(request_data.get("exclude_dirs")),
+                                       CreateDirHandler._as_list(request_data.get("exclude_extensions")))
+        except (ValueError, SyntaxError, re.error), msg:
+            response_data = {"service_version": version, "state": State.ERROR}
+            self.set_status(400, reason="Invalid exclude patterns: {}".format(msg))
+            self.write_object(response_data)
+            return
 
         # FIXME: Dont raise here. 
         if not CreateDirHandler._validate_runfolder_exists(runfolder, monitored_dir):
@@ -509,6 +1639,26 @@ class CreateDirHandler(BaseDsmcHandler):
             self.write_object(response_data)      
             return      
 
+        if dry_run:
+            try:
+                plan = yield self.executor().submit(self.timed("plan_link_tree", plan_link_tree),
+                                                    path_to_runfolder, excludes,
+                                                    self.config["inventory_workers"], bundle_below=bundle_below,
+                                                    max_bundle_bytes=max_bundle_bytes)
+            except OSError, msg:
+                response_data = {"service_version": version, "state": State.ERROR}
+                self.set_status(500, reason="Error when planning archive dir: {}".format(msg))
+                self.write_object(response_data)
+                return
+
+            response_data = {"service_version": version, "state": State.DONE, "dry_run": True,
+                             "archive_exists": os.path.exists(path_to_archive)}
+            response_data.update(plan)
+
+            self.set_status(200, reason="Finished processing.")
+            self.write_object(response_data)
+            return
+
         # FIXME: Don't raise here
         if not CreateDirHandler._verify_dest(path_to_archive, remove): 
             response_data = {"service_version": version, "state": State.ERROR}
@@ -519,14 +1669,17 @@ class CreateDirHandler(BaseDsmcHandler):
         # Raise exception? Print out error to user client. 
         try: 
             os.mkdir(path_to_archive)
-            CreateDirHandler._create_archive(path_to_runfolder, path_to_archive, exclude_dirs, exclude_extensions)
-        except ArteriaUsageException, msg: 
+            stats = yield self.executor().submit(self.timed("create_link_tree", CreateDirHandler._create_archive),
+                                                 path_to_runfolder, path_to_archive, excludes,
+                                                 self.config["inventory_workers"], bundle_below, max_bundle_bytes)
+        except (ArteriaUsageException, OSError), msg: 
             response_data = {"service_version": version, "state": State.ERROR}
             self.set_status(500, reason="Error when creating archive dir: {}".format(msg))
             self.write_object(response_data)      
             return                  
 
         response_data = {"service_version": version, "state": State.DONE}
+        response_data.update(stats._asdict())
 
         self.set_status(200, reason="Finished processing.")
         self.write_object(response_data)
@@ -537,25 +1690,170 @@ class StatusHandler(BaseDsmcHandler):
     Get the status of one or all jobs.
     """
 
+    @gen.coroutine
     def get(self, job_id):
         """
         Get the status of the specified job_id, or if now id is given, the
-        status of all jobs.
+        status of all jobs. A job also reports the number of times it has logged
+        each dsmc warning. Upload jobs also report their progress: the number of
+        files and bytes transferred, the current throughput, an estimate of the
+        seconds left, and the summary statistics of dsmc once it has finished.
+
+        The status of all jobs can be narrowed down with the query arguments
+        `state` (e.g. `?state=started&state=pending`), and paged through, in
+        order of job id, with `offset` and `limit`. The number of jobs that
+        match the states is returned in the `X-Total-Count` header.
         :param job_id: to check status for (set to empty to get status for all)
         """
 
         if job_id:
-            status = {"state": self.runner_service.status(job_id)}
+            status = yield self.job_status(job_id)
         else:
-            # TODO: Update the correct status for all jobs; the filtering in jobrunner doesn't work here.
             all_status = self.runner_service.status_all()
+
+            states = self.get_arguments("state")
+
+            try:
+                offset = int(self.get_argument("offset", 0))
+                limit = self.get_argument("limit", None)
+                limit = int(limit) if limit is not None else None
+
+                if offset < 0 or (limit is not None and limit < 0):
+                    raise ValueError("offset and limit can't be negative")
+            except ValueError, msg:
+                self.set_status(400, reason="Invalid offset or limit: {}".format(msg))
+                self.write_object({"service_version": version, "state": State.ERROR})
+                return
+
+            job_ids = sorted(k for k, v in all_status.iteritems() if not states or v in states)
+            self.set_header("X-Total-Count", len(job_ids))
+
+            if limit is not None:
+                job_ids = job_ids[offset:offset + limit]
+            else:
+                job_ids = job_ids[offset:]
+
             status_dict = {}
-            for k, v in all_status.iteritems():
-                status_dict[k] = {"state": v}
+            for k in job_ids:
+                status_dict[k] = yield self.job_status(k, all_status[k])
             status = status_dict
 
         self.write_json(status)
 
+class WatchHandler(BaseDsmcHandler):
+    """
+    Watch the status of many jobs over one long-polling connection.
+    """
+
+    # How often the jobs are checked while waiting for a change, in seconds
+    POLL_INTERVAL = 1
+
+    # The longest a request may wait for a change, in seconds
+    MAX_TIMEOUT = 300
+
+    @staticmethod
+    def version(statuses):
+        """
+        :param statuses: dict of job id and status
+        :return: an ETag that changes when the state, warnings or the amount
+                 transferred of any of the jobs changes. The throughput and the
+                 ETA change all the time, so they're left out.
+        """
+        versioned = {}
+
+        for job_id, status in statuses.iteritems():
+            versioned[job_id] = dict(status)
+            progress = versioned[job_id].pop("progress", None)
+
+            if progress:
+                versioned[job_id]["progress"] = [progress["files_done"], progress["bytes_transferred"],
+                                                 progress["total_bytes"], progress.get("summary")]
+
+        return '"{}"'.format(hashlib.md5(json.dumps(versioned, sort_keys=True)).hexdigest())
+
+    @gen.coroutine
+    def statuses(self, job_ids):
+        if job_ids:
+            states = dict((job_id, None) for job_id in job_ids)
+        else:
+            states = self.runner_service.status_all()
+
+        statuses = {}
+        for job_id, state in states.iteritems():
+            statuses[str(job_id)] = yield self.job_status(job_id, state)
+
+        raise gen.Return(statuses)
+
+    def on_connection_close(self):
+        self.closed = True
+
+    @gen.coroutine
+    def get(self):
+        """
+        Get the status of the jobs given by the `job_id` query arguments (e.g.
+        `?job_id=1&job_id=2`), or of all jobs, like `status` does. The response
+        has an ETag header. Pass it back in an `If-None-Match` header, and the
+        request waits until the status of any of the jobs changes, or for at most
+        `timeout` seconds (30 by default) after which it returns 304 Not Modified.
+        """
+        self.closed = False
+
+        job_ids = self.get_arguments("job_id")
+
+        try:
+            timeout = float(self.get_argument("timeout", 30))
+
+            if not 0 <= timeout < float("inf"):
+                raise ValueError("the timeout must be a number of seconds")
+
+            timeout = min(timeout, WatchHandler.MAX_TIMEOUT)
+
+            for job_id in job_ids:
+                int(job_id)
+        except ValueError, msg:
+            self.set_status(400, reason="Invalid timeout or job id: {}".format(msg))
+            self.write_object({"service_version": version, "state": State.ERROR})
+            return
+
+        known_version = self.request.headers.get("If-None-Match")
+
+        deadline = time.time() + timeout
+        statuses = yield self.statuses(job_ids)
+        status_version = WatchHandler.version(statuses)
+
+        while status_version == known_version and time.time() < deadline and not self.closed:
+            yield gen.sleep(min(WatchHandler.POLL_INTERVAL, max(0, deadline - time.time())))
+            statuses = yield self.statuses(job_ids)
+            status_version = WatchHandler.version(statuses)
+
+        if self.closed:
+            return
+
+        self.set_header("Etag", status_version)
+
+        if status_version == known_version:
+            self.set_status(304)
+            self.finish()
+        else:
+            self.write_json(statuses)
+
+class MetricsHandler(BaseDsmcHandler):
+    """
+    Metrics of the service, for Prometheus to scrape.
+    """
+
+    def get(self):
+        """
+        Get counters and histograms, in the Prometheus text format, of the seconds
+        spent in each stage of the work of the handlers (e.g. the dsmc query, the
+        listing of the archive, the comparison and the writing of the filelist of
+        a reupload), the requests served, how long jobs waited and ran, the return
+        codes and the dsmc warnings of finished jobs, the files and bytes they
+        archived, and their throughput.
+        """
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(REGISTRY.expose())
+
 class StopHandler(BaseDsmcHandler):
     """
     Stop one or all jobs.
@@ -0,0 +1,202 @@
+"""
+Bundles the small files of an archive into tar files, so that they become a
+few large TSM objects instead of hundreds of thousands of tiny ones. Every
+bundle is an uncompressed tar, streamed straight from the runfolder, and an
+index tells which bundle, and where in it, every file ended up, e.g.
+
+    # arteria-dsmc bundle index 1
+    small_files_0001.tar    InterOp/ExtractionMetricsOut.bin    80524    1536    9e107d9d372bb6826bd81d3542a419d6
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import tarfile
+
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+INDEX_NAME = "small_files.index"
+INDEX_HEADER = "# arteria-dsmc bundle index 1"
+
+# A bundle is closed when it has grown to this many bytes
+MAX_BUNDLE_BYTES = 10 * 1024 ** 3
+
+# Where a file ended up: the name of the bundle, its size, the offset of its
+# data in the bundle, and the md5 of its data
+BundledFile = collections.namedtuple("BundledFile", ["bundle", "size", "offset", "md5"])
+
+
+class _HashingReader(object):
+    """
+    Calculates the md5 of a file as tarfile reads it into the bundle
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.md5.update(data)
+        return data
+
+
+def bundle_name(nbr):
+    return "small_files_{:04d}.tar".format(nbr)
+
+
+def split_into_bundles(files, max_bundle_bytes=MAX_BUNDLE_BYTES):
+    """
+    Split files into bundles in order of their path, so that files of the same
+    directory end up next to each other.
+    :param files: iterable of (relative path, size) tuples
+    :return: list of bundles, each a list of relative paths
+    """
+    bundles = []
+    bundle_bytes = 0
+
+    for rel_path, size in sorted(files):
+        if not bundles or (bundle_bytes > 0 and bundle_bytes + size > max_bundle_bytes):
+            bundles.append([])
+            bundle_bytes = 0
+
+        bundles[-1].append(rel_path)
+        bundle_bytes += size
+
+    return bundles
+
+
+def _write_bundle(src, bundle_path, rel_paths):
+    """
+    :return: list of (relative path, size, offset, md5) of the files in the bundle
+    """
+    entries = []
+
+    with tarfile.open(bundle_path, "w", dereference=True) as tar:
+        for rel_path in rel_paths:
+            tarinfo = tar.gettarinfo(os.path.join(src, rel_path), arcname=rel_path)
+
+            with open(os.path.join(src, rel_path), "rb") as f:
+                reader = _HashingReader(f)
+                tar.addfile(tarinfo, reader)
+
+            # The data ends the member, padded to a whole number of blocks
+            offset = tar.offset - (tarinfo.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+            entries.append((rel_path, tarinfo.size, offset, reader.md5.hexdigest()))
+
+    return entries
+
+
+def write_bundles(src, dest, files, max_bundle_bytes=MAX_BUNDLE_BYTES, workers=1):
+    """
+    Write files of `src` into tar bundles in `dest`, and write an index of them
+    in `dest`, see `INDEX_NAME`.
+    :param src: the runfolder
+    :param dest: the archive dir to write the bundles in
+    :param files: iterable of (path relative to `src`, size) of the files to bundle
+    :param max_bundle_bytes: the size at which a bundle is closed
+    :param workers: number of bundles to write at once
+    :return: list of the names of the bundles
+    :raises IOError, OSError: if a file couldn't be bundled
+    """
+    bundles = split_into_bundles(files, max_bundle_bytes)
+    names = [bundle_name(nbr) for nbr in range(1, len(bundles) + 1)]
+
+    def write(args):
+        name, rel_paths = args
+        return name, _write_bundle(src, os.path.join(dest, name), rel_paths)
+
+    pool = ThreadPool(workers) if workers > 1 and len(bundles) > 1 else None
+
+    try:
+        results = (pool.map if pool else map)(write, zip(names, bundles))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    index_path = os.path.join(dest, INDEX_NAME)
+
+    with open("{}.tmp".format(index_path), "w") as index:
+        index.write("{}\n".format(INDEX_HEADER))
+
+        for name, entries in results:
+            for rel_path, size, offset, md5 in entries:
+                index.write("{}\t{}\t{}\t{}\t{}\n".format(name, rel_path, size, offset, md5))
+
+    os.rename("{}.tmp".format(index_path), index_path)
+
+    log.debug("Bundled {} files from {} into {} bundles in {}".format(
+        sum(len(bundle) for bundle in bundles), src, len(bundles), dest))
+
+    return names
+
+
+def read_index(archive_dir):
+    """
+    :param archive_dir: with the bundles and their index
+    :return: dict of relative path and `BundledFile`, empty if nothing was bundled
+    """
+    index_path = os.path.join(archive_dir, INDEX_NAME)
+    bundled = {}
+
+    if not os.path.exists(index_path):
+        return bundled
+
+    with open(index_path) as index:
+        header = index.readline().rstrip("\n")
+
+        if header != INDEX_HEADER:
+            raise ValueError("{} is not a bundle index".format(index_path))
+
+        for line in index:
+            name, rel_path, size, offset, md5 = line.rstrip("\n").split("\t")
+            bundled[rel_path] = BundledFile(name, int(size), int(offset), md5)
+
+    return bundled
+
+
+def read_bundled_file(archive_dir, bundled_file, block_size=8 * 1024 * 1024):
+    """
+    Read a bundled file straight from its bundle, without going through the tar headers
+    :return: generator of blocks of the data of the file
+    """
+    with open(os.path.join(archive_dir, bundled_file.bundle), "rb") as f:
+        f.seek(bundled_file.offset)
+        left = bundled_file.size
+
+        while left > 0:
+            data = f.read(min(block_size, left))
+
+            if not data:
+                raise IOError("{} ends before the data of the bundled file".format(bundled_file.bundle))
+
+            left -= len(data)
+            yield data
+
+
+def verify_bundles(archive_dir):
+    """
+    Check the files in the bundles of an archive against the md5s of the index
+    :param archive_dir: with the bundles and their index
+    :return: list of (relative path, error message) of the files that don't match
+    """
+    errors = []
+
+    for rel_path, bundled_file in sorted(read_index(archive_dir).iteritems()):
+        md5 = hashlib.md5()
+
+        try:
+            for data in read_bundled_file(archive_dir, bundled_file):
+                md5.update(data)
+        except IOError, msg:
+            errors.append((rel_path, str(msg)))
+            continue
+
+        if md5.hexdigest() != bundled_file.md5:
+            errors.append((rel_path, "md5 {} differs from {} in the index".format(md5.hexdigest(), bundled_file.md5)))
+
+    return errors
@@ -0,0 +1,341 @@
+import datetime
+import logging
+import os
+
+from arteria.web.state import State
+from concurrent.futures import ThreadPoolExecutor
+
+from dsmc.lib.db import connect
+from dsmc.lib.listing import FileListing
+from dsmc.lib.manifest import Manifest
+
+log = logging.getLogger(__name__)
+
+
+class ArchiveCatalog(object):
+    """
+    A local SQLite catalog of what has been archived to PDC, so that we don't
+    have to run `dsmc q ar` against the TSM server every time we want to
+    compare a local archive with what has been uploaded.
+
+    The catalog is filled when upload and reupload jobs finish, see
+    `CatalogUpdater`, or refreshed
+    from a live dsmc query. An archive is only served from the catalog as long
+    as it isn't flagged as stale and has been refreshed within `max_age`.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS archives (
+            archive TEXT PRIMARY KEY,
+            refreshed_at TEXT NOT NULL,
+            stale INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS objects (
+            archive TEXT NOT NULL,
+            description TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            archived_at TEXT NOT NULL,
+            PRIMARY KEY (archive, description, path)
+        );
+        CREATE TABLE IF NOT EXISTS pending_jobs (
+            job_id TEXT PRIMARY KEY,
+            archive TEXT NOT NULL,
+            description TEXT NOT NULL,
+            complete INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS pending_files (
+            job_id TEXT NOT NULL,
+            path TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS pending_files_job_id ON pending_files (job_id);
+        """
+
+    # The states of jobs that ended without uploading everything
+    UNFINISHED_STATES = (State.ERROR, State.CANCELLED, State.NONE)
+
+    def __init__(self, db_path, max_age):
+        """
+        :param db_path: path to the SQLite database, created if it doesn't exist
+        :param max_age: a timedelta after which a catalogued archive is considered stale
+        """
+        self.db_path = db_path
+        self.max_age = max_age
+
+        with connect(self.db_path) as conn:
+            conn.executescript(ArchiveCatalog.SCHEMA)
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now().isoformat(" ")
+
+    def replace(self, archive, archived_files):
+        """
+        Replace everything known about an archive with the result of a dsmc query
+        :param archive: path to the archive as reported by dsmc
+        :param archived_files: iterable of `dsmc.lib.query.ArchivedFile`. It is
+                               consumed within one transaction, so if it raises
+                               the catalog is left untouched.
+        """
+        with connect(self.db_path) as conn:
+            conn.execute("DELETE FROM objects WHERE archive = ?", (archive,))
+            conn.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)",
+                             ((archive, archived.description, archived.path, archived.size,
+                               archived.archived_at.isoformat(" ")) for archived in archived_files))
+            conn.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, 0)", (archive, ArchiveCatalog._now()))
+
+        log.debug("Refreshed the catalog for {}".format(archive))
+
+    def extend(self, archive, archived_files):
+        """
+        Add more of the result of a dsmc query to an archive just refreshed by `replace`, e.g.
+        when dsmc lists the objects of several archives interleaved
+        :param archive: path to the archive as reported by dsmc
+        :param archived_files: iterable of `dsmc.lib.query.ArchivedFile`, consumed within one transaction
+        """
+        with connect(self.db_path) as conn:
+            conn.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)",
+                             ((archive, archived.description, archived.path, archived.size,
+                               archived.archived_at.isoformat(" ")) for archived in archived_files))
+
+    def add(self, archive, description, files, complete):
+        """
+        Add files that have been archived under a description
+        :param archive: path to the archive
+        :param description: the dsmc description used when archiving
+        :param files: iterable of (path, size) tuples
+        :param complete: True if `files` is everything archived under this description,
+                         otherwise the files are only added if the archive is already catalogued.
+        """
+        now = ArchiveCatalog._now()
+
+        with connect(self.db_path) as conn:
+            known = conn.execute("SELECT 1 FROM archives WHERE archive = ?", (archive,)).fetchone()
+
+            if not complete and not known:
+                log.debug("{} is not catalogued, so partial upload will not be added".format(archive))
+                return
+
+            files = list(files)
+
+            if not files:
+                log.debug("Nothing archived under {} for {}, not cataloguing it".format(description, archive))
+                return
+
+            conn.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)",
+                             ((archive, description, path, size, now) for path, size in files))
+            conn.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, 0)", (archive, now))
+
+    def mark_stale(self, archive):
+        """
+        Flag an archive as stale, e.g. when an upload of it has been started or has failed
+        :param archive: to flag
+        """
+        with connect(self.db_path) as conn:
+            conn.execute("UPDATE archives SET stale = 1 WHERE archive = ?", (archive,))
+
+    def is_fresh(self, archive):
+        """
+        :param archive: to check
+        :return: True if the archive is catalogued, not flagged as stale and recently refreshed
+        """
+        with connect(self.db_path) as conn:
+            row = conn.execute("SELECT refreshed_at, stale FROM archives WHERE archive = ?", (archive,)).fetchone()
+
+        if not row:
+            return False
+
+        refreshed_at, stale = row
+        oldest_fresh = (datetime.datetime.now() - self.max_age).isoformat(" ")
+
+        return not stale and refreshed_at >= oldest_fresh
+
+    def latest_description(self, archive):
+        """
+        :param archive: to look up
+        :return: the description of the most recently archived version, or None
+        """
+        with connect(self.db_path) as conn:
+            row = conn.execute("SELECT description FROM objects WHERE archive = ? "
+                               "GROUP BY description ORDER BY MAX(archived_at) DESC LIMIT 1", (archive,)).fetchone()
+
+        return row[0] if row else None
+
+    def filelist(self, archive, description):
+        """
+        :param archive: to look up
+        :param description: of the archived version
+        :return: `dsmc.lib.listing.FileListing` of the objects, like `ReuploadHelper.get_pdc_filelist`
+        """
+        listing = FileListing(archive)
+
+        with connect(self.db_path) as conn:
+            rows = conn.execute("SELECT path, size FROM objects WHERE archive = ? AND description = ?",
+                                (archive, description))
+            # sqlite gives back unicode, while dsmc and the file system give byte strings
+            for path, size in rows:
+                listing.add(path.encode("utf-8") if isinstance(path, unicode) else path, size)
+
+        return listing
+
+    def track_job(self, job_id, archive, description, files=None):
+        """
+        Remember a started upload job, so that the catalog can be updated when it finishes
+        :param job_id: of the upload job
+        :param archive: path to the archive being uploaded
+        :param description: the dsmc description used
+        :param files: list of the files uploaded, or None if the whole archive is uploaded
+        """
+        with connect(self.db_path) as conn:
+            conn.execute("INSERT OR REPLACE INTO pending_jobs VALUES (?, ?, ?, ?)",
+                         (str(job_id), archive, description, int(files is None)))
+
+            if files is not None:
+                conn.executemany("INSERT INTO pending_files VALUES (?, ?)", ((str(job_id), path) for path in files))
+
+            conn.execute("UPDATE archives SET stale = 1 WHERE archive = ?", (archive,))
+
+    def _forget_job(self, conn, job_id):
+        conn.execute("DELETE FROM pending_jobs WHERE job_id = ?", (job_id,))
+        conn.execute("DELETE FROM pending_files WHERE job_id = ?", (job_id,))
+
+    @staticmethod
+    def _local_sizes(paths):
+        for path in paths:
+            try:
+                yield path, os.path.getsize(path)
+            except OSError, msg:
+                log.info("Could not stat {} when updating the catalog: {}".format(path, msg))
+
+    def job_finished(self, job_id, state, workers=1, manifest_dir=None):
+        """
+        Update the catalog for a tracked upload job that has finished. A job that
+        isn't tracked, e.g. because it has already been handled, is ignored.
+        :param job_id: of the job
+        :param state: the final state of the job. Jobs that failed, or are no longer
+                      known by the runner, leave their archive stale.
+        :param workers: number of threads used to list archives that were reuploaded
+        :param manifest_dir: if given, a `dsmc.lib.manifest.Manifest` of the archive is
+                             written here when an upload or reupload is done. An upload of
+                             a whole archive is only catalogued from the manifest taken
+                             when it started, see `dsmc.lib.manifest.Manifest.pending_path_for`.
+        """
+        job_id = str(job_id)
+
+        with connect(self.db_path) as conn:
+            row = conn.execute("SELECT archive, description, complete FROM pending_jobs WHERE job_id = ?",
+                               (job_id,)).fetchone()
+
+        if not row:
+            return
+
+        archive, description, complete = row
+        pending_manifest = Manifest.pending_path_for(manifest_dir, job_id) if manifest_dir else None
+
+        if state == State.DONE and complete:
+            # Everything in the archive as it was when the upload started is now in PDC
+            # under this description, see `BaseDsmcHandler.track_job`
+            if pending_manifest and os.path.exists(pending_manifest):
+                log.debug("Upload job {} of {} is done, updating the catalog".format(job_id, archive))
+                manifest = Manifest.read(pending_manifest)
+                self.add(archive, description, ((os.path.join(archive, rel_path), local_file.size)
+                                                for rel_path, local_file in manifest.files.iteritems()), complete)
+                os.rename(pending_manifest, Manifest.path_for(manifest_dir, archive))
+            else:
+                log.info("No manifest of {} was taken when job {} started, catalog remains stale".format(
+                    archive, job_id))
+        elif state == State.DONE:
+            log.debug("Upload job {} of {} is done, updating the catalog".format(job_id, archive))
+
+            if manifest_dir:
+                manifest, _ = Manifest.create(archive, description, workers)
+                manifest.write(Manifest.path_for(manifest_dir, archive))
+
+            with connect(self.db_path) as conn:
+                paths = [path for path, in conn.execute("SELECT path FROM pending_files WHERE job_id = ?", (job_id,))]
+
+            if self.latest_description(archive) == description:
+                self.add(archive, description, ArchiveCatalog._local_sizes(paths), complete)
+        elif state in ArchiveCatalog.UNFINISHED_STATES:
+            log.debug("Upload job {} of {} did not finish, catalog remains stale".format(job_id, archive))
+            self.mark_stale(archive)
+        else:
+            return
+
+        if pending_manifest and os.path.exists(pending_manifest):
+            os.remove(pending_manifest)
+
+        with connect(self.db_path) as conn:
+            self._forget_job(conn, job_id)
+
+    def update_from_jobs(self, runner_service, workers=1, manifest_dir=None):
+        """
+        Update the catalog with all the tracked upload jobs that have finished, e.g. the
+        ones that finished, or were interrupted, before the service was restarted.
+        :param runner_service: to check the job states with
+        :param workers: see `job_finished`
+        :param manifest_dir: see `job_finished`
+        """
+        with connect(self.db_path) as conn:
+            pending = [row[0] for row in conn.execute("SELECT job_id FROM pending_jobs")]
+
+        for job_id in pending:
+            self.job_finished(job_id, runner_service.status(job_id), workers, manifest_dir)
+
+
+class CatalogUpdater(object):
+    """
+    Updates an `ArchiveCatalog`, and writes manifests, as soon as the upload jobs
+    it tracks finish. This scans the archives, so it's done in a thread of its
+    own, one job at a time, rather than when someone asks for the status of a job.
+    """
+
+    def __init__(self, catalog, runner_service, workers=1, manifest_dir=None):
+        """
+        :param catalog: the `ArchiveCatalog` to update
+        :param runner_service: that runs the jobs, see `dsmc.lib.jobrunner.JobRunnerAdapter`
+        :param workers: number of threads used to list archives that were reuploaded
+        :param manifest_dir: where to write the manifests of archives that have been uploaded
+        """
+        self.catalog = catalog
+        self.runner_service = runner_service
+        self.workers = workers
+        self.manifest_dir = manifest_dir
+        self.executor = ThreadPoolExecutor(1)
+
+        runner_service.add_finished_callback(self.job_finished)
+
+    def track_job(self, job_id, archive, description, files=None):
+        """
+        Remember a started upload job, see `ArchiveCatalog.track_job`
+        """
+        self.catalog.track_job(job_id, archive, description, files)
+
+        # The job may have finished before it was tracked
+        state = self.runner_service.status(job_id)
+        if state == State.DONE or state in ArchiveCatalog.UNFINISHED_STATES:
+            self.job_finished(job_id, state)
+
+    def job_finished(self, job_id, state):
+        """
+        Update the catalog for a job that has finished, in the background
+        :return: a `Future` of the update
+        """
+        return self.executor.submit(self._run, self.catalog.job_finished, job_id, state,
+                                    self.workers, self.manifest_dir)
+
+    def sweep(self):
+        """
+        Update the catalog, in the background, for the tracked jobs that finished
+        while the service wasn't running
+        :return: a `Future` of the update
+        """
+        return self.executor.submit(self._run, self.catalog.update_from_jobs, self.runner_service,
+                                    self.workers, self.manifest_dir)
+
+    @staticmethod
+    def _run(func, *args):
+        try:
+            func(*args)
+        except Exception, msg:
+            log.error("Could not update the catalog: {}".format(msg))
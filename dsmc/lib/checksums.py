@@ -0,0 +1,485 @@
+"""
+Generates md5sum compatible checksums for all files in an archive, hashing
+files in parallel in a pool of processes. Several digests can be calculated,
+and gzip files checked for integrity, while reading each file only once.
+
+Meant to be run as a job through the runner service, e.g.
+
+    python -m dsmc.lib.checksums /path/to/archive --output checksums_prior_to_pdc.md5 --workers 4 \
+        --cache /path/to/checksum_cache.sqlite --algorithms md5 sha256 --check-gzip
+
+The files of an archive retrieved from PDC are checked against the checksum
+file, in parallel, with
+
+    python -m dsmc.lib.checksums /path/to/archive --output checksums_prior_to_pdc.md5 --workers 4 --verify
+"""
+
+import argparse
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+import zlib
+
+from dsmc.lib.inventory import scan_tree
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+log = logging.getLogger(__name__)
+
+# Read large blocks, aligned to the block size of the file system, into one
+# buffer per worker process that is reused for every file.
+BLOCK_SIZE = 8 * 1024 * 1024
+
+_buffer = None
+
+# The digests that can be calculated, and the extension of their output file
+ALGORITHMS = {"md5": hashlib.md5, "sha256": hashlib.sha256}
+
+if xxhash:
+    ALGORITHMS["xxh64"] = xxhash.xxh64
+
+# The cache keeps track of gzip files that have been checked, as if it was a digest
+GZIP_OK = "ok"
+
+
+class ChecksumCache(object):
+    """
+    A persistent cache of checksums, keyed on the identity of the real file
+    (device and inode, with links resolved) and its size and mtime. The
+    `_archive` directories are trees of links to the runfolder, so rebuilding
+    them doesn't change the real files, and their checksums can be reused
+    instead of reading the files again.
+
+    Only meant to be used from one thread at a time, but several jobs may use
+    the same cache at once. Checksums are written in small batches, each in a
+    short transaction, so that the others aren't locked out for long, and a
+    batch that can't be written is dropped as if it had never been cached.
+    """
+
+    # Write now and then, so that an interrupted job still leaves the
+    # checksums calculated so far behind.
+    BATCH_SIZE = 50
+
+    # How long to wait for another job to finish writing
+    BUSY_TIMEOUT_SECONDS = 30
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path, timeout=ChecksumCache.BUSY_TIMEOUT_SECONDS)
+
+        # Readers don't block the writer, nor the writer the readers, in WAL mode
+        try:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.Error, msg:
+            log.info("Could not switch the checksum cache {} to WAL: {}".format(db_path, msg))
+
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS checksums (
+                    dev INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    algorithm TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    digest TEXT NOT NULL,
+                    PRIMARY KEY (dev, inode, algorithm)
+                )""")
+        self.pending = []
+
+    def get(self, local_file, algorithm):
+        """
+        :param local_file: a `dsmc.lib.inventory.LocalFile`
+        :param algorithm: e.g. "md5"
+        :return: the cached digest, or None if the file isn't cached, has changed or the cache can't be read
+        """
+        try:
+            row = self.conn.execute("SELECT digest FROM checksums WHERE dev = ? AND inode = ? AND algorithm = ? "
+                                    "AND size = ? AND mtime = ?",
+                                    (local_file.dev, local_file.inode, algorithm, local_file.size,
+                                     local_file.mtime)).fetchone()
+        except sqlite3.Error, msg:
+            log.warning("Could not read the checksum cache: {}".format(msg))
+            return None
+
+        return row[0] if row else None
+
+    def put(self, local_file, algorithm, digest):
+        self.pending.append((local_file.dev, local_file.inode, algorithm, local_file.size, local_file.mtime, digest))
+
+        if len(self.pending) >= ChecksumCache.BATCH_SIZE:
+            self.commit()
+
+    def commit(self):
+        pending, self.pending = self.pending, []
+
+        if not pending:
+            return
+
+        try:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)", pending)
+        except sqlite3.Error, msg:
+            log.warning("Could not write {} checksums to the cache: {}".format(len(pending), msg))
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+class GzipValidator(object):
+    """
+    Checks that gzip data decompresses completely, like `gzip -t`, while
+    being fed the data block by block. Files of several gzip members, e.g.
+    concatenated or bgzipped fastq files, are supported.
+    """
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def update(self, data):
+        """
+        :raises zlib.error: if the data isn't valid gzip
+        """
+        while data:
+            # Limit the output, the decompressed data is thrown away anyway
+            self.decompressor.decompress(data, BLOCK_SIZE)
+
+            if self.decompressor.unused_data:
+                # A member ended, the rest of the data starts the next one
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = self.decompressor.unconsumed_tail
+
+    def is_complete(self):
+        """
+        :return: True if the data fed so far ends with a complete gzip member
+        """
+        # Anything fed after the end of a member ends up in `unused_data`, so
+        # a byte shows up there only if the last member is complete.
+        try:
+            self.decompressor.decompress(b"\0")
+        except zlib.error:
+            return False
+
+        return self.decompressor.unused_data == b"\0"
+
+
+def hash_file(path, algorithms=("md5",), check_gzip=False):
+    """
+    Calculate the digests of a file, and optionally check that it's a valid
+    gzip file, in one pass over the file.
+    :param path: to the file
+    :param algorithms: names of the digests to calculate, see `ALGORITHMS`
+    :param check_gzip: also check that the file decompresses completely
+    :return: tuple of (path, dict of algorithm and hex digest, error message or None,
+             gzip error message or None)
+    """
+    global _buffer
+
+    if _buffer is None:
+        _buffer = bytearray(BLOCK_SIZE)
+
+    view = memoryview(_buffer)
+    hashes = [(algorithm, ALGORITHMS[algorithm]()) for algorithm in algorithms]
+    gzip_validator = GzipValidator() if check_gzip else None
+    gzip_error = None
+
+    try:
+        with io.open(path, "rb", buffering=0) as f:
+            while True:
+                nbr_of_bytes = f.readinto(_buffer)
+
+                if not nbr_of_bytes:
+                    break
+
+                block = view[:nbr_of_bytes]
+
+                for _, hash_obj in hashes:
+                    hash_obj.update(block)
+
+                if gzip_validator:
+                    try:
+                        gzip_validator.update(block.tobytes())
+                    except zlib.error, msg:
+                        gzip_error = "invalid gzip data: {}".format(msg)
+                        gzip_validator = None
+    except (IOError, OSError), msg:
+        return path, None, str(msg), None
+
+    if gzip_validator and not gzip_validator.is_complete():
+        gzip_error = "unexpected end of file, the file is truncated"
+
+    return path, dict((algorithm, hash_obj.hexdigest()) for algorithm, hash_obj in hashes), None, gzip_error
+
+
+def _hash_file_task(args):
+    # `Pool.imap_unordered` only passes one argument
+    return hash_file(*args)
+
+
+def output_name_for(output_name, algorithm):
+    """
+    :param output_name: name of the md5 file
+    :return: name of the checksum file of an algorithm, e.g. checksums_prior_to_pdc.sha256
+             for checksums_prior_to_pdc.md5
+    """
+    if algorithm == "md5":
+        return output_name
+    return "{}.{}".format(os.path.splitext(output_name)[0], algorithm)
+
+
+def gzip_report_name_for(output_name):
+    """
+    :return: name of the file listing the gzip files that failed the integrity check
+    """
+    return "{}.gzip_errors".format(os.path.splitext(output_name)[0])
+
+
+def verify_report_name_for(output_name):
+    """
+    :return: name of the file listing the files that failed the check against the checksum file
+    """
+    return "{}.verify_errors".format(os.path.splitext(output_name)[0])
+
+
+def read_checksums(path):
+    """
+    :param path: to a checksum file in the format of md5sum
+    :return: dict of path, as written in the file, and digest
+    """
+    digests = {}
+
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+
+            if line:
+                # md5sum marks files read in binary mode by a "*" instead of the second space
+                digest, file_path = line[:line.index(" ")], line[line.index(" ") + 2:]
+                digests[file_path] = digest
+
+    return digests
+
+
+def verify_checksums(path_to_archive, output_name, workers=1):
+    """
+    Check the files of an archive, e.g. retrieved from PDC, against a checksum
+    file in it, like `md5sum -c` but hashing the files in parallel, the largest
+    first. The files that are missing or differ are listed in a report, see
+    `verify_report_name_for`.
+
+    :param path_to_archive: the archive to check
+    :param output_name: name of the checksum file in the archive, its digest is told by its
+                        extension, see `output_name_for`
+    :param workers: number of processes to hash with
+    :return: list of (path, error message) for the files that failed the check, by their path
+             in the checksum file
+    """
+    extension = os.path.splitext(output_name)[1][1:]
+    algorithm = extension if extension in ALGORITHMS else "md5"
+    expected = read_checksums(os.path.join(path_to_archive, output_name))
+
+    rel_paths = {}
+    sizes = {}
+    errors = []
+
+    for rel_path in expected:
+        path = os.path.join(path_to_archive, rel_path)
+
+        try:
+            sizes[path] = os.path.getsize(path)
+            rel_paths[path] = rel_path
+        except OSError, msg:
+            errors.append((rel_path, "missing: {}".format(msg)))
+
+    log.info("Checking {} files in {} against {} using {} processes".format(len(expected), path_to_archive,
+                                                                         output_name, workers))
+
+    tasks = ((path, (algorithm,), False) for path in sorted(sizes, key=sizes.get, reverse=True))
+    pool = multiprocessing.Pool(workers)
+
+    try:
+        for path, digests, error, _ in pool.imap_unordered(_hash_file_task, tasks, chunksize=1):
+            rel_path = rel_paths[path]
+
+            if error:
+                errors.append((rel_path, error))
+            elif digests[algorithm] != expected[rel_path]:
+                errors.append((rel_path, "{} differs".format(algorithm)))
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    errors.sort()
+
+    with open(os.path.join(path_to_archive, verify_report_name_for(output_name)), "w") as report:
+        for rel_path, error in errors:
+            log.error("Check failed for {}: {}".format(rel_path, error))
+            report.write("{}\t{}\n".format(rel_path, error))
+
+    return errors
+
+
+def generate_checksums(path_to_archive, output_name, workers=1, cache=None, algorithms=("md5",), check_gzip=False):
+    """
+    Write the md5 of every file below the archive to a file in the archive,
+    in the same format as `find -L . -type f -exec md5sum {} +`. Linked files
+    and directories are followed, just like `find -L`.
+
+    Other digests are written to files of their own in the same format, named
+    after the algorithm, see `output_name_for`. If gzip files are checked, the
+    ones that don't decompress completely are listed in a report, see
+    `gzip_report_name_for`.
+
+    The largest files are hashed first, so that the job doesn't end with a
+    single worker busy with a large file while the others idle.
+
+    :param path_to_archive: the archive to checksum
+    :param output_name: name of the checksum file, written in the archive
+    :param workers: number of processes to hash with
+    :param cache: a `ChecksumCache` to take unchanged files from, and to store new checksums in
+    :param algorithms: names of the digests to calculate, see `ALGORITHMS`
+    :param check_gzip: check that all .gz files decompress completely
+    :return: tuple of list of (path, error message) for the files that couldn't be read,
+             and list of (path, error message) for the gzip files that failed the check
+    """
+    output_names = dict((algorithm, output_name_for(output_name, algorithm)) for algorithm in algorithms)
+    report_name = gzip_report_name_for(output_name)
+
+    inventory = scan_tree(path_to_archive, workers=workers, follow_links=True)
+
+    # Leave out the files written by earlier runs
+    for name in [output_name, report_name] + [output_name_for(output_name, algorithm) for algorithm in ALGORITHMS]:
+        inventory.pop(os.path.join(path_to_archive, name), None)
+
+    paths = sorted(inventory, key=lambda path: inventory[path].size, reverse=True)
+    errors = []
+    gzip_errors = []
+
+    def is_gzip(path):
+        return check_gzip and path.endswith(".gz")
+
+    def from_cache(path):
+        if not cache:
+            return None
+        if is_gzip(path) and cache.get(inventory[path], "gzip") != GZIP_OK:
+            return None
+
+        digests = dict((algorithm, cache.get(inventory[path], algorithm)) for algorithm in algorithms)
+        return digests if all(digests.values()) else None
+
+    outputs = {}
+    pool = multiprocessing.Pool(workers)
+
+    def write_checksums(path, digests):
+        rel_path = os.path.relpath(path, path_to_archive)
+
+        for algorithm, digest in digests.iteritems():
+            outputs[algorithm].write("{}  ./{}\n".format(digest, rel_path))
+
+    try:
+        for algorithm, name in output_names.iteritems():
+            outputs[algorithm] = open("{}.tmp".format(os.path.join(path_to_archive, name)), "w")
+
+        paths_to_hash = []
+
+        for path in paths:
+            digests = from_cache(path)
+
+            if digests:
+                write_checksums(path, digests)
+            else:
+                paths_to_hash.append(path)
+
+        log.info("Calculating checksums for {} files in {} using {} processes ({} taken from the cache)".format(
+            len(paths_to_hash), path_to_archive, workers, len(paths) - len(paths_to_hash)))
+
+        tasks = ((path, algorithms, is_gzip(path)) for path in paths_to_hash)
+
+        for path, digests, error, gzip_error in pool.imap_unordered(_hash_file_task, tasks, chunksize=1):
+            if error:
+                log.error("Could not calculate checksum for {}: {}".format(path, error))
+                errors.append((path, error))
+                continue
+
+            write_checksums(path, digests)
+
+            if gzip_error:
+                log.error("Gzip integrity check failed for {}: {}".format(path, gzip_error))
+                gzip_errors.append((path, gzip_error))
+
+            if cache:
+                for algorithm, digest in digests.iteritems():
+                    cache.put(inventory[path], algorithm, digest)
+
+                if is_gzip(path) and not gzip_error:
+                    cache.put(inventory[path], "gzip", GZIP_OK)
+
+        if cache:
+            cache.commit()
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+        for output in outputs.itervalues():
+            output.close()
+
+    for name in output_names.itervalues():
+        output_path = os.path.join(path_to_archive, name)
+        os.rename("{}.tmp".format(output_path), output_path)
+
+    if check_gzip:
+        with open(os.path.join(path_to_archive, report_name), "w") as report:
+            for path, gzip_error in sorted(gzip_errors):
+                report.write("./{}\t{}\n".format(os.path.relpath(path, path_to_archive), gzip_error))
+
+    return errors, gzip_errors
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Generate md5sum compatible checksums for an archive")
+    parser.add_argument("path_to_archive")
+    parser.add_argument("--output", default="checksums_prior_to_pdc.md5",
+                        help="name of the md5 file, the files of the other digests are named after it")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--cache", help="SQLite database to cache checksums in")
+    parser.add_argument("--algorithms", nargs="+", choices=sorted(ALGORITHMS), default=["md5"])
+    parser.add_argument("--check-gzip", action="store_true", help="check that all .gz files decompress completely")
+    parser.add_argument("--verify", action="store_true",
+                        help="check the files against the checksum file named by --output, instead of writing it")
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    if args.verify:
+        return 1 if verify_checksums(args.path_to_archive, args.output, args.workers) else 0
+
+    cache = ChecksumCache(args.cache) if args.cache else None
+
+    try:
+        errors, gzip_errors = generate_checksums(args.path_to_archive, args.output, args.workers, cache,
+                                                 args.algorithms, args.check_gzip)
+    finally:
+        if cache:
+            cache.close()
+
+    return 1 if errors or gzip_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+import contextlib
+import sqlite3
+
+
+@contextlib.contextmanager
+def connect(db_path):
+    """
+    Open a SQLite database for one operation, e.g. `with connect(path) as conn:`.
+    The changes are committed when the block ends, or rolled back if it raises.
+    One connection per operation lets the database be used from any thread.
+    :param db_path: path to the database, created if it doesn't exist
+    :return: a context manager giving the connection
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        yield conn
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
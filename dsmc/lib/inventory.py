@@ -0,0 +1,154 @@
+import collections
+import logging
+import os
+import Queue
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+log = logging.getLogger(__name__)
+
+# What we know about a local file. The stat is taken from the `DirEntry`
+# and follows symlinks, so for the links in an `_archive` directory this
+# describes the real file.
+LocalFile = collections.namedtuple("LocalFile", ["size", "mtime", "inode", "dev"])
+
+
+def list_dir(path, follow_links=False):
+    """
+    List one directory using the stat information `scandir` already has.
+    :param path: directory to list
+    :param follow_links: also return linked directories
+    :return: tuple of (list of (file path, `LocalFile`), list of (subdir path, stat of subdir if following links))
+    """
+    files = []
+    subdirs = []
+
+    for entry in scandir(path):
+        try:
+            if entry.is_dir():
+                if entry.is_symlink() and not follow_links:
+                    # Like `os.walk` we don't descend into linked directories
+                    continue
+                subdirs.append((entry.path, entry.stat() if follow_links else None))
+            else:
+                try:
+                    stat = entry.stat()
+                except OSError, msg:
+                    # Keep broken links in the listing, and leave it to whoever
+                    # uses it to complain about them.
+                    log.info("Could not stat {}, using the link itself: {}".format(entry.path, msg))
+                    stat = entry.stat(follow_symlinks=False)
+                files.append((entry.path, LocalFile(stat.st_size, stat.st_mtime, stat.st_ino, stat.st_dev)))
+        except OSError, msg:
+            log.info("Could not stat {}: {}".format(entry.path, msg))
+
+    return files, subdirs
+
+
+def _run_visit(visit, path, context):
+    # This runs in the pool, where an exception would never reach the caller.
+    try:
+        files, subdirs = visit(path, context)
+        return path, files, subdirs, None
+    except Exception, msg:
+        return path, [], [], msg
+
+
+def walk(root, visit, root_context=None, workers=1):
+    """
+    Walk a tree by handing out directories to a pool of threads as they are found,
+    so that e.g. the lanes and the project directories under `Unaligned` are
+    listed in parallel. This pays off on network file systems where every stat
+    is a round trip.
+
+    :param root: the directory to start from
+    :param visit: function called with (directory path, context) that returns a tuple
+                  of (list of (file path, file info), list of (subdir path, subdir context))
+    :param root_context: context passed along with the root directory
+    :param workers: number of threads to visit directories with
+    :return: dict of file path and file info
+    """
+    inventory = {}
+    results = Queue.Queue()
+    pool = ThreadPool(workers) if workers > 1 else None
+
+    def submit(path, context):
+        if pool:
+            pool.apply_async(_run_visit, (visit, path, context), callback=results.put)
+        else:
+            results.put(_run_visit(visit, path, context))
+
+    try:
+        submit(root, root_context)
+        outstanding = 1
+
+        while outstanding:
+            path, files, subdirs, error = results.get()
+            outstanding -= 1
+
+            if error:
+                if path == root:
+                    raise OSError("Could not list {}: {}".format(root, error))
+                log.info("Could not list {}: {}".format(path, error))
+
+            inventory.update(files)
+
+            for subdir, context in subdirs:
+                submit(subdir, context)
+                outstanding += 1
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    return inventory
+
+
+def scan_tree(root, workers=1, follow_links=False, dirs=None):
+    """
+    List all files below a directory, see `walk`.
+
+    :param root: the directory to list
+    :param workers: number of threads to list directories with
+    :param follow_links: descend into linked directories, like `find -L`
+    :param dirs: if a dict is given, it is filled with the mtime of every directory
+    :return: dict of file path and `LocalFile`
+    """
+    def visit(path, ancestors):
+        if dirs is not None:
+            # Take the mtime before listing, so that changes made while
+            # listing are picked up by the next incremental scan.
+            dirs[path] = os.stat(path).st_mtime
+
+        files, subdirs = list_dir(path, follow_links)
+        subdir_contexts = []
+
+        for subdir, stat in subdirs:
+            subdir_ancestors = None
+
+            if stat:
+                # Like `find -L`, don't loop forever on links pointing back up the tree
+                if (stat.st_dev, stat.st_ino) in ancestors:
+                    log.info("Not following {}, as it links to one of its parents".format(subdir))
+                    continue
+                subdir_ancestors = ancestors | frozenset([(stat.st_dev, stat.st_ino)])
+
+            subdir_contexts.append((subdir, subdir_ancestors))
+
+        return files, subdir_contexts
+
+    root_context = None
+    if follow_links:
+        stat = os.stat(root)
+        root_context = frozenset([(stat.st_dev, stat.st_ino)])
+
+    inventory = walk(root, visit, root_context, workers)
+
+    log.debug("Found {} files below {}".format(len(inventory), root))
+
+    return inventory
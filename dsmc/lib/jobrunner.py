@@ -1,17 +1,40 @@
+import collections
+import itertools
 import logging
+import os
 import re
+import threading
+import time
 
 from localq.localQ_server import LocalQServer, Status
 from arteria.web.state import State as arteria_state
 
+from dsmc.lib.metrics import REGISTRY
+from dsmc.lib.progress import DsmcProgress
+
 log = logging.getLogger(__name__)
 
+JOB_QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "arteria_dsmc_job_queue_wait_seconds", "Seconds from a job was started until it was seen running", ["command"])
+JOB_RUN_SECONDS = REGISTRY.histogram(
+    "arteria_dsmc_job_run_seconds", "Seconds from a job was seen running until it was seen finished",
+    ["command", "state"])
+JOBS_FINISHED = REGISTRY.counter("arteria_dsmc_jobs_finished_total", "Jobs that have finished", ["command", "state"])
+JOB_RETURN_CODES = REGISTRY.counter("arteria_dsmc_job_return_codes_total", "Return codes of finished jobs",
+                                    ["command", "code"])
+DSMC_WARNINGS = REGISTRY.counter("arteria_dsmc_warnings_total", "dsmc warnings logged by finished jobs", ["code"])
+FILES_ARCHIVED = REGISTRY.counter("arteria_dsmc_archived_files_total", "Files sent by finished dsmc jobs")
+BYTES_ARCHIVED = REGISTRY.counter("arteria_dsmc_archived_bytes_total", "Bytes sent by finished dsmc jobs")
+UPLOAD_BYTES_PER_SECOND = REGISTRY.histogram(
+    "arteria_dsmc_upload_bytes_per_second", "Bytes sent per second of run time by finished dsmc jobs",
+    buckets=[2 ** power * 1024 ** 2 for power in range(11)])
+
 class JobRunnerAdapter:
     """
     Specifies interface that should be used by jobrunners.
     """
 
-    def start(self, cmd, nbr_of_cores, run_dir, stdout=None, stderr=None):
+    def start(self, cmd, nbr_of_cores, run_dir, stdout=None, stderr=None, resources=None, estimated_bytes=None):
         """
         Start a job corresponding to cmd
         :param cmd: to run
@@ -19,10 +42,49 @@ class JobRunnerAdapter:
         :param run_dir: where to run the job
         :param stdout: Reroute stdout to here
         :param stderr: Reroute stderr to here
+        :param resources: dict of other resources the job uses, see `JobScheduler`
+        :param estimated_bytes: the number of bytes the job will process, if known
         :return: the jobid associated with it (None on failure).
         """
         raise NotImplementedError("Subclasses should implement this!")
 
+    def start_group(self, jobs):
+        """
+        Start several jobs that together make up one piece of work, e.g. the
+        shards of an upload. The jobs are tracked by one parent job id, whose
+        status combines the status of the jobs.
+        :param jobs: list of dicts with the arguments to `start`
+        :return: the job id of the group (None on failure).
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def start_after(self, after_job_id, cmd, nbr_of_cores, run_dir, stdout=None, stderr=None, resources=None,
+                    estimated_bytes=None):
+        """
+        Start a job once another job, or group of jobs, is done, e.g. the check
+        of the files of a retrieve. If the other job fails the job is cancelled.
+        :param after_job_id: of the job to wait for
+        :return: the job id of the job waiting (None on failure). Its arguments are those of `start`.
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def children(self, job_id):
+        """
+        The jobs of a group started with `start_group`
+        :param job_id: of a group
+        :return: the job ids of the jobs in the group, or None if it isn't a group
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def add_finished_callback(self, callback):
+        """
+        Have a function called once for every job, or group of jobs, that finishes,
+        whether anyone asks for its status or not
+        :param callback: called with the job id and the final state. It is called
+                         from the thread that saw the job finish, so it should be quick.
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
     def stop(self, job_id):
         """
         Stop job with job_id
@@ -54,6 +116,171 @@ class JobRunnerAdapter:
         """
         raise NotImplementedError("Subclasses should implement this!")
 
+    def warnings(self, job_id):
+        """
+        Warnings the job has logged so far
+        :param job_id: to get warnings for
+        :return: dict of warning code and number of times it was logged, or None if unknown
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
+
+class WarningHistogram(object):
+    """
+    Counts the dsmc warnings (e.g. ANS1809W) in a log, and the files and bytes
+    dsmc has sent. The log is read from where the last update stopped, so that
+    a log of gigabytes is only read once, no matter how often the status of
+    its job is asked for.
+    """
+
+    WARNING = re.compile(r"ANS[0-9]+W")
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.offset = 0
+        self.partial_line = ""
+        self.counts = collections.Counter()
+        self.files_sent = 0
+        self.bytes_sent = 0
+
+        # Set once the job has finished and the whole log has been read
+        self.complete = False
+        self.lock = threading.Lock()
+
+    def update(self, final=False):
+        """
+        Count the warnings written to the log since the last update
+        :param final: the job has finished, so the log won't grow any more
+        :return: the counts so far
+        """
+        with self.lock:
+            if self.complete:
+                return self.counts
+
+            try:
+                with open(self.log_path, "rb") as f:
+                    f.seek(self.offset)
+                    data = f.read()
+                    self.offset = f.tell()
+            except (IOError, TypeError), msg:
+                log.debug("Could not read the log {}: {}".format(self.log_path, msg))
+                data = ""
+
+            # A warning code may be split between two reads, so only look at whole lines
+            lines = (self.partial_line + data).split("\n")
+            self.partial_line = "" if final else lines.pop()
+
+            for line in lines:
+                self.counts.update(WarningHistogram.WARNING.findall(line))
+
+                sent_bytes = DsmcProgress.sent_bytes(line)
+
+                if sent_bytes is not None:
+                    self.files_sent += 1
+                    self.bytes_sent += sent_bytes
+
+            self.complete = final
+
+            return self.counts
+
+
+class JobScheduler(object):
+    """
+    Decides when waiting jobs may start, given limits on the resources they
+    use, e.g. the number of concurrent dsmc sessions, the number of checksum
+    workers and the network bandwidth. Localq only knows about cores, which
+    says little about what limits an upload.
+
+    Of the jobs that fit in the resources left, the ones with the fewest bytes
+    to process start first, so that a small reupload doesn't wait behind a few
+    large archives. Jobs that have waited longer than `max_wait` seconds go
+    first, and hold back the others until they fit, so that large jobs aren't
+    starved by a steady stream of small ones.
+    """
+
+    def __init__(self, capacities, max_wait=3600, clock=time.time):
+        """
+        :param capacities: dict of resource name and how much of it there is, None for no limit
+        :param max_wait: seconds after which a waiting job gets priority
+        :param clock: returns the current time in seconds
+        """
+        self.capacities = capacities
+        self.max_wait = max_wait
+        self.clock = clock
+
+        self.in_use = collections.defaultdict(float)
+        self.waiting = {}
+        self.running = {}
+        self.submitted = itertools.count()
+
+    def submit(self, job_id, resources=None, estimated_bytes=None):
+        """
+        Put a job in line
+        :param job_id: of the job
+        :param resources: dict of resource name and how much of it the job uses
+        :param estimated_bytes: the number of bytes the job will process, None if not known.
+                                Jobs of unknown size are treated as larger than any other.
+        """
+        self.waiting[job_id] = (resources or {}, estimated_bytes, self.clock(), next(self.submitted))
+
+    def _fits(self, resources):
+        for resource, amount in resources.iteritems():
+            capacity = self.capacities.get(resource)
+
+            # A job larger than the capacity may still run on its own
+            if capacity is not None and self.in_use[resource] > 0 and self.in_use[resource] + amount > capacity:
+                return False
+
+        return True
+
+    def _priority(self, job_id):
+        resources, estimated_bytes, submitted_at, order = self.waiting[job_id]
+        starved = self.clock() - submitted_at > self.max_wait
+
+        if starved:
+            return 0, order, 0
+        return 1, estimated_bytes is None, estimated_bytes, order
+
+    def admit(self):
+        """
+        Take the jobs that may start now out of line, and count their resources as used
+        :return: list of the job ids to start, in order
+        """
+        admitted = []
+
+        for job_id in sorted(self.waiting, key=self._priority):
+            resources = self.waiting[job_id][0]
+            starved = self._priority(job_id)[0] == 0
+
+            if not self._fits(resources):
+                if starved:
+                    # Let the resources drain until the starved job fits
+                    break
+                continue
+
+            for resource, amount in resources.iteritems():
+                self.in_use[resource] += amount
+
+            self.running[job_id] = resources
+            del self.waiting[job_id]
+            admitted.append(job_id)
+
+        return admitted
+
+    def release(self, job_id):
+        """
+        Give back the resources of a job that has finished, or take it out of line
+        :return: True if the job was still waiting
+        """
+        if job_id in self.waiting:
+            del self.waiting[job_id]
+            return True
+
+        for resource, amount in self.running.pop(job_id, {}).iteritems():
+            self.in_use[resource] -= amount
+
+        return False
+
 
 class LocalQAdapter(JobRunnerAdapter):
     """
@@ -84,67 +311,503 @@ class LocalQAdapter(JobRunnerAdapter):
         else:
             return arteria_state.NONE
 
-    def __init__(self, nbr_of_cores, whitelisted_warnings, interval=30, priority_method="fifo"):
+    @staticmethod
+    def combine_states(states):
+        """
+        Combine the states of the jobs in a group. A group is running until all
+        its jobs have finished, and is only done if all of them are done.
+        :param states: arteria states of the jobs in the group
+        :return: the arteria state of the group
+        """
+        if arteria_state.STARTED in states:
+            return arteria_state.STARTED
+        elif arteria_state.PENDING in states:
+            return arteria_state.PENDING
+        elif arteria_state.ERROR in states or arteria_state.NONE in states:
+            return arteria_state.ERROR
+        elif arteria_state.CANCELLED in states:
+            return arteria_state.CANCELLED
+        else:
+            return arteria_state.DONE
+
+    def __init__(self, nbr_of_cores, whitelisted_warnings, interval=30, priority_method="fifo", job_store=None,
+                 scheduler=None):
+        """
+        :param job_store: a `dsmc.lib.jobstore.JobStore` to record the jobs in, so that
+                          job ids and the states of finished jobs survive a restart
+        :param scheduler: a `JobScheduler` that decides when jobs are handed to localq.
+                          Without it, jobs are handed to localq as they are started.
+        """
         self.nbr_of_cores = nbr_of_cores
-        self.whitelisted_warnings = whitelisted_warnings
+
+        # The whitelist may also be given as the string of a list
+        if isinstance(whitelisted_warnings, basestring):
+            whitelisted_warnings = WarningHistogram.WARNING.findall(whitelisted_warnings)
+        self.whitelisted_warnings = frozenset(whitelisted_warnings)
+
         self.server = LocalQServer(nbr_of_cores, interval, priority_method, use_shell=True)
         self.server.run()
 
-    def start(self, cmd, nbr_of_cores, run_dir, stdout=None, stderr=None):
-        return self.server.add(cmd, nbr_of_cores, run_dir, stdout=stdout, stderr=stderr)
+        # We hand out our own job ids, so that jobs and groups of jobs share
+        # one series of ids. They map to localq job ids, or to a list of our
+        # job ids for groups.
+        self.job_store = job_store
+        self.job_ids = itertools.count(job_store.last_job_id() + 1 if job_store else 1)
+        self.lock = threading.Lock()
+        self.localq_jobs = {}
+        self.groups = {}
+
+        # The group of every job in a group, so that the group is finished with its last job
+        self.parents = {}
+
+        # Jobs waiting for another job to finish, with the job id they wait for
+        # and the arguments to start them with, see `start_after`
+        self.dependent_jobs = {}
+
+        # The warnings in the stdout of every job, see `warnings`
+        self.histograms = {}
+
+        # The command of every job, and when it was started, handed to localq and
+        # seen running, for the metrics of the job, see `_record_metrics`
+        self.timings = {}
+
+        # The state of a job never changes once it has finished, so it's only
+        # worked out once, see `_job_status`
+        self.final_states = {}
+        self.finished_callbacks = []
+
+        if job_store:
+            interrupted = job_store.mark_interrupted()
+
+            if interrupted:
+                log.info("{} jobs were interrupted when the service stopped".format(interrupted))
+
+            self.final_states.update(job_store.final_states())
+
+        # Jobs waiting for the scheduler, with the arguments to start them with
+        self.scheduler = scheduler
+        self.scheduler_lock = threading.RLock()
+        self.waiting_jobs = {}
+
+        # Jobs are recorded as finished, and their resources freed, when they
+        # finish, whether anyone asks for their status or not
+        monitor = threading.Thread(target=self._monitor_forever, args=(interval,))
+        monitor.daemon = True
+        monitor.start()
+
+    def _next_job_id(self):
+        with self.lock:
+            return next(self.job_ids)
+
+    def _track(self, job_id, cmd, stdout):
+        self.histograms[job_id] = WarningHistogram(stdout)
+        self.timings[job_id] = {"command": os.path.basename(cmd.split(None, 1)[0]) if cmd.strip() else "",
+                                "started": time.time(), "handed_over": None, "running": None}
+
+    def start(self, cmd, nbr_of_cores, run_dir, stdout=None, stderr=None, resources=None, estimated_bytes=None):
+        if self.scheduler:
+            job_id = self._next_job_id()
+            self._track(job_id, cmd, stdout)
+
+            if self.job_store:
+                self.job_store.add_job(job_id, cmd, run_dir, stdout)
+
+            self._hand_over(job_id, {"cmd": cmd, "nbr_of_cores": nbr_of_cores, "run_dir": run_dir,
+                                     "stdout": stdout, "stderr": stderr, "resources": resources,
+                                     "estimated_bytes": estimated_bytes})
+            return job_id
+
+        localq_id = self.server.add(cmd, nbr_of_cores, run_dir, stdout=stdout, stderr=stderr)
+
+        if localq_id is None:
+            return None
+
+        job_id = self._next_job_id()
+        self.localq_jobs[job_id] = localq_id
+        self._track(job_id, cmd, stdout)
+        self.timings[job_id]["handed_over"] = self.timings[job_id]["started"]
+
+        if self.job_store:
+            self.job_store.add_job(job_id, cmd, run_dir, stdout)
+
+        return job_id
+
+    def _hand_over(self, job_id, job):
+        """
+        Put a job that has been given its job id in line for the scheduler, or
+        hand it to localq right away if there is no scheduler
+        :param job: dict of the arguments to `start`
+        """
+        if self.scheduler:
+            with self.scheduler_lock:
+                self.waiting_jobs[job_id] = job
+                self.scheduler.submit(job_id, job["resources"], job["estimated_bytes"])
+
+            self._dispatch()
+            return
+
+        localq_id = self.server.add(job["cmd"], job["nbr_of_cores"], job["run_dir"], stdout=job["stdout"],
+                                    stderr=job["stderr"])
+
+        if localq_id is None:
+            log.info("Could not start job {} in localq".format(job_id))
+            self._finished(job_id, arteria_state.ERROR)
+        else:
+            self.localq_jobs[job_id] = localq_id
+            self.timings[job_id]["handed_over"] = time.time()
+
+    def _dispatch(self):
+        """
+        Hand the jobs the scheduler lets start over to localq
+        """
+        with self.scheduler_lock:
+            for job_id in self.scheduler.admit():
+                job = self.waiting_jobs[job_id]
+                localq_id = self.server.add(job["cmd"], job["nbr_of_cores"], job["run_dir"],
+                                            stdout=job["stdout"], stderr=job["stderr"])
+
+                # `status` doesn't take the lock, so the job is only taken out of the waiting
+                # jobs once it can be found elsewhere, or it would look unknown meanwhile
+                if localq_id is None:
+                    log.info("Could not start job {} in localq".format(job_id))
+                    self._finished(job_id, arteria_state.ERROR)
+                else:
+                    log.debug("Scheduled job {} as localq job {}".format(job_id, localq_id))
+                    self.localq_jobs[job_id] = localq_id
+                    self.timings[job_id]["handed_over"] = time.time()
+
+                del self.waiting_jobs[job_id]
+
+    def check_jobs(self):
+        """
+        Work out the state of the jobs that haven't finished, so that finished jobs
+        are recorded, with their groups, and the jobs whose turn has come are started.
+        The monitor does this every `interval` seconds.
+        """
+        for job_id in self.localq_jobs.keys():
+            if job_id not in self.final_states:
+                self.status(job_id)
+
+        for job_id in self.dependent_jobs.keys():
+            self.status(job_id)
+
+        if self.scheduler:
+            self._dispatch()
+
+    def _monitor_forever(self, interval):
+        while True:
+            time.sleep(interval)
+
+            try:
+                self.check_jobs()
+            except Exception, msg:
+                log.error("Could not check the jobs: {}".format(msg))
+
+    def start_group(self, jobs):
+        children = []
+
+        for job in jobs:
+            child_id = self.start(**job)
+
+            if child_id is None:
+                log.info("Could not start all jobs of the group, stopping the ones started.")
+                for started in children:
+                    self.stop(started)
+                return None
+
+            children.append(child_id)
+
+        job_id = self._next_job_id()
+        self.groups[job_id] = children
+
+        for child in children:
+            self.parents[child] = job_id
+
+        if self.job_store:
+            self.job_store.add_group(job_id, children)
+
+        log.debug("Started group {} with the jobs {}".format(job_id, children))
+        return job_id
+
+    def start_after(self, after_job_id, cmd, nbr_of_cores, run_dir, stdout=None, stderr=None, resources=None,
+                    estimated_bytes=None):
+        job_id = self._next_job_id()
+        self._track(job_id, cmd, stdout)
+
+        if self.job_store:
+            self.job_store.add_job(job_id, cmd, run_dir, stdout)
+
+        self.dependent_jobs[job_id] = (int(after_job_id), {"cmd": cmd, "nbr_of_cores": nbr_of_cores,
+                                                           "run_dir": run_dir, "stdout": stdout, "stderr": stderr,
+                                                           "resources": resources,
+                                                           "estimated_bytes": estimated_bytes})
+
+        log.debug("Job {} will start when job {} is done".format(job_id, after_job_id))
+        return job_id
+
+    def _dependent_status(self, job_id):
+        """
+        Start a job waiting for another one if that one is done, or cancel it if that one failed
+        :return: the arteria state of the job
+        """
+        after_job_id, job = self.dependent_jobs[job_id]
+        after_state = self.status(after_job_id)
+
+        if not self._is_terminal(after_state):
+            return arteria_state.PENDING
+
+        # The dispatcher may get here at the same time
+        if self.dependent_jobs.pop(job_id, None) is None:
+            return self.status(job_id)
+
+        if after_state != arteria_state.DONE:
+            log.info("Cancelling job {}, as job {} it waited for ended as {}".format(job_id, after_job_id,
+                                                                                   after_state))
+            self._finished(job_id, arteria_state.CANCELLED)
+        else:
+            self._hand_over(job_id, job)
+
+        return self.status(job_id)
+
+    def children(self, job_id):
+        """
+        :param job_id: of a group
+        :return: the job ids of the jobs in the group, or None if it isn't a group
+        """
+        return self.groups.get(int(job_id))
+
+    def add_finished_callback(self, callback):
+        self.finished_callbacks.append(callback)
 
     def stop(self, job_id):
-        return self.server.stop_job_with_id(job_id)
+        job_id = int(job_id)
+
+        if job_id in self.groups:
+            for child in self.groups[job_id]:
+                self.stop(child)
+            return job_id
+        elif job_id in self.localq_jobs:
+            if self.server.stop_job_with_id(self.localq_jobs[job_id]) is not None:
+                return job_id
+        elif job_id in self.waiting_jobs:
+            with self.scheduler_lock:
+                if self.waiting_jobs.pop(job_id, None):
+                    self._finished(job_id, arteria_state.CANCELLED)
+                    return job_id
+        elif job_id in self.dependent_jobs:
+            if self.dependent_jobs.pop(job_id, None):
+                self._finished(job_id, arteria_state.CANCELLED)
+                return job_id
+
+        return None
 
     def stop_all(self):
         return self.server.stop_all_jobs()
 
+    def _is_terminal(self, state):
+        # A job that localq doesn't know about (NONE) may just not have shown up yet
+        return state in (arteria_state.DONE, arteria_state.ERROR, arteria_state.CANCELLED)
+
+    def _seen_running(self, job_id):
+        timing = self.timings.get(job_id)
+
+        if timing and timing["running"] is None:
+            timing["running"] = time.time()
+            JOB_QUEUE_WAIT_SECONDS.labels(timing["command"]).observe(timing["running"] - timing["started"])
+
+    def _record_metrics(self, job_id, state, returncode):
+        """
+        Record the run time, return code, warnings and the files and bytes sent of a finished job.
+        Jobs are only seen running and finished when their status is checked, which the
+        monitor does every `interval` seconds.
+        """
+        timing = self.timings.pop(job_id, None)
+
+        if not timing:
+            return
+
+        command = timing["command"]
+        JOBS_FINISHED.labels(command, state).inc()
+
+        # A job that finished between two checks was never seen running
+        running_since = timing["running"] or timing["handed_over"]
+
+        if running_since is None:
+            # It never left the line
+            return
+
+        if timing["running"] is None:
+            JOB_QUEUE_WAIT_SECONDS.labels(command).observe(running_since - timing["started"])
+
+        run_seconds = time.time() - running_since
+        JOB_RUN_SECONDS.labels(command, state).observe(run_seconds)
+
+        if isinstance(returncode, int):
+            JOB_RETURN_CODES.labels(command, str(returncode)).inc()
+
+        histogram = self.histograms.get(job_id)
+
+        if histogram and histogram.complete:
+            for code, count in histogram.counts.iteritems():
+                DSMC_WARNINGS.labels(code).inc(count)
+
+            if histogram.files_sent:
+                FILES_ARCHIVED.inc(histogram.files_sent)
+                BYTES_ARCHIVED.inc(histogram.bytes_sent)
+
+                if run_seconds > 0:
+                    UPLOAD_BYTES_PER_SECOND.observe(histogram.bytes_sent / run_seconds)
+
+    def _finished(self, job_id, state, returncode=None):
+        # The monitor and a status request may both see the job finish
+        with self.lock:
+            if job_id in self.final_states:
+                return
+            self.final_states[job_id] = state
+
+        if self.job_store:
+            self.job_store.set_state(job_id, state)
+
+        self._record_metrics(job_id, state, returncode)
+
+        if self.scheduler and job_id not in self.groups:
+            # The resources of the job are free for the next ones
+            with self.scheduler_lock:
+                self.scheduler.release(job_id)
+            self._dispatch()
+
+        for callback in self.finished_callbacks:
+            try:
+                callback(job_id, state)
+            except Exception, msg:
+                log.error("Could not handle that job {} has finished: {}".format(job_id, msg))
+
+        # A group is finished with its last job
+        group = self.parents.get(job_id)
+
+        if group is not None and all(child in self.final_states for child in self.groups[group]):
+            self._finished(group, LocalQAdapter.combine_states([self.final_states[child]
+                                                                for child in self.groups[group]]))
+
+    def _update_warnings(self, job_id, state):
+        return self.histograms[job_id].update(final=self._is_terminal(state))
+
     # Returns the stats of the long running DSMC or md5sum job. 
     def status(self, job_id):
-        arteria_status = LocalQAdapter.localq2arteria_status(self.server.get_status(job_id))
+        job_id = int(job_id)
+
+        # This includes jobs that finished, or were interrupted, before a restart
+        if job_id in self.final_states:
+            return self.final_states[job_id]
+
+        if job_id in self.groups:
+            return self._group_status(job_id, [self.status(child) for child in self.groups[job_id]])
+
+        if job_id in self.waiting_jobs:
+            return arteria_state.PENDING
+
+        if job_id in self.dependent_jobs:
+            return self._dependent_status(job_id)
+
+        if job_id not in self.localq_jobs:
+            return arteria_state.NONE
+
+        return self._job_status(job_id, self.server.get_status(self.localq_jobs[job_id]))
+
+    def _job_status(self, job_id, localq_status):
+        """
+        Work out the arteria state of a job, and remember it if the job has finished
+        :param job_id: our id of a job, not a group
+        :param localq_status: the status of the job in localq
+        :return: the arteria state
+        """
+        localq_id = self.localq_jobs[job_id]
+        arteria_status = LocalQAdapter.localq2arteria_status(localq_status)
+
+        if arteria_status == arteria_state.STARTED:
+            self._seen_running(job_id)
+
+        # Only the new part of the log is read, and nothing once the job has finished
+        warnings = self._update_warnings(job_id, arteria_status)
+        returncode = None
 
         # This is a bit hacky, because we're assuming this will only/mostly happen to 
         # dsmc and not md5sum. 
         if arteria_status == arteria_state.ERROR: 
             log.debug("DSMC process returned an error!")
-            job = self.server.get_job_with_id(int(job_id))
+            job = self.server.get_job_with_id(localq_id)
+            returncode = job.proc.returncode
 
             # DSMC sets return code to 8 when a warning was encountered. 
             # md5sum returns nonzero to indicate a failure. 
             if job.proc.returncode == 8: 
                 log.debug("DSMC process actually returned a warning.")
+                log.debug("Warnings found in DSMC output: {}".format(dict(warnings)))
 
-                # Search through the DSMC log and see if we only have 
-                # whitelisted warnings. If that is the case, change the
-                # return code to 0 instead. Otherwise keep the error state. 
+                # If we only have whitelisted warnings, change the return code
+                # to 0 instead. Otherwise keep the error state.
+                if set(warnings) - self.whitelisted_warnings:
+                    log.debug("A non-whitelisted DSMC warning was encountered. Keeping Arteria's error return state.")
+                else:
+                    log.debug("Only whitelisted DSMC warnings were encountered. Changing Arteria's return state to DONE.")
+                    arteria_status = arteria_state.DONE
+            else: 
+                log.info("An uncatched DSMC error code was encountered!")
 
-                warnings = []
+        if self._is_terminal(arteria_status):
+            if returncode is None and arteria_status == arteria_state.DONE:
+                returncode = 0
+            self._finished(job_id, arteria_status, returncode)
 
-                with open(job.stdout) as dsmc_log: 
-                    for line in dsmc_log: 
-                        matches = re.findall(r'ANS[0-9]+W', line)
+        return arteria_status
 
-                        for match in matches: 
-                            warnings.append(match) 
+    def _group_status(self, job_id, states):
+        state = LocalQAdapter.combine_states(states)
 
-                    log.debug("Warnings found in DSMC output: {}".format(warnings))
+        if self._is_terminal(state):
+            self._finished(job_id, state)
 
-                    for warning in warnings: 
-                        if warning not in self.whitelisted_warnings: 
-                            log.debug("A non-whitelisted DSMC warning was encountered. Keeping Arteria's error return state.")
-                            return arteria_state.ERROR
+        return state
 
-                    log.debug("Only whitelisted DSMC warnings were encountered. Changing Arteria's return state to DONE.")
-                    return arteria_state.DONE
-            else: 
-                log.info("An uncatched DSMC error code was encountered!")
-                return arteria_state.ERROR
-        else: 
-            return arteria_status
+    def warnings(self, job_id):
+        job_id = int(job_id)
+
+        if job_id in self.groups:
+            counts = collections.Counter()
+            for child in self.groups[job_id]:
+                counts.update(self.warnings(child) or {})
+            return dict(counts)
+
+        if job_id not in self.histograms:
+            return None
+
+        return dict(self.histograms[job_id].counts)
 
-    # TODO: At the moment `status_all()` will not re-write the return code from dsmc as with `status()`. 
     def status_all(self):
-        jobs_and_status = {}
-        for k, v in self.server.get_status_all().iteritems():
-            jobs_and_status[k] = LocalQAdapter.localq2arteria_status(v)
+        # Start with the jobs that have finished, also before a restart
+        jobs_and_status = dict(self.final_states)
+        localq_status = None
+
+        for job_id in self.waiting_jobs.keys():
+            jobs_and_status[job_id] = arteria_state.PENDING
+
+        for job_id, localq_id in self.localq_jobs.items():
+            if job_id in self.final_states:
+                jobs_and_status[job_id] = self.final_states[job_id]
+            else:
+                # Only ask localq when there are jobs that are still running
+                if localq_status is None:
+                    localq_status = self.server.get_status_all()
+                jobs_and_status[job_id] = self._job_status(job_id, localq_status.get(localq_id))
+
+        for job_id, children in self.groups.items():
+            # A group may have finished with its last job above
+            if job_id in self.final_states:
+                jobs_and_status[job_id] = self.final_states[job_id]
+            else:
+                jobs_and_status[job_id] = self._group_status(job_id, [jobs_and_status[child] for child in children])
+
+        for job_id in self.dependent_jobs.keys():
+            jobs_and_status[job_id] = self.status(job_id)
+
         return jobs_and_status
@@ -0,0 +1,140 @@
+import datetime
+import logging
+
+from arteria.web.state import State
+
+from dsmc.lib.db import connect
+
+log = logging.getLogger(__name__)
+
+
+class JobStore(object):
+    """
+    A local SQLite record of the jobs started by the service, so that job ids,
+    and the states of jobs, survive a restart of the service.
+
+    Jobs that were still running when the service stopped are marked as
+    interrupted, and reported as errors. Upload jobs are also described by the
+    archive and the dsmc description they upload, so that an interrupted upload
+    can be resumed by archiving what didn't reach PDC under that description.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY,
+            cmd TEXT,
+            run_dir TEXT,
+            stdout TEXT,
+            parent INTEGER,
+            state TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            interrupted INTEGER NOT NULL DEFAULT 0,
+            archive TEXT,
+            description TEXT,
+            resumed_by INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS jobs_parent ON jobs (parent);
+        """
+
+    FINAL_STATES = (State.DONE, State.ERROR, State.CANCELLED)
+
+    def __init__(self, db_path):
+        """
+        :param db_path: path to the SQLite database, created if it doesn't exist
+        """
+        self.db_path = db_path
+
+        with connect(self.db_path) as conn:
+            conn.executescript(JobStore.SCHEMA)
+
+    def add_job(self, job_id, cmd, run_dir, stdout):
+        with connect(self.db_path) as conn:
+            conn.execute("INSERT OR REPLACE INTO jobs (job_id, cmd, run_dir, stdout, state, started_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         (job_id, cmd, run_dir, stdout, State.PENDING, datetime.datetime.now().isoformat(" ")))
+
+    def add_group(self, job_id, children):
+        with connect(self.db_path) as conn:
+            conn.execute("INSERT OR REPLACE INTO jobs (job_id, state, started_at) VALUES (?, ?, ?)",
+                         (job_id, State.PENDING, datetime.datetime.now().isoformat(" ")))
+            conn.executemany("UPDATE jobs SET parent = ? WHERE job_id = ?", ((job_id, child) for child in children))
+
+    def set_state(self, job_id, state):
+        with connect(self.db_path) as conn:
+            conn.execute("UPDATE jobs SET state = ? WHERE job_id = ?", (state, job_id))
+
+    def describe(self, job_id, archive, description):
+        """
+        Record what an upload job archives
+        :param job_id: of the upload job, or group of upload jobs
+        :param archive: path to the archive being uploaded
+        :param description: the dsmc description used
+        """
+        with connect(self.db_path) as conn:
+            conn.execute("UPDATE jobs SET archive = ?, description = ? WHERE job_id = ?",
+                         (archive, description, int(job_id)))
+
+    def last_job_id(self):
+        """
+        :return: the highest job id handed out so far, or 0
+        """
+        with connect(self.db_path) as conn:
+            return conn.execute("SELECT MAX(job_id) FROM jobs").fetchone()[0] or 0
+
+    def mark_interrupted(self):
+        """
+        Mark the jobs that hadn't finished as interrupted, when the service starts
+        :return: the number of interrupted jobs
+        """
+        with connect(self.db_path) as conn:
+            cursor = conn.execute("UPDATE jobs SET state = ?, interrupted = 1 WHERE state NOT IN (?, ?, ?)",
+                                  (State.ERROR,) + JobStore.FINAL_STATES)
+            return cursor.rowcount
+
+    def final_states(self):
+        """
+        :return: dict of job id and state of the jobs that have finished
+        """
+        with connect(self.db_path) as conn:
+            rows = conn.execute("SELECT job_id, state FROM jobs WHERE state IN (?, ?, ?)", JobStore.FINAL_STATES)
+            return dict(rows)
+
+    def resumable(self):
+        """
+        :return: list of dicts describing the interrupted upload jobs that haven't been resumed
+        """
+        with connect(self.db_path) as conn:
+            rows = conn.execute("SELECT job_id, archive, description, started_at FROM jobs "
+                                "WHERE interrupted = 1 AND archive IS NOT NULL AND resumed_by IS NULL "
+                                "ORDER BY job_id").fetchall()
+
+        return [{"job_id": job_id, "archive": archive, "description": description, "started_at": started_at}
+                for job_id, archive, description, started_at in rows]
+
+    def mark_resumed(self, job_id, resumed_by):
+        """
+        :param job_id: of the interrupted upload job
+        :param resumed_by: the job id of the job uploading the rest of it, or 0 if
+                           everything had already been uploaded
+        """
+        with connect(self.db_path) as conn:
+            conn.execute("UPDATE jobs SET resumed_by = ? WHERE job_id = ?", (resumed_by, int(job_id)))
+
+    def job(self, job_id):
+        """
+        :param job_id: of a job
+        :return: dict of the command, run dir, stdout, parent, state, archive and description
+                 of the job, or None if it isn't known. A job in a group is described by the
+                 archive and description of its group.
+        """
+        with connect(self.db_path) as conn:
+            row = conn.execute("SELECT j.job_id, j.cmd, j.run_dir, j.stdout, j.parent, j.state, "
+                               "COALESCE(j.archive, p.archive), COALESCE(j.description, p.description) "
+                               "FROM jobs j LEFT JOIN jobs p ON p.job_id = j.parent "
+                               "WHERE j.job_id = ?", (int(job_id),)).fetchone()
+
+        if row is None:
+            return None
+
+        keys = ("job_id", "cmd", "run_dir", "stdout", "parent", "state", "archive", "description")
+        return dict(zip(keys, row))
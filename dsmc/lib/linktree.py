@@ -0,0 +1,336 @@
+import collections
+import heapq
+import itertools
+import logging
+import os
+import re
+
+from dsmc.lib.bundle import MAX_BUNDLE_BYTES, split_into_bundles, verify_bundles, write_bundles
+from dsmc.lib.inventory import walk
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+log = logging.getLogger(__name__)
+
+# What went into a link tree
+LinkTreeStats = collections.namedtuple("LinkTreeStats", ["files", "bytes", "dirs", "excluded", "bundled_files",
+                                                         "bundled_bytes", "bundles"])
+
+# Upper limits of the size classes of `plan_link_tree`, the last class has no limit
+SIZE_CLASSES = [(1024, "< 1 KiB"), (1024 ** 2, "< 1 MiB"), (100 * 1024 ** 2, "< 100 MiB"),
+                (1024 ** 3, "< 1 GiB"), (10 * 1024 ** 3, "< 10 GiB"), (None, ">= 10 GiB")]
+
+
+def _glob_to_regex(pattern):
+    """
+    Translate a glob to a regex matching paths relative to the runfolder. Unlike
+    `fnmatch`, `*` and `?` don't match across directories, while `**` does.
+    """
+    regex = []
+    i = 0
+
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            regex.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            regex.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            regex.append("[{}]".format(chars.replace("\\", "\\\\")))
+            i = end + 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+
+    return "".join(regex)
+
+
+class ExcludePatterns(object):
+    """
+    Decides what to leave out of a link tree. Patterns are sorted into the
+    cheapest lookup that can answer them, so that most entries are decided
+    by a few set lookups:
+
+        Thumbnail_Images/**       a directory with that name, anywhere
+        Logs/                     the same
+        core                      a file or directory with that name, anywhere
+        *.cif                     names with that suffix, anywhere
+        Data/Intensities/L001     that path relative to the runfolder, kept in a trie
+        Data/*/L00?/C*.1          other globs, `**` matches across directories
+        re:.*_tmp$                a regex, matched against the relative path
+
+    Globs and regexes are compiled into one regex for files and one for directories.
+    """
+
+    # Marks the end of a path in the trie
+    END = None
+
+    GLOB_CHARS = re.compile(r"[*?\[]")
+
+    def __init__(self, patterns=(), exclude_dirs=(), exclude_extensions=()):
+        """
+        :param patterns: list of glob or regex patterns, see above
+        :param exclude_dirs: names of directories to leave out
+        :param exclude_extensions: file extensions to leave out, e.g. ".txt"
+        """
+        self.names = {"file": set(), "dir": set(exclude_dirs)}
+        self.suffixes = {"file": set(exclude_extensions), "dir": set()}
+        self.tries = {"file": {}, "dir": {}}
+        regexes = {"file": [], "dir": []}
+
+        for pattern in patterns:
+            if pattern.startswith("re:"):
+                for kind in regexes:
+                    regexes[kind].append(pattern[3:])
+                continue
+
+            kinds = ("file", "dir")
+
+            for dir_suffix in ("/**", "/"):
+                if pattern.endswith(dir_suffix) and len(pattern) > len(dir_suffix):
+                    pattern = pattern[:-len(dir_suffix)]
+                    kinds = ("dir",)
+                    break
+
+            pattern = pattern.lstrip("/")
+
+            if pattern.startswith("*.") and not ExcludePatterns.GLOB_CHARS.search(pattern[1:]):
+                lookup = self.suffixes
+                key = pattern[1:]
+            elif not ExcludePatterns.GLOB_CHARS.search(pattern):
+                if "/" in pattern:
+                    for kind in kinds:
+                        self._add_to_trie(self.tries[kind], pattern.split("/"))
+                    continue
+                lookup = self.names
+                key = pattern
+            else:
+                if "/" not in pattern:
+                    # Like a name, a glob without a directory matches anywhere
+                    pattern = "**/" + pattern
+                for kind in kinds:
+                    regexes[kind].append(_glob_to_regex(pattern))
+                continue
+
+            for kind in kinds:
+                lookup[kind].add(key)
+
+        self.regexes = dict((kind, re.compile("(?:{})\\Z".format(")\\Z|(?:".join(kind_regexes))))
+                            for kind, kind_regexes in regexes.iteritems() if kind_regexes)
+
+    @staticmethod
+    def _add_to_trie(trie, parts):
+        node = trie
+        for part in parts:
+            node = node.setdefault(part, {})
+        node[ExcludePatterns.END] = True
+
+    def root(self):
+        """
+        :return: the position of the runfolder itself in the tries, to pass to `excludes`
+        """
+        return self.tries["file"], self.tries["dir"]
+
+    def excludes(self, name, rel_path, is_dir, nodes):
+        """
+        :param name: of the file or directory
+        :param rel_path: of the file or directory, relative to the runfolder
+        :param is_dir: True for a directory
+        :param nodes: the position of the parent directory in the tries
+        :return: tuple of True if the entry is excluded, and the position of the entry in
+                 the tries, to pass along for the content of a directory
+        """
+        kind = "dir" if is_dir else "file"
+        file_node = nodes[0].get(name) if nodes[0] else None
+        dir_node = nodes[1].get(name) if nodes[1] else None
+
+        node = dir_node if is_dir else file_node
+        if node and node.get(ExcludePatterns.END):
+            return True, None
+
+        if name in self.names[kind]:
+            return True, None
+
+        suffixes = self.suffixes[kind]
+        if suffixes:
+            dot = name.find(".", 1)
+            while dot != -1:
+                if name[dot:] in suffixes:
+                    return True, None
+                dot = name.find(".", dot + 1)
+
+        regex = self.regexes.get(kind)
+        if regex and regex.match(rel_path):
+            return True, None
+
+        return False, (file_node, dir_node)
+
+
+def _link_tree(src, dest, excludes, workers, bundle_below=None):
+    """
+    See `create_link_tree`, nothing is written if `dest` is None
+    :return: tuple of dict of path and size of the files to link, list of (relative
+             path, size) of the files to bundle, the number of directories and the
+             number of excluded entries
+    """
+    excludes = excludes or ExcludePatterns()
+    errors = []
+    dirs = []
+    excluded = []
+    # Appending to a list is thread safe
+    small = []
+
+    def visit(path, context):
+        dest_dir, rel_dir, nodes, ancestors = context
+        files = []
+        subdirs = []
+
+        try:
+            for entry in scandir(path):
+                rel_path = rel_dir + entry.name
+                # `DirEntry` follows links, and only stats if the type isn't known
+                is_dir = entry.is_dir()
+
+                if not is_dir and not entry.is_file():
+                    log.debug("Skipping {} because it is neither a file nor a directory".format(entry.path))
+                    excluded.append(entry.path)
+                    continue
+
+                is_excluded, entry_nodes = excludes.excludes(entry.name, rel_path, is_dir, nodes)
+
+                if is_excluded:
+                    log.debug("Skipping {} because it is excluded".format(entry.path))
+                    excluded.append(entry.path)
+                    continue
+
+                new_path = os.path.join(dest_dir, entry.name) if dest else None
+
+                if is_dir:
+                    entry_ancestors = ancestors
+                    if entry.is_symlink():
+                        stat = entry.stat()
+                        if (stat.st_dev, stat.st_ino) in ancestors:
+                            log.info("Not following {}, as it links to one of its parents".format(entry.path))
+                            continue
+                        entry_ancestors = ancestors | frozenset([(stat.st_dev, stat.st_ino)])
+
+                    if dest:
+                        os.mkdir(new_path)
+                    dirs.append(new_path)
+                    subdirs.append((entry.path, (new_path, rel_path + "/", entry_nodes, entry_ancestors)))
+                else:
+                    size = entry.stat().st_size
+
+                    if bundle_below and size < bundle_below:
+                        small.append((rel_path, size))
+                        continue
+
+                    if dest:
+                        os.symlink(entry.path, new_path)
+                    files.append((entry.path, size))
+        except OSError, msg:
+            errors.append(str(msg))
+            raise
+
+        return files, subdirs
+
+    stat = os.stat(src)
+    linked = walk(src, visit, (dest, "", excludes.root(), frozenset([(stat.st_dev, stat.st_ino)])), workers)
+
+    if errors:
+        raise OSError("Could not list the link tree of {}: {}".format(src, "; ".join(errors)))
+
+    return linked, small, len(dirs), len(excluded)
+
+
+def create_link_tree(src, dest, excludes=None, workers=1, bundle_below=None, max_bundle_bytes=MAX_BUNDLE_BYTES):
+    """
+    Mirror the directories below `src` in `dest`, and link every file in them
+    to the file in `src`. Linked directories, e.g. `Unaligned`, are followed.
+    Excluded directories are left out before anything below them is listed.
+
+    Files smaller than `bundle_below` bytes aren't linked, but written into tar
+    bundles in `dest` instead, see `dsmc.lib.bundle`. The bundles are read back
+    and checked against their index before the tree is handed over for upload.
+
+    :param src: the runfolder
+    :param dest: an existing, empty directory to build the tree in
+    :param excludes: an `ExcludePatterns`
+    :param workers: number of threads to list directories, and write bundles, with
+    :param bundle_below: bundle the files smaller than this many bytes, None to link all files
+    :param max_bundle_bytes: the size at which a bundle is closed
+    :return: `LinkTreeStats` of the files linked, their size, the directories
+             created, the entries excluded, the files bundled, their size and
+             the number of bundles
+    :raises OSError, IOError: if the tree couldn't be built completely
+    """
+    linked, small, nbr_of_dirs, nbr_of_excluded = _link_tree(src, dest, excludes, workers, bundle_below)
+
+    bundles = write_bundles(src, dest, small, max_bundle_bytes, workers) if small else []
+
+    if bundles:
+        errors = verify_bundles(dest)
+
+        if errors:
+            raise IOError("{} bundled files in {} don't match their index, e.g. {}: {}".format(
+                len(errors), dest, *errors[0]))
+
+    stats = LinkTreeStats(len(linked), sum(linked.itervalues()), nbr_of_dirs, nbr_of_excluded,
+                          len(small), sum(size for _, size in small), len(bundles))
+    log.debug("Linked {} files ({} bytes) in {} directories from {} to {}, excluded {} entries".format(
+        stats.files, stats.bytes, stats.dirs, src, dest, stats.excluded))
+
+    return stats
+
+
+def plan_link_tree(src, excludes=None, workers=1, largest=10, bundle_below=None, max_bundle_bytes=MAX_BUNDLE_BYTES):
+    """
+    Tell what `create_link_tree` would link, without writing anything
+    :param src: the runfolder
+    :param excludes: an `ExcludePatterns`
+    :param workers: number of threads to list directories with
+    :param largest: the number of the largest files to list
+    :param bundle_below: see `create_link_tree`
+    :param max_bundle_bytes: see `create_link_tree`
+    :return: dict of the number of files to link, their total size, the number of directories,
+             the number of excluded entries, the number of files to bundle, their total size,
+             the number of bundles, a histogram of all files by size, and the largest files
+             with their size, relative to `src`
+    :raises OSError: if the runfolder couldn't be listed completely
+    """
+    linked, small, nbr_of_dirs, nbr_of_excluded = _link_tree(src, None, excludes, workers, bundle_below)
+
+    histogram = [{"size": label, "files": 0, "bytes": 0} for _, label in SIZE_CLASSES]
+
+    for size in itertools.chain(linked.itervalues(), (size for _, size in small)):
+        for size_class, (limit, _) in zip(histogram, SIZE_CLASSES):
+            if limit is None or size < limit:
+                size_class["files"] += 1
+                size_class["bytes"] += size
+                break
+
+    largest_files = heapq.nlargest(largest, linked.iteritems(), key=lambda item: item[1])
+
+    return {"files": len(linked),
+            "bytes": sum(linked.itervalues()),
+            "dirs": nbr_of_dirs,
+            "excluded": nbr_of_excluded,
+            "bundled_files": len(small),
+            "bundled_bytes": sum(size for _, size in small),
+            "bundles": len(split_into_bundles(small, max_bundle_bytes)),
+            "size_histogram": histogram,
+            "largest_files": [{"path": os.path.relpath(path, src), "bytes": size} for path, size in largest_files]}
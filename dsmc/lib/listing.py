@@ -0,0 +1,177 @@
+"""
+Listings of the files of an archive, local or uploaded to PDC, and the
+comparison of two of them. With millions of files, a dict of absolute paths
+and sizes as strings spends most of its memory on the same prefix over and
+over, so a `FileListing` keeps the paths relative to the archive, interned
+so that the local and the uploaded listing share them, and the sizes as ints.
+"""
+
+import collections
+import logging
+
+log = logging.getLogger(__name__)
+
+# The relative paths, in order, of the files missing in PDC, the files whose
+# size in PDC differs from the local one, and the objects only found in PDC
+ListingDiff = collections.namedtuple("ListingDiff", ["missing", "size_mismatch", "remote_only"])
+
+
+def _intern(path):
+    # Only byte strings can be interned
+    return intern(path) if type(path) is str else path
+
+
+class FileListing(object):
+    """
+    The sizes of the files of an archive, by their path relative to the archive.
+    It works like a read only dict of relative path and size.
+    """
+
+    def __init__(self, root, sizes=None):
+        """
+        :param root: the path to the archive, as the absolute paths added start with it
+        :param sizes: dict of relative path and size to start with
+        """
+        self.root = root.rstrip("/") if root != "/" else root
+        self.prefix = self.root + "/" if self.root and self.root != "/" else self.root
+        self.sizes = sizes if sizes is not None else {}
+
+    @staticmethod
+    def from_inventory(root, inventory):
+        """
+        :param root: the path to the archive
+        :param inventory: dict of path and `dsmc.lib.inventory.LocalFile`, see `dsmc.lib.inventory.scan_tree`
+        :return: a `FileListing` of the files in the inventory
+        """
+        listing = FileListing(root)
+
+        for path, local_file in inventory.iteritems():
+            listing.add(path, local_file.size)
+
+        return listing
+
+    def relative(self, path):
+        """
+        :param path: an absolute path
+        :return: the path relative to the archive, "" for the archive itself, or None if
+                 the path isn't in the archive
+        """
+        if path == self.root:
+            return ""
+        if path.startswith(self.prefix):
+            return path[len(self.prefix):]
+        return None
+
+    def absolute(self, rel_path):
+        """
+        :param rel_path: a path relative to the archive
+        :return: the path the archive was listed with
+        """
+        return self.prefix + rel_path if rel_path else self.root
+
+    def add(self, path, size):
+        """
+        Add a file by its absolute path. The archive itself, and paths outside it,
+        e.g. of a sibling whose name starts with the name of the archive, are left out.
+        :param path: of the file
+        :param size: of the file, in bytes
+        :return: True if the file was added
+        """
+        rel_path = self.relative(path)
+
+        if not rel_path:
+            return False
+
+        self.sizes[_intern(rel_path)] = size
+        return True
+
+    def absolute_items(self):
+        """
+        :return: generator of absolute path and size of every file
+        """
+        for rel_path, size in self.sizes.iteritems():
+            yield self.absolute(rel_path), size
+
+    def total_bytes(self, rel_paths=None):
+        """
+        :param rel_paths: relative paths of files in the listing, all files if None
+        :return: the total size of the files
+        """
+        if rel_paths is None:
+            return sum(self.sizes.itervalues())
+        return sum(self.sizes[rel_path] for rel_path in rel_paths)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __contains__(self, rel_path):
+        return rel_path in self.sizes
+
+    def __getitem__(self, rel_path):
+        return self.sizes[rel_path]
+
+    def __iter__(self):
+        return iter(self.sizes)
+
+    def iteritems(self):
+        return self.sizes.iteritems()
+
+    def get(self, rel_path, default=None):
+        return self.sizes.get(rel_path, default)
+
+
+def parent_dirs(rel_paths):
+    """
+    :param rel_paths: relative paths, e.g. of the objects uploaded to PDC
+    :return: set of the directories that have anything in them, "" for the archive itself
+    """
+    return set(rel_path.rpartition("/")[0] for rel_path in rel_paths)
+
+
+def as_listing(files):
+    """
+    :param files: a `FileListing`, or a dict of path and size (also as a string)
+    :return: a `FileListing` of the files, a dict is taken as relative to ""
+    """
+    if isinstance(files, FileListing):
+        return files
+    return FileListing("", dict((path, int(size)) for path, size in files.iteritems()))
+
+
+def diff_listings(local, remote):
+    """
+    Compare the local files of an archive with the files uploaded to PDC, in one
+    pass over the local listing. Local files are the truth, so files only found
+    in PDC are reported, but never reuploaded. dsmc also lists the directories,
+    so the ones with anything in them aren't reported as only found in PDC.
+    :param local: `FileListing` of the local files
+    :param remote: `FileListing` of the uploaded files
+    :return: a `ListingDiff` of relative paths
+    """
+    local_sizes = local.sizes
+    remote_sizes = remote.sizes
+    remote_size = remote_sizes.get
+    missing = []
+    size_mismatch = []
+
+    for rel_path, size in local_sizes.iteritems():
+        uploaded_size = remote_size(rel_path)
+
+        if uploaded_size is None:
+            missing.append(rel_path)
+        elif uploaded_size != size:
+            size_mismatch.append(rel_path)
+
+    remote_only = remote_sizes.viewkeys() - local_sizes.viewkeys()
+
+    if remote_only:
+        remote_only -= parent_dirs(remote_sizes)
+
+    missing.sort()
+    size_mismatch.sort()
+
+    log.info("Compared {} local files with {} objects in PDC: {} missing, {} differing in size, "
+             "{} only in PDC".format(len(local_sizes), len(remote_sizes), len(missing), len(size_mismatch),
+                                     len(remote_only)))
+
+    return ListingDiff(missing, size_mismatch, sorted(remote_only))
@@ -0,0 +1,170 @@
+import collections
+import gzip
+import logging
+import os
+
+from dsmc.lib.inventory import LocalFile, list_dir, scan_tree, walk
+
+log = logging.getLogger(__name__)
+
+
+class Manifest(object):
+    """
+    A compact record of a local archive as it looked when it was successfully
+    uploaded: the mtime of every directory, and the size, mtime, inode and
+    device of every file. Paths are stored relative to the archive.
+
+    It lets a later reupload check only list the directories whose mtime has
+    changed since, and compare just the files in them. Note that a file that
+    is changed in place doesn't change the mtime of its directory, so ask for
+    a full scan if files may have been rewritten rather than added, removed or
+    replaced.
+    """
+
+    HEADER = "# arteria-dsmc manifest 2"
+
+    def __init__(self, root, description, dirs, files):
+        """
+        :param root: path to the archive
+        :param description: the dsmc description the archive was uploaded with
+        :param dirs: dict of relative directory path and mtime, the archive itself is ""
+        :param files: dict of relative file path and `dsmc.lib.inventory.LocalFile`
+        """
+        self.root = root
+        self.description = description
+        self.dirs = dirs
+        self.files = files
+
+    @staticmethod
+    def path_for(manifest_dir, archive):
+        """
+        :return: where the manifest of an archive is kept
+        """
+        return os.path.join(manifest_dir, "{}.manifest.gz".format(os.path.basename(os.path.normpath(archive))))
+
+    @staticmethod
+    def pending_path_for(manifest_dir, job_id):
+        """
+        :return: where the manifest of an archive is kept while the job uploading it is running
+        """
+        return os.path.join(manifest_dir, "pending", "{}.manifest.gz".format(job_id))
+
+    @staticmethod
+    def _relative(root, path):
+        # Paths from the inventory are joined onto the root, so slicing is
+        # enough and much cheaper than `os.path.relpath`.
+        return path[len(root) + 1:] if path != root else ""
+
+    @staticmethod
+    def from_scan(root, description, inventory, dirs):
+        """
+        Create a manifest from a `dsmc.lib.inventory.scan_tree` of the archive
+        :param inventory: the files returned by `scan_tree`
+        :param dirs: the directory mtimes filled in by `scan_tree`
+        """
+        return Manifest(root, description,
+                        dict((Manifest._relative(root, path), mtime) for path, mtime in dirs.iteritems()),
+                        dict((Manifest._relative(root, path), local_file) for path, local_file in inventory.iteritems()))
+
+    @staticmethod
+    def create(root, description, workers=1):
+        """
+        Scan the archive and create a manifest of it
+        :return: tuple of the manifest and the inventory of the archive
+        """
+        dirs = {}
+        inventory = scan_tree(root, workers, dirs=dirs)
+        return Manifest.from_scan(root, description, inventory, dirs), inventory
+
+    def write(self, path):
+        tmp_path = "{}.tmp".format(path)
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+
+        with gzip.open(tmp_path, "wb") as f:
+            f.write("{}\t{}\t{}\n".format(Manifest.HEADER, self.root, self.description))
+
+            for rel_path, mtime in self.dirs.iteritems():
+                f.write("D\t{}\t{!r}\n".format(rel_path, mtime))
+
+            for rel_path, local_file in self.files.iteritems():
+                f.write("F\t{}\t{}\t{!r}\t{}\t{}\n".format(rel_path, local_file.size, local_file.mtime,
+                                                         local_file.inode, local_file.dev))
+
+        # Never leave a half written manifest behind
+        os.rename(tmp_path, path)
+
+        log.debug("Wrote manifest of {} with {} files to {}".format(self.root, len(self.files), path))
+
+    @staticmethod
+    def read(path):
+        dirs = {}
+        files = {}
+
+        with gzip.open(path, "rb") as f:
+            header, root, description = f.readline().rstrip("\n").split("\t")
+
+            if header != Manifest.HEADER:
+                raise ValueError("{} is not a manifest, or of an older format".format(path))
+
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+
+                if fields[0] == "D":
+                    dirs[fields[1]] = float(fields[2])
+                else:
+                    files[fields[1]] = LocalFile(int(fields[2]), float(fields[3]), int(fields[4]), int(fields[5]))
+
+        return Manifest(root, description, dirs, files)
+
+    def incremental_scan(self, workers=1):
+        """
+        List the archive again, but only list the directories whose mtime differs
+        from the manifest. The content of the other directories is taken from the
+        manifest, which costs one stat per directory instead of one per file.
+
+        :param workers: number of threads to stat and list directories with
+        :return: tuple of the inventory of the archive (like `scan_tree`), and the
+                 set of paths of the files that are new or differ from the manifest
+        """
+        dir_files = collections.defaultdict(list)
+        dir_subdirs = collections.defaultdict(list)
+
+        for rel_path, local_file in self.files.iteritems():
+            dir_files[os.path.dirname(rel_path)].append((os.path.basename(rel_path), local_file))
+
+        for rel_path in self.dirs:
+            if rel_path:
+                dir_subdirs[os.path.dirname(rel_path)].append(os.path.basename(rel_path))
+
+        # Appending to a list is thread safe
+        changed = []
+        rescanned_dirs = []
+
+        def visit(path, rel_path):
+            mtime = os.stat(path).st_mtime
+
+            if self.dirs.get(rel_path) == mtime:
+                files = [(os.path.join(path, name), local_file) for name, local_file in dir_files[rel_path]]
+                subdirs = [(os.path.join(path, name), os.path.join(rel_path, name)) for name in dir_subdirs[rel_path]]
+                return files, subdirs
+
+            rescanned_dirs.append(path)
+            files, subdirs = list_dir(path)
+
+            for file_path, local_file in files:
+                if self.files.get(Manifest._relative(self.root, file_path)) != local_file:
+                    changed.append(file_path)
+
+            return files, [(subdir, Manifest._relative(self.root, subdir)) for subdir, _ in subdirs]
+
+        inventory = walk(self.root, visit, "", workers)
+
+        log.debug("Incremental scan of {} listed {} changed directories and found {} changed files".format(
+            self.root, len(rescanned_dirs), len(changed)))
+
+        return inventory, set(changed)
@@ -0,0 +1,243 @@
+"""
+Counters and histograms of what the service spends its time on, exposed in
+the Prometheus text format, see `Registry.expose`. E.g.
+
+    with HANDLER_STAGE_SECONDS.labels("reupload", "pdc_query").time():
+        ...
+
+Recording a value takes a dict lookup and a lock, so it can be done in the
+hot paths. The children of a metric, one per combination of label values,
+are created when they are first used.
+"""
+
+import bisect
+import threading
+import time
+
+# Upper limits of the buckets of histograms of seconds, from handler stages
+# of milliseconds to uploads of a day
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600,
+                   7200, 14400, 43200, 86400)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{{{}}}".format(",".join('{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)))
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Timer(object):
+    """
+    Observes the seconds spent in a with block
+    """
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.child.observe(time.time() - self.start)
+
+
+class _NotTimed(object):
+    """
+    Stands in for a timer where nothing is to be recorded
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NOT_TIMED = _NotTimed()
+
+
+class _CounterChild(object):
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class _HistogramChild(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """
+        :return: a context manager that observes the seconds spent in it
+        """
+        return _Timer(self)
+
+
+class _Metric(object):
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def labels(self, *values):
+        """
+        :param values: the values of the labels, in the order of `labelnames`
+        :return: the child of the metric with those label values
+        """
+        try:
+            return self.children[values]
+        except KeyError:
+            if len(values) != len(self.labelnames):
+                raise ValueError("{} takes the labels {}, not {}".format(self.name, self.labelnames, values))
+
+            with self.lock:
+                return self.children.setdefault(values, self._new_child())
+
+    def _samples(self):
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def expose(self):
+        """
+        :return: the lines of the metric in the Prometheus text format
+        """
+        lines = ["# HELP {} {}".format(self.name, self.documentation.replace("\\", "\\\\").replace("\n", "\\n")),
+                 "# TYPE {} {}".format(self.name, self.TYPE)]
+
+        for suffix, names, values, value in self._samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, _format_labels(names, values), _format_value(value)))
+
+        return lines
+
+
+class Counter(_Metric):
+    """
+    A count that only goes up, e.g. of bytes archived
+    """
+
+    TYPE = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        """
+        Count a metric without labels
+        """
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in sorted(self.children.items()):
+            yield "", self.labelnames, values, child.value
+
+
+class Histogram(_Metric):
+    """
+    Counts of observations, e.g. of seconds, by the buckets they fall in
+    """
+
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        """
+        Observe a value of a metric without labels
+        """
+        self.labels().observe(value)
+
+    def _samples(self):
+        names = self.labelnames + ("le",)
+
+        for values, child in sorted(self.children.items()):
+            with child.lock:
+                counts = list(child.counts)
+                total = child.sum
+
+            cumulative = 0
+            for limit, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", names, values + (_format_value(limit),), cumulative
+
+            yield "_sum", self.labelnames, values, total
+            yield "_count", self.labelnames, values, cumulative
+
+
+class Registry(object):
+    """
+    The metrics of the service
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            # Modules may be reloaded, e.g. by tests, so the first one registered is kept
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        :return: the `Counter` of that name, created if it doesn't exist
+        """
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        :return: the `Histogram` of that name, created if it doesn't exist
+        """
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def expose(self):
+        """
+        :return: all metrics in the Prometheus text format
+        """
+        lines = []
+
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].expose())
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
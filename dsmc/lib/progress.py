@@ -0,0 +1,187 @@
+import collections
+import logging
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class DsmcProgress(object):
+    """
+    Follows the dsmc logs of a running job, to tell how far it has come. Every
+    update only reads what has been written to the logs since the last one.
+
+    dsmc logs a line like
+
+        Normal File-->        40,960 /path/to/runfolder/file.fastq.gz [Sent]
+
+    for every file it has sent, and ends with summary statistics like
+
+        Total number of objects archived:        12
+        Total number of bytes transferred:   1.23 GB
+        Elapsed processing time:            00:00:05
+    """
+
+    # The size has thousand separators that depend on the locale, "40,960" or "40 960"
+    SENT_FILE = re.compile(r"Normal File-->\s+(\d{1,3}(?:[, ]\d{3})*)\s+/.*\s+\[Sent\]")
+
+    SUMMARY_LINE = re.compile(r"^(Total number of [\w ]+|Data transfer time|Network data transfer rate|"
+                              r"Aggregate data transfer rate|Objects compressed by|Total data reduction ratio|"
+                              r"Elapsed processing time):\s+(.+?)\s*$")
+
+    # The current throughput is measured over this many seconds
+    THROUGHPUT_WINDOW = 60
+
+    def __init__(self, log_files, total_bytes=None, clock=time.time):
+        """
+        :param log_files: the dsmc logs of the job, several if it runs in parallel sessions
+        :param total_bytes: the number of bytes the job is expected to transfer, if known. It
+                            can also be set later on, e.g. when the runfolder has been measured.
+        :param clock: returns the current time in seconds
+        """
+        self.log_files = list(log_files)
+        self.total_bytes = total_bytes
+        self.clock = clock
+
+        self.offsets = dict((log_file, 0) for log_file in self.log_files)
+        self.partial_lines = dict((log_file, "") for log_file in self.log_files)
+        self.summaries = dict((log_file, collections.OrderedDict()) for log_file in self.log_files)
+
+        self.files_done = 0
+        self.bytes_transferred = 0
+
+        # Samples of (time, bytes transferred), to calculate the throughput from
+        self.samples = collections.deque([(clock(), 0)])
+
+        # The progress as it was when the job finished, see `finish`
+        self.final = None
+
+        # Status requests may update the progress from several threads
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def sent_bytes(line):
+        """
+        :param line: of a dsmc log
+        :return: the number of bytes of the file, if the line tells that dsmc has sent a file, otherwise None
+        """
+        if "[Sent]" not in line:
+            return None
+
+        match = DsmcProgress.SENT_FILE.search(line)
+
+        if not match:
+            return None
+
+        return int(match.group(1).replace(",", "").replace(" ", ""))
+
+    @staticmethod
+    def _to_key(name):
+        return name.lower().replace(" ", "_")
+
+    def _parse(self, log_file, line):
+        sent_bytes = DsmcProgress.sent_bytes(line)
+
+        if sent_bytes is not None:
+            self.files_done += 1
+            self.bytes_transferred += sent_bytes
+            return
+
+        match = DsmcProgress.SUMMARY_LINE.match(line)
+
+        if match:
+            self.summaries[log_file][DsmcProgress._to_key(match.group(1))] = match.group(2)
+
+    def _read_new_lines(self, log_file, final=False):
+        try:
+            with open(log_file, "rb") as f:
+                f.seek(self.offsets[log_file])
+                data = f.read()
+                self.offsets[log_file] = f.tell()
+        except IOError, msg:
+            # The job may not have started yet
+            log.debug("Could not read {}: {}".format(log_file, msg))
+            return []
+
+        # Keep a line that is still being written until the rest of it shows up,
+        # unless the job has finished and the line won't get any longer
+        lines = (self.partial_lines[log_file] + data).split("\n")
+        self.partial_lines[log_file] = "" if final else lines.pop()
+
+        return lines
+
+    def update(self, final=False):
+        """
+        Read what has been written to the logs since the last update
+        :param final: the job has finished, so the logs won't grow any more
+        """
+        with self.lock:
+            if self.final is not None:
+                return
+
+            for log_file in self.log_files:
+                for line in self._read_new_lines(log_file, final):
+                    self._parse(log_file, line)
+
+            now = self.clock()
+            self.samples.append((now, self.bytes_transferred))
+
+            # Keep one sample from before the window, to measure the whole window
+            while len(self.samples) > 2 and self.samples[1][0] <= now - DsmcProgress.THROUGHPUT_WINDOW:
+                self.samples.popleft()
+
+    def throughput(self):
+        """
+        :return: the number of bytes per second transferred recently
+        """
+        first_time, first_bytes = self.samples[0]
+        last_time, last_bytes = self.samples[-1]
+
+        if last_time <= first_time:
+            return 0.0
+
+        return (last_bytes - first_bytes) / float(last_time - first_time)
+
+    def eta(self):
+        """
+        :return: the estimated number of seconds until the job is done, or None if
+                 it can't be estimated
+        """
+        throughput = self.throughput()
+
+        if self.total_bytes is None or not throughput:
+            return None
+
+        return max(0, self.total_bytes - self.bytes_transferred) / throughput
+
+    def finish(self):
+        """
+        Read the rest of the logs of a job that has finished, and freeze its progress,
+        so that the same progress is served from now on
+        """
+        self.update(final=True)
+        progress = self.as_dict()
+
+        with self.lock:
+            if self.final is None:
+                self.final = progress
+
+    def as_dict(self):
+        with self.lock:
+            if self.final is not None:
+                return dict(self.final)
+
+            progress = {
+                "files_done": self.files_done,
+                "bytes_transferred": self.bytes_transferred,
+                "total_bytes": self.total_bytes,
+                "throughput_bytes_per_second": self.throughput(),
+                "eta_seconds": self.eta()}
+
+            summaries = [self.summaries[log_file] for log_file in self.log_files if self.summaries[log_file]]
+
+            if summaries:
+                progress["summary"] = summaries
+
+            return progress
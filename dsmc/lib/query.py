@@ -0,0 +1,165 @@
+import collections
+import datetime
+import logging
+import re
+import subprocess
+
+from arteria.exceptions import ArteriaUsageException
+
+log = logging.getLogger(__name__)
+
+# One archived object as reported by `dsmc q ar`, e.g.
+#
+#         4 096  B  2017-07-27 17.48.34    /data/mm-xart002/runfolders/foo_archive/Config Never e374bd6b-ab36-4f41-94d3-f4eaea9f30d4
+#
+# `size` is in bytes and `archived_at` is a datetime.
+ArchivedFile = collections.namedtuple("ArchivedFile", ["size", "archived_at", "path", "expires", "description"])
+
+# The size is printed with thousand separators that depend on the OS locale,
+# i.e. "4,096" or "4 096". The date can either be "2017-07-27 17.48.34" or
+# "01/10/2017 16:47:24". The expiry is either "Never" or a date.
+DSMC_QUERY_LINE = re.compile(r"""
+    ^\s*(?P<size>\d+(?:[, ]\d{3})*)\s+B\s+
+    (?P<date>\d{4}-\d{2}-\d{2}|\d{2}/\d{2}/\d{4})\s+
+    (?P<time>\d{2}[.:]\d{2}[.:]\d{2})\s+
+    (?P<path>/.*?)\s+
+    (?P<expires>Never|\d{4}-\d{2}-\d{2}|\d{2}/\d{2}/\d{4})
+    (?:\s+(?P<description>.*?))?\s*$
+    """, re.VERBOSE)
+
+# Anything that starts like an archived object, i.e. with a size in bytes, so
+# that object lines that `DSMC_QUERY_LINE` can't parse aren't silently dropped
+DSMC_OBJECT_LINE = re.compile(r"^\s*\d+(?:[, ]\d{3})*\s+B\s")
+
+DSMC_MESSAGE = re.compile(r"ANS[0-9]+[EWIS]")
+
+# The date and time formats depend on the locale of dsmc unless they are set
+# on the command line, so the queries ask for "2017-07-27" and "17:48:34"
+DSMC_QUERY_OPTIONS = "-dateformat=3 -timeformat=1"
+
+
+class DsmcQueryError(ArteriaUsageException):
+    """
+    Raised when a dsmc query did not complete successfully.
+
+    :param cmd: the dsmc command that was run
+    :param returncode: the return code of dsmc
+    :param errors: list of the ANS error lines found in the output
+    """
+
+    def __init__(self, cmd, returncode, errors):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.errors = errors
+        super(DsmcQueryError, self).__init__(
+            "'{}' failed with return code {}: {}".format(cmd, returncode, "; ".join(errors)))
+
+
+def parse_timestamp(date, time):
+    """
+    Convert the date and time columns of the dsmc output to a datetime
+    :param date: e.g. "2017-07-27" or "07/27/2017"
+    :param time: e.g. "17.48.34" or "17:48:34"
+    :return: the corresponding datetime, or None if it isn't a valid date, e.g. "27/07/2017"
+    """
+    time = time.replace(".", ":")
+    date_format = "%m/%d/%Y" if "/" in date else "%Y-%m-%d"
+
+    try:
+        return datetime.datetime.strptime("{} {}".format(date, time), "{} %H:%M:%S".format(date_format))
+    except ValueError:
+        return None
+
+
+def parse_line(line):
+    """
+    Parse one line of `dsmc q ar` output
+    :param line: to parse
+    :return: an `ArchivedFile`, or None if the line doesn't describe an archived object
+    """
+    match = DSMC_QUERY_LINE.match(line)
+
+    if not match:
+        return None
+
+    size = int(match.group("size").replace(",", "").replace(" ", ""))
+    archived_at = parse_timestamp(match.group("date"), match.group("time"))
+
+    if not archived_at:
+        return None
+
+    return ArchivedFile(size, archived_at, match.group("path"), match.group("expires"), match.group("description"))
+
+
+class DsmcQuery(object):
+    """
+    Runs a `dsmc q ar` command and parses its output line by line as dsmc
+    prints it, without keeping the whole output in memory.
+
+    Iterate over the object to get the archived objects as `ArchivedFile`. When
+    dsmc has finished, `DsmcQueryError` is raised if dsmc returned an
+    unexpected return code or printed any error messages. The warnings
+    encountered are available in `warnings` afterwards.
+
+    dsmc returns 8 together with ANS1092W when nothing matched the query,
+    so 8 is accepted as long as no errors were printed. Lines that look like
+    archived objects but can't be parsed, e.g. in an unexpected date format,
+    are errors too, rather than objects missing from the result.
+    """
+
+    ACCEPTED_RETURN_CODES = (0, 8)
+
+    def __init__(self, cmd, path_prefix=None):
+        """
+        :param cmd: the dsmc command to run, `DSMC_QUERY_OPTIONS` are added to it
+        :param path_prefix: only yield objects whose path starts with this
+        """
+        self.cmd = "{} {}".format(cmd, DSMC_QUERY_OPTIONS)
+        self.path_prefix = path_prefix
+        self.warnings = []
+        self.errors = []
+        # The number of lines that look like archived objects but couldn't be parsed, and the first of them
+        self.unparsed = 0
+        self.first_unparsed = None
+        self.returncode = None
+
+    def _lines(self):
+        p = subprocess.Popen(self.cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        try:
+            # Don't iterate over the file directly, as that reads ahead in large
+            # blocks and delays the parsing until dsmc has printed a lot of output.
+            for line in iter(p.stdout.readline, b""):
+                yield line
+        finally:
+            p.stdout.close()
+            self.returncode = p.wait()
+
+    def __iter__(self):
+        for line in self._lines():
+            archived = parse_line(line)
+
+            if archived:
+                if not self.path_prefix or archived.path.startswith(self.path_prefix):
+                    yield archived
+            elif DSMC_OBJECT_LINE.match(line):
+                self.unparsed += 1
+                self.first_unparsed = self.first_unparsed or line.strip()
+            else:
+                severities = set(message[-1] for message in DSMC_MESSAGE.findall(line))
+
+                if "E" in severities or "S" in severities:
+                    self.errors.append(line.strip())
+                elif "W" in severities:
+                    self.warnings.append(line.strip())
+
+        if self.unparsed:
+            self.errors.append("{} archived objects could not be parsed, e.g. '{}'".format(
+                self.unparsed, self.first_unparsed))
+
+        if self.returncode not in DsmcQuery.ACCEPTED_RETURN_CODES or self.errors:
+            log.info("dsmc query '{}' failed with return code {}".format(self.cmd, self.returncode))
+            raise DsmcQueryError(self.cmd, self.returncode, self.errors)
+
+        if self.warnings:
+            log.debug("dsmc query '{}' gave the warnings: {}".format(self.cmd, self.warnings))
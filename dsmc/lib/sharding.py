@@ -0,0 +1,107 @@
+import heapq
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def balance_by_bytes(files, nbr_of_shards):
+    """
+    Split files into shards of about the same number of bytes, by handing out
+    the largest files first, each to the shard with the fewest bytes so far,
+    and of those to the one with the fewest files, so that empty files are
+    spread out as well.
+
+    :param files: iterable of (path, size) tuples
+    :param nbr_of_shards: the maximum number of shards to split into
+    :return: list of shards, each a list of paths. Empty shards are left out.
+    """
+    shards = [[] for _ in range(nbr_of_shards)]
+    heap = [(0, 0, i) for i in range(nbr_of_shards)]
+
+    for path, size in sorted(files, key=lambda path_and_size: path_and_size[1], reverse=True):
+        shard_bytes, shard_files, i = heapq.heappop(heap)
+        shards[i].append(path)
+        heapq.heappush(heap, (shard_bytes + size, shard_files + 1, i))
+
+    log.debug("Split into shards of {} bytes".format(sorted(shard_bytes for shard_bytes, _, _ in heap)))
+
+    return [shard for shard in shards if shard]
+
+
+def write_filelist(path, files):
+    """
+    Write a filelist that can be passed to `dsmc archive -filelist=`
+    :param path: of the filelist to write
+    :param files: iterable of the paths to put in it
+    """
+    with open(path, "w") as f:
+        for file_path in files:
+            f.write('"{}"\n'.format(file_path))
+
+
+def read_filelist(path):
+    """
+    :param path: of a filelist written by `write_filelist`
+    :return: list of the paths in it
+    """
+    with open(path) as f:
+        return [line.rstrip("\n").strip('"') for line in f if line.strip()]
+
+
+def start_sharded(runner_service, command, files, descr, run_dir, dsmc_log_file, nbr_of_shards, options="",
+                  resources=None, first_shard_extra=()):
+    """
+    Split files into filelists of about the same number of bytes, and run a dsmc
+    command on each of them in parallel sessions, tracked as one group of jobs.
+    The filelist of every shard is kept next to its dsmc log, so that a shard
+    that fails can be run again on its own.
+
+    :param runner_service: to start the jobs with, see `dsmc.lib.jobrunner.JobRunnerAdapter`
+    :param command: the dsmc command, e.g. "dsmc archive" or "dsmc retrieve"
+    :param files: iterable of (path, size) tuples
+    :param descr: the dsmc description to archive or retrieve the files under
+    :param run_dir: where to run the jobs
+    :param dsmc_log_file: the filelist and log of every shard are named after it
+    :param nbr_of_shards: the maximum number of dsmc sessions to split the files over
+    :param options: other options of the command, e.g. "-replace=no"
+    :param resources: used by each dsmc session
+    :param first_shard_extra: paths to put in the first shard, e.g. the directories of an
+                              archive, that archiving a filelist doesn't create by itself
+    :return: tuple of the job id of the group (None on failure), and a list of dicts of
+             the job id, filelist, dsmc log, number of files and bytes of every shard
+    """
+    sizes = dict(files)
+    shards = [sorted(shard) for shard in balance_by_bytes(sizes.iteritems(), nbr_of_shards)]
+
+    if first_shard_extra:
+        if shards:
+            shards[0].extend(sorted(first_shard_extra))
+        else:
+            shards = [sorted(first_shard_extra)]
+
+    jobs = []
+    shard_infos = []
+
+    for i, shard in enumerate(shards):
+        filelist = "{}-shard{}.filelist".format(dsmc_log_file, i)
+        shard_log = "{}-shard{}".format(dsmc_log_file, i)
+        shard_bytes = sum(sizes.get(path, 0) for path in shard)
+        write_filelist(filelist, shard)
+
+        cmd = "{} -filelist={} -description={}".format(command, filelist, descr)
+        if options:
+            cmd = "{} {}".format(cmd, options)
+
+        jobs.append({"cmd": cmd, "nbr_of_cores": 1, "run_dir": run_dir, "stdout": shard_log, "stderr": shard_log,
+                     "resources": resources, "estimated_bytes": shard_bytes})
+        shard_infos.append({"filelist": filelist, "dsmc_log": shard_log, "files": len(shard), "bytes": shard_bytes})
+
+    log.debug("Running '{}' in {} parallel sessions".format(command, len(jobs)))
+
+    job_id = runner_service.start_group(jobs)
+
+    if job_id is not None:
+        for shard_info, child_id in zip(shard_infos, runner_service.children(job_id) or []):
+            shard_info["job_id"] = child_id
+
+    return job_id, shard_infos
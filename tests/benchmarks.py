@@ -0,0 +1,212 @@
+"""
+Benchmarks of the stages of an upload and a reupload check, on a synthetic
+runfolder and with `tests/fake_dsmc.py` standing in for dsmc. Every stage
+runs in a process of its own, so that its peak memory can be told apart
+from the others. Run from the root of the repository, e.g.
+
+    python -m tests.benchmarks --files 100000 --objects 1000000 --output results.json
+    python -m tests.benchmarks --files 100000 --objects 1000000 --baseline results.json
+
+With a baseline, the run fails if a stage has become more than `--tolerance`
+slower, or uses that much more memory, than in the baseline.
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from dsmc.handlers.dsmc_handlers import CreateDirHandler, ReuploadHelper
+from dsmc.lib.linktree import ExcludePatterns, plan_link_tree
+from tests import fake_dsmc
+
+FAKE_DSMC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_dsmc.py")
+
+
+def create_runfolder(path, nbr_of_files):
+    """
+    Create a synthetic runfolder of sparse files, see `fake_dsmc.synthetic_files`
+    """
+    for rel_path, size in fake_dsmc.synthetic_files(nbr_of_files):
+        full_path = os.path.join(path, rel_path)
+
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+
+        with open(full_path, "wb") as f:
+            f.truncate(size)
+
+
+def install_fake_dsmc(bin_dir):
+    """
+    Put the fake dsmc first on the PATH
+    """
+    with open(os.path.join(bin_dir, "dsmc"), "w") as f:
+        f.write("#!/bin/sh\nexec {} {} \"$@\"\n".format(sys.executable, FAKE_DSMC))
+    os.chmod(os.path.join(bin_dir, "dsmc"), 0755)
+    os.environ["PATH"] = "{}:{}".format(bin_dir, os.environ["PATH"])
+
+
+def max_rss_mb():
+    # In kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_stage(name, prepare, stage):
+    """
+    Run a stage in a forked process
+    :param prepare: function returning the arguments of the stage, not timed
+    :param stage: function run with the prepared arguments
+    :return: dict of the seconds the stage took and its peak memory in MB
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(read_end)
+        result = {}
+
+        try:
+            args = prepare()
+            rss_before = max_rss_mb()
+            start = time.time()
+            stage(*args)
+            result = {"seconds": time.time() - start, "peak_mb": max_rss_mb(),
+                      "peak_increase_mb": max_rss_mb() - rss_before}
+        except Exception, msg:
+            result = {"error": str(msg)}
+        finally:
+            with os.fdopen(write_end, "w") as f:
+                json.dump(result, f)
+            os._exit(0)
+
+    os.close(write_end)
+
+    with os.fdopen(read_end) as f:
+        result = json.load(f)
+
+    os.waitpid(pid, 0)
+    result["stage"] = name
+
+    return result
+
+
+def benchmarks(runfolder, nbr_of_objects, workers, tmp_dir):
+    """
+    :return: list of (name, prepare, stage) of the stages to benchmark
+    """
+    helper = ReuploadHelper()
+    synthetic_archive = "/fake/runfolders/synthetic_archive"
+    nbr_of_objects = str(nbr_of_objects)
+
+    def query_env(locale):
+        os.environ["FAKE_DSMC_LOCALE"] = locale
+        os.environ["FAKE_DSMC_OBJECTS"] = nbr_of_objects
+        return synthetic_archive, "fake-description-0000"
+
+    def local_and_uploaded():
+        return (helper.get_local_filelist(runfolder, workers=workers),
+                helper.get_pdc_latest_version(runfolder)[1])
+
+    def create_archive(excludes):
+        dest = tempfile.mkdtemp(dir=tmp_dir)
+        CreateDirHandler._create_archive(runfolder, dest, excludes, workers)
+
+    return [
+        ("query_space_locale", lambda: query_env("space"), helper.get_pdc_filelist),
+        ("query_comma_locale", lambda: query_env("comma"), helper.get_pdc_filelist),
+        ("query_latest_version", lambda: (runfolder,), helper.get_pdc_latest_version),
+        ("local_filelist", lambda: (runfolder, workers), helper.get_local_filelist),
+        ("files_to_reupload", local_and_uploaded, helper.get_files_to_reupload),
+        ("create_archive", lambda: (ExcludePatterns(["Thumbnail_Images/**", "*.cif"]),), create_archive),
+        ("plan_archive", lambda: (runfolder, ExcludePatterns(["Thumbnail_Images/**", "*.cif"]), workers),
+         plan_link_tree),
+    ]
+
+
+def regressions(results, baseline, tolerance):
+    """
+    :return: list of messages about the stages that are slower, or use more memory,
+             than in the baseline by more than the tolerance
+    """
+    baseline = dict((result["stage"], result) for result in baseline)
+    messages = []
+
+    for result in results:
+        before = baseline.get(result["stage"])
+
+        if not before or "error" in before or "error" in result:
+            continue
+
+        for key in ("seconds", "peak_mb"):
+            if result[key] > before[key] * (1 + tolerance):
+                messages.append("{} {} went from {:.2f} to {:.2f}".format(result["stage"], key, before[key],
+                                                                        result[key]))
+
+    return messages
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the stages of an upload on a synthetic runfolder")
+    parser.add_argument("--files", type=int, default=10000, help="number of files in the synthetic runfolder")
+    parser.add_argument("--objects", type=int, default=100000,
+                        help="number of files in the synthetic archive listed by the dsmc queries")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--stages", nargs="+", help="only run these stages")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of earlier results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(args)
+
+    tmp_dir = tempfile.mkdtemp(prefix="dsmc_benchmarks_")
+
+    try:
+        runfolder = os.path.join(tmp_dir, "runfolder_archive")
+        bin_dir = os.path.join(tmp_dir, "bin")
+        os.mkdir(bin_dir)
+
+        install_fake_dsmc(bin_dir)
+
+        start = time.time()
+        create_runfolder(runfolder, args.files)
+        print("Created a runfolder of {} files in {:.1f} s".format(args.files, time.time() - start))
+
+        results = []
+
+        for name, prepare, stage in benchmarks(runfolder, args.objects, args.workers, tmp_dir):
+            if args.stages and name not in args.stages:
+                continue
+
+            result = run_stage(name, prepare, stage)
+            results.append(result)
+
+            if "error" in result:
+                print("{:<22} failed: {}".format(name, result["error"]))
+            else:
+                print("{:<22} {:>8.2f} s {:>10.1f} MB peak {:>10.1f} MB increase".format(
+                    name, result["seconds"], result["peak_mb"], result["peak_increase_mb"]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            messages = regressions(results, json.load(f), args.tolerance)
+
+        for message in messages:
+            print("Regression: {}".format(message))
+
+        return 1 if messages else 0
+
+    return 1 if any("error" in result for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+A stand-in for the dsmc client, for tests and benchmarks on machines without
+access to a TSM server. It answers `dsmc q ar` and `dsmc archive` with output
+in the format of the real client.
+
+An archive that exists locally is reported as if it had been uploaded as it
+is. Any other path is reported as a synthetic runfolder, see `synthetic_files`.
+The output is controlled by environment variables:
+
+    FAKE_DSMC_OBJECTS     number of files of a synthetic runfolder (10000)
+    FAKE_DSMC_VERSIONS    number of uploaded versions of every archive (1)
+    FAKE_DSMC_LOCALE      "space" for sizes like "4 096" and dates like "2017-07-27 17.48.34",
+                          "comma" for sizes like "4,096" and dates like "07/27/2017 17:48:34" (space)
+    FAKE_DSMC_DELAY       seconds to wait before answering, like setting up a session (0)
+    FAKE_DSMC_FILE_DELAY  seconds to wait after every file archived (0)
+    FAKE_DSMC_WARNINGS    number of ANS warnings to print among the output, dsmc then returns 8 (0)
+
+Put it on the PATH as `dsmc`, e.g. with a link, or run it as
+`python tests/fake_dsmc.py q ar /path/to/archive -subdir=yes`.
+"""
+
+import datetime
+import os
+import random
+import sys
+import time
+
+HEADER = """IBM Tivoli Storage Manager
+Command Line Backup-Archive Client Interface
+  Client Version 7, Release 1, Level 2.0
+  Client date/time: {now}
+(c) Copyright by IBM Corporation and other(s) 1990, 2015. All Rights Reserved.
+
+Node Name: FAKE-DSMC
+Session established with server FAKE: Linux/x86_64
+  Server Version 6, Release 3, Level 5.0
+  Server date/time: {now}  Last access: {now}
+
+"""
+
+QUERY_HEADER = """Accessing as node: FAKE-DSMC
+             Size  Archive Date - Time    File - Expires on - Description
+             ----  -------------------    -------------------------------
+"""
+
+WARNING = "ANS1809W A session with the TSM server has been disconnected. An attempt will be made to reestablish " \
+          "the connection."
+
+DIR_SIZE = 4096
+
+
+def synthetic_files(nbr_of_files, seed=0):
+    """
+    The files of a synthetic runfolder, laid out like a HiSeq X runfolder: a
+    lot of small bcl, filter and InterOp files, and a few large fastq files.
+    :param nbr_of_files: the number of files
+    :return: generator of (relative path, size)
+    """
+    rand = random.Random(seed)
+    nbr_of_fastqs = max(1, nbr_of_files // 1000)
+
+    for name in ("RunInfo.xml", "runParameters.xml", "SampleSheet.csv"):
+        yield name, rand.randint(1000, 20000)
+
+    for nbr in range(nbr_of_fastqs):
+        yield ("Unaligned/Project_{}/Sample_{}/Sample_{}_S{}_L00{}_R1_001.fastq.gz".format(
+            nbr // 96, nbr, nbr, nbr, nbr % 8 + 1), rand.randint(10 ** 9, 4 * 10 ** 9))
+
+    for nbr in range(3 + nbr_of_fastqs, nbr_of_files):
+        lane = nbr % 8 + 1
+        cycle = nbr // 8 // 96 + 1
+        tile = nbr // 8 % 96 + 1101
+
+        if nbr % 50 == 0:
+            yield "InterOp/C{}.1/TileMetricsOut_{}.bin".format(cycle, tile), rand.randint(100, 50000)
+        elif nbr % 10 == 0:
+            yield "Data/Intensities/BaseCalls/L00{}/s_{}_{}.filter".format(lane, lane, tile), rand.randint(1000, 100000)
+        else:
+            yield ("Data/Intensities/BaseCalls/L00{}/C{}.1/s_{}_{}.bcl.gz".format(lane, cycle, lane, tile),
+                   rand.randint(100000, 2000000))
+
+
+def local_files(path):
+    """
+    :return: generator of (path, size) of the directories and files below a local
+             archive, following links like dsmc does
+    """
+    yield path, DIR_SIZE
+
+    for root, dirs, files in os.walk(path, followlinks=True):
+        for name in sorted(dirs):
+            yield os.path.join(root, name), DIR_SIZE
+
+        for name in sorted(files):
+            full_path = os.path.join(root, name)
+            try:
+                yield full_path, os.stat(full_path).st_size
+            except OSError:
+                yield full_path, os.lstat(full_path).st_size
+
+
+def archive_objects(path, subdir):
+    """
+    :return: generator of (path, size) of the objects archived below a path
+    """
+    path = path.rstrip("/") or "/"
+
+    if os.path.exists(path):
+        # dsmc reports absolute paths
+        objects = local_files(os.path.abspath(path))
+    else:
+        def synthetic():
+            yield path, DIR_SIZE
+            dirs = set()
+
+            for rel_path, size in synthetic_files(int(os.environ.get("FAKE_DSMC_OBJECTS", 10000))):
+                rel_dir = os.path.dirname(rel_path)
+
+                while rel_dir and rel_dir not in dirs:
+                    dirs.add(rel_dir)
+                    yield os.path.join(path, rel_dir), DIR_SIZE
+                    rel_dir = os.path.dirname(rel_dir)
+
+                yield os.path.join(path, rel_path), size
+
+        objects = synthetic()
+
+    for obj in objects:
+        yield obj
+        if not subdir:
+            return
+
+
+class Formatter(object):
+
+    def __init__(self, locale):
+        self.locale = locale
+
+    def size(self, size):
+        separator = "," if self.locale == "comma" else " "
+        return "{:,}".format(size).replace(",", separator)
+
+    def timestamp(self, when):
+        if self.locale == "comma":
+            return when.strftime("%m/%d/%Y %H:%M:%S")
+        return when.strftime("%Y-%m-%d %H.%M.%S")
+
+
+def parse_args(args):
+    options = {}
+    positional = []
+
+    for arg in args:
+        if arg.startswith("-"):
+            name, _, value = arg.lstrip("-").partition("=")
+            options[name.lower()] = value
+        else:
+            positional.append(arg)
+
+    return positional, options
+
+
+class Warnings(object):
+    """
+    Spreads the requested number of warnings over the output
+    """
+
+    def __init__(self, nbr_of_warnings, out):
+        self.left = nbr_of_warnings
+        self.printed = 0
+        self.out = out
+
+    def maybe(self, index):
+        if self.left and index % 97 == 0:
+            self.out.write("{}\n".format(WARNING))
+            self.left -= 1
+            self.printed += 1
+
+    def rest(self):
+        for _ in range(self.left):
+            self.out.write("{}\n".format(WARNING))
+        self.printed += self.left
+        self.left = 0
+
+
+def query_archive(positional, options, formatter, warnings, out):
+    if not positional:
+        out.write("ANS1102E Excessive number of command line arguments passed to the program!\n")
+        return 12
+
+    path = positional[0].strip("'\"")
+    subdir = options.get("subdir", "no").lower() == "yes"
+    description = options.get("description")
+
+    nbr_of_versions = int(os.environ.get("FAKE_DSMC_VERSIONS", 1))
+    first_upload = datetime.datetime(2017, 1, 10, 15, 16, 26)
+    versions = [("fake-description-{:04d}".format(nbr), first_upload + datetime.timedelta(days=nbr))
+                for nbr in range(nbr_of_versions)]
+
+    # The real client doesn't list versions in chronological order either
+    random.Random(1).shuffle(versions)
+
+    if description:
+        versions = [(descr, when) for descr, when in versions if descr == description]
+
+    if path.endswith("/*"):
+        root = path[:-2]
+        paths = [os.path.join(root, name) for name in sorted(os.listdir(root))] if os.path.isdir(root) else []
+    else:
+        paths = [path]
+
+    out.write(QUERY_HEADER)
+    index = 0
+
+    for archive in paths:
+        for descr, when in versions:
+            for obj_path, size in archive_objects(archive, subdir):
+                out.write("{:>18}  B  {}    {} Never {}\n".format(formatter.size(size), formatter.timestamp(when),
+                                                                  obj_path, descr))
+                warnings.maybe(index)
+                index += 1
+
+    if not index:
+        out.write("ANS1092W No files matching search criteria were found\n")
+        return 8
+
+    return 0
+
+
+def archive(positional, options, formatter, warnings, out):
+    file_delay = float(os.environ.get("FAKE_DSMC_FILE_DELAY", 0))
+    start = time.time()
+
+    if "filelist" in options:
+        with open(options["filelist"]) as f:
+            paths = [line.strip().strip('"') for line in f if line.strip()]
+        objects = ((path, os.path.getsize(path) if os.path.exists(path) else 0) for path in paths)
+    elif positional:
+        objects = archive_objects(positional[0], options.get("subdir", "no").lower() == "yes")
+    else:
+        out.write("ANS1102E Excessive number of command line arguments passed to the program!\n")
+        return 12
+
+    out.write("Archive function invoked.\n\n")
+    nbr_of_objects = 0
+    nbr_of_bytes = 0
+
+    for index, (path, size) in enumerate(objects):
+        kind = "Directory-->" if os.path.isdir(path) else "Normal File-->"
+        out.write("{:<14}{:>22} {} [Sent]\n".format(kind, formatter.size(size), path))
+        nbr_of_objects += 1
+        nbr_of_bytes += size
+        warnings.maybe(index)
+
+        if file_delay:
+            out.flush()
+            time.sleep(file_delay)
+
+    elapsed = int(time.time() - start)
+
+    out.write("\n")
+    out.write("Total number of objects inspected:{:>20}\n".format(formatter.size(nbr_of_objects)))
+    out.write("Total number of objects archived:{:>21}\n".format(formatter.size(nbr_of_objects)))
+    out.write("Total number of objects failed:{:>23}\n".format(0))
+    out.write("Total number of bytes transferred:{:>20}\n".format("{:.2f} MB".format(nbr_of_bytes / 1024.0 ** 2)))
+    out.write("Elapsed processing time:{:>30}\n".format("{:02d}:{:02d}:{:02d}".format(
+        elapsed // 3600, elapsed // 60 % 60, elapsed % 60)))
+
+    return 0
+
+
+def main(args=None, out=sys.stdout):
+    args = sys.argv[1:] if args is None else args
+    positional, options = parse_args(args)
+
+    time.sleep(float(os.environ.get("FAKE_DSMC_DELAY", 0)))
+    out.write(HEADER.format(now=datetime.datetime.now().strftime("%Y-%m-%d %H.%M.%S")))
+
+    formatter = Formatter(os.environ.get("FAKE_DSMC_LOCALE", "space"))
+    warnings = Warnings(int(os.environ.get("FAKE_DSMC_WARNINGS", 0)), out)
+
+    if positional[:2] in (["q", "ar"], ["query", "archive"]):
+        returncode = query_archive(positional[2:], options, formatter, warnings, out)
+    elif positional[:1] in (["archive"], ["ar"]):
+        returncode = archive(positional[1:], options, formatter, warnings, out)
+    else:
+        out.write("ANS1138E The '{}' command must be followed by a subcommand\n".format(" ".join(positional)))
+        return 12
+
+    warnings.rest()
+
+    if returncode == 0 and warnings.printed:
+        returncode = 8
+
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from dsmc.lib.bundle import INDEX_NAME, read_index, split_into_bundles, verify_bundles, write_bundles
+
+
+class TestBundle(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+        self.src = os.path.join(self.tmp_dir, "runfolder")
+        self.dest = os.path.join(self.tmp_dir, "runfolder_archive")
+        os.makedirs(os.path.join(self.src, "InterOp"))
+        os.mkdir(self.dest)
+
+        self.files = []
+        for nbr in range(5):
+            rel_path = "InterOp/metrics_{}.bin".format(nbr)
+            with open(os.path.join(self.src, rel_path), "w") as f:
+                f.write(str(nbr) * 100 * (nbr + 1))
+            self.files.append((rel_path, 100 * (nbr + 1)))
+
+    def test_split_into_bundles(self):
+        self.assertEqual(split_into_bundles([("b", 5), ("a", 5), ("c", 20), ("d", 1)], max_bundle_bytes=10),
+                         [["a", "b"], ["c"], ["d"]])
+
+    def test_write_bundles(self):
+        names = write_bundles(self.src, self.dest, self.files, max_bundle_bytes=1000, workers=2)
+
+        self.assertEqual(names, ["small_files_0001.tar", "small_files_0002.tar"])
+        self.assertItemsEqual(os.listdir(self.dest), names + [INDEX_NAME])
+
+        # The bundles are ordinary tar files, with the paths relative to the runfolder
+        with tarfile.open(os.path.join(self.dest, names[0])) as tar:
+            self.assertEqual(tar.getnames(), ["InterOp/metrics_0.bin", "InterOp/metrics_1.bin", "InterOp/metrics_2.bin",
+                                             "InterOp/metrics_3.bin"])
+            self.assertEqual(tar.extractfile("InterOp/metrics_1.bin").read(), "1" * 200)
+
+        index = read_index(self.dest)
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index["InterOp/metrics_4.bin"].bundle, names[1])
+        self.assertEqual(index["InterOp/metrics_4.bin"].md5, hashlib.md5("4" * 500).hexdigest())
+        self.assertEqual(verify_bundles(self.dest), [])
+
+    def test_verify_bundles(self):
+        write_bundles(self.src, self.dest, self.files)
+        bundled_file = read_index(self.dest)["InterOp/metrics_2.bin"]
+
+        with open(os.path.join(self.dest, bundled_file.bundle), "r+b") as f:
+            f.seek(bundled_file.offset)
+            f.write("x")
+
+        errors = verify_bundles(self.dest)
+        self.assertEqual([rel_path for rel_path, _ in errors], ["InterOp/metrics_2.bin"])
+
+    def test_nothing_bundled(self):
+        self.assertEqual(read_index(self.dest), {})
+        self.assertEqual(verify_bundles(self.dest), [])
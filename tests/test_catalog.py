@@ -0,0 +1,140 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from arteria.web.state import State
+
+from dsmc.lib.catalog import ArchiveCatalog, CatalogUpdater
+from dsmc.lib.manifest import Manifest
+from dsmc.lib.query import ArchivedFile
+
+
+class TestArchiveCatalog(unittest.TestCase):
+
+    ARCHIVE = "/data/mm-xart002/runfolders/foo_archive"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.catalog = ArchiveCatalog(os.path.join(self.tmp_dir, "catalog.sqlite"), datetime.timedelta(hours=1))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _archived(self, path, size, descr, archived_at):
+        return ArchivedFile(size, archived_at, os.path.join(self.ARCHIVE, path), "Never", descr)
+
+    def test_replace(self):
+        self.assertFalse(self.catalog.is_fresh(self.ARCHIVE))
+
+        self.catalog.replace(self.ARCHIVE, [
+            self._archived("a.txt", 10, "old", datetime.datetime(2017, 7, 27)),
+            self._archived("b.txt", 20, "new", datetime.datetime(2017, 9, 1)),
+            self._archived("a.txt", 11, "new", datetime.datetime(2017, 9, 1))])
+
+        self.assertTrue(self.catalog.is_fresh(self.ARCHIVE))
+        self.assertEqual(self.catalog.latest_description(self.ARCHIVE), "new")
+        self.assertEqual(dict(self.catalog.filelist(self.ARCHIVE, "new").iteritems()), {"a.txt": 11, "b.txt": 20})
+
+        self.catalog.mark_stale(self.ARCHIVE)
+        self.assertFalse(self.catalog.is_fresh(self.ARCHIVE))
+
+    def test_replace_is_rolled_back_on_error(self):
+        def failing():
+            yield self._archived("a.txt", 10, "descr", datetime.datetime(2017, 7, 27))
+            raise RuntimeError("dsmc failed")
+
+        with self.assertRaises(RuntimeError):
+            self.catalog.replace(self.ARCHIVE, failing())
+
+        self.assertFalse(self.catalog.is_fresh(self.ARCHIVE))
+        self.assertEqual(len(self.catalog.filelist(self.ARCHIVE, "descr")), 0)
+
+    def test_update_from_jobs(self):
+        archive = os.path.join(self.tmp_dir, "foo_archive")
+        os.mkdir(archive)
+
+        with open(os.path.join(archive, "a.txt"), "w") as f:
+            f.write("hello")
+
+        class MyRunner(object):
+            states = {"1": State.STARTED, "2": State.ERROR}
+
+            def status(self, job_id):
+                return self.states[job_id]
+
+        runner = MyRunner()
+        manifest_dir = os.path.join(self.tmp_dir, "manifests")
+        manifest, _ = Manifest.create(archive, "descr")
+        manifest.write(Manifest.pending_path_for(manifest_dir, 1))
+        self.catalog.track_job(1, archive, "descr")
+        self.catalog.update_from_jobs(runner, manifest_dir=manifest_dir)
+        self.assertFalse(self.catalog.is_fresh(archive))
+
+        # A file added after the upload started isn't taken for uploaded
+        with open(os.path.join(archive, "b.txt"), "w") as f:
+            f.write("world")
+
+        runner.states["1"] = State.DONE
+        self.catalog.update_from_jobs(runner, manifest_dir=manifest_dir)
+        self.assertTrue(self.catalog.is_fresh(archive))
+        self.assertEqual(dict(self.catalog.filelist(archive, "descr").absolute_items()),
+                         {os.path.join(archive, "a.txt"): 5})
+        self.assertEqual(Manifest.read(Manifest.path_for(manifest_dir, archive)).files.keys(), ["a.txt"])
+        self.assertFalse(os.path.exists(Manifest.pending_path_for(manifest_dir, 1)))
+
+        # A failed reupload leaves the archive stale
+        self.catalog.track_job(2, archive, "descr", [os.path.join(archive, "a.txt")])
+        self.catalog.update_from_jobs(runner)
+        self.assertFalse(self.catalog.is_fresh(archive))
+
+        # So does an upload without a manifest of what it uploaded
+        runner.states["3"] = State.DONE
+        self.catalog.track_job(3, archive, "descr3")
+        self.catalog.update_from_jobs(runner, manifest_dir=manifest_dir)
+        self.assertFalse(self.catalog.is_fresh(archive))
+        self.assertNotEqual(self.catalog.latest_description(archive), "descr3")
+
+    def test_catalog_updater(self):
+        archive = os.path.join(self.tmp_dir, "foo_archive")
+        os.mkdir(archive)
+
+        with open(os.path.join(archive, "a.txt"), "w") as f:
+            f.write("hello")
+
+        class MyRunner(object):
+            states = {"1": State.STARTED, "2": State.DONE}
+            callbacks = []
+
+            def status(self, job_id):
+                return self.states[str(job_id)]
+
+            def add_finished_callback(self, callback):
+                self.callbacks.append(callback)
+
+        runner = MyRunner()
+        manifest_dir = os.path.join(self.tmp_dir, "manifests")
+        updater = CatalogUpdater(self.catalog, runner, manifest_dir=manifest_dir)
+
+        for job_id, descr in ((1, "descr"), (2, "descr2")):
+            Manifest.create(archive, descr)[0].write(Manifest.pending_path_for(manifest_dir, job_id))
+
+        updater.track_job(1, archive, "descr")
+        updater.sweep().result()
+        self.assertFalse(self.catalog.is_fresh(archive))
+
+        # The runner tells the updater when the job has finished
+        runner.states["1"] = State.DONE
+        for callback in runner.callbacks:
+            callback(1, State.DONE).result()
+
+        self.assertTrue(self.catalog.is_fresh(archive))
+        self.assertTrue(os.path.exists(Manifest.path_for(manifest_dir, archive)))
+
+        # A job that finished before it was tracked is catalogued right away
+        self.catalog.mark_stale(archive)
+        updater.track_job(2, archive, "descr2")
+        updater.executor.shutdown(wait=True)
+        self.assertTrue(self.catalog.is_fresh(archive))
+        self.assertEqual(self.catalog.latest_description(archive), "descr2")
@@ -0,0 +1,165 @@
+import gzip
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import unittest
+
+from dsmc.lib import checksums
+from dsmc.lib.checksums import ChecksumCache, generate_checksums, verify_checksums
+from dsmc.lib.inventory import scan_tree
+
+
+class TestChecksums(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.tmp_dir, "foo_archive")
+        shutil.copytree("tests/resources/archives/archive_from_pdc", self.archive)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_generate_checksums(self):
+        filename = "checksums_prior_to_pdc.md5"
+
+        cmd = "cd {} && find -L . -type f -exec md5sum {{}} +".format(self.archive)
+        expected = subprocess.check_output(cmd, shell=True).splitlines()
+
+        errors, gzip_errors = generate_checksums(self.archive, filename, workers=2)
+
+        with open(os.path.join(self.archive, filename)) as f:
+            self.assertItemsEqual(f.read().splitlines(), expected)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(gzip_errors, [])
+
+        # The checksum file itself is left out when regenerating
+        generate_checksums(self.archive, filename, workers=2)
+
+        with open(os.path.join(self.archive, filename)) as f:
+            self.assertItemsEqual(f.read().splitlines(), expected)
+
+        # And the file can be verified with md5sum
+        subprocess.check_call("cd {} && md5sum --quiet -c {}".format(self.archive, filename), shell=True)
+
+    def test_generate_checksums_with_cache(self):
+        filename = "checksums_prior_to_pdc.md5"
+        cache = ChecksumCache(os.path.join(self.tmp_dir, "cache.sqlite"))
+
+        # Checksum an archive of links to the real files, like an `_archive` directory
+        links = os.path.join(self.tmp_dir, "links_archive")
+        os.mkdir(links)
+        for name in ("RunInfo.xml", "SampleSheet.csv"):
+            os.symlink(os.path.join(self.archive, name), os.path.join(links, name))
+
+        generate_checksums(links, filename, workers=2, cache=cache)
+
+        with open(os.path.join(links, filename)) as f:
+            first = f.read().splitlines()
+
+        # Rebuild the links, the files should then be served from the cache
+        shutil.rmtree(links)
+        os.mkdir(links)
+        for name in ("RunInfo.xml", "SampleSheet.csv"):
+            os.symlink(os.path.join(self.archive, name), os.path.join(links, name))
+
+        def fail(path):
+            raise AssertionError("{} should be taken from the cache".format(path))
+
+        hash_file = checksums.hash_file
+        checksums.hash_file = fail
+
+        try:
+            generate_checksums(links, filename, workers=1, cache=cache)
+        finally:
+            checksums.hash_file = hash_file
+
+        with open(os.path.join(links, filename)) as f:
+            self.assertItemsEqual(f.read().splitlines(), first)
+
+        cache.close()
+
+    def test_cache_write_that_is_locked_out_is_a_miss(self):
+        db_path = os.path.join(self.tmp_dir, "cache.sqlite")
+        cache = ChecksumCache(db_path)
+        local_file = scan_tree(self.archive)[os.path.join(self.archive, "RunInfo.xml")]
+
+        # Another job is writing to the cache
+        other = sqlite3.connect(db_path)
+        other.execute("BEGIN EXCLUSIVE")
+
+        cache.conn.execute("PRAGMA busy_timeout = 10")
+        cache.put(local_file, "md5", "d41d8cd98f00b204e9800998ecf8427e")
+        cache.commit()
+
+        other.rollback()
+        other.close()
+
+        self.assertIsNone(cache.get(local_file, "md5"))
+
+        cache.put(local_file, "md5", "d41d8cd98f00b204e9800998ecf8427e")
+        cache.close()
+        self.assertEqual(ChecksumCache(db_path).get(local_file, "md5"), "d41d8cd98f00b204e9800998ecf8427e")
+
+    def test_generate_checksums_with_several_digests_and_gzip_check(self):
+        filename = "checksums_prior_to_pdc.md5"
+
+        # The fastq files of the test archive aren't real gzip files
+        archive = os.path.join(self.tmp_dir, "gz_archive")
+        os.mkdir(archive)
+
+        with gzip.open(os.path.join(archive, "ok.fastq.gz"), "wb") as f:
+            f.write("@read\nACGT\n+\nIIII\n" * 10000)
+
+        # Concatenated members are fine, like `cat a.gz b.gz`
+        with open(os.path.join(archive, "ok.fastq.gz"), "rb") as f:
+            member = f.read()
+        with open(os.path.join(archive, "concatenated.fastq.gz"), "wb") as f:
+            f.write(member + member)
+
+        with open(os.path.join(archive, "truncated.fastq.gz"), "wb") as f:
+            f.write(member[:len(member) / 2])
+
+        with open(os.path.join(archive, "not_gzip.gz"), "wb") as f:
+            f.write("not gzip data")
+
+        errors, gzip_errors = generate_checksums(archive, filename, workers=2,
+                                                 algorithms=["md5", "sha256"], check_gzip=True)
+
+        self.assertEqual(errors, [])
+        self.assertItemsEqual([os.path.basename(path) for path, _ in gzip_errors],
+                              ["truncated.fastq.gz", "not_gzip.gz"])
+
+        with open(os.path.join(archive, "checksums_prior_to_pdc.gzip_errors")) as f:
+            self.assertEqual([line.split("\t")[0] for line in f.read().splitlines()],
+                             ["./not_gzip.gz", "./truncated.fastq.gz"])
+
+        # Every digest goes to a file of its own, that can be verified with the usual tools
+        subprocess.check_call("cd {} && md5sum --quiet -c {}".format(archive, filename), shell=True)
+        subprocess.check_call("cd {} && sha256sum --quiet -c checksums_prior_to_pdc.sha256".format(archive),
+                              shell=True)
+
+    def test_verify_checksums(self):
+        filename = "checksums_prior_to_pdc.md5"
+        generate_checksums(self.archive, filename, workers=2)
+
+        self.assertEqual(verify_checksums(self.archive, filename, workers=2), [])
+
+        # Retrieved files that are missing, or differ, are reported
+        with open(os.path.join(self.archive, filename)) as f:
+            rel_paths = sorted(line.split("  ", 1)[1].rstrip("\n") for line in f)
+
+        os.remove(os.path.join(self.archive, rel_paths[0]))
+        with open(os.path.join(self.archive, rel_paths[1]), "a") as f:
+            f.write("corrupted")
+
+        errors = verify_checksums(self.archive, filename, workers=2)
+        self.assertEqual([rel_path for rel_path, _ in errors], rel_paths[:2])
+        self.assertEqual(errors[1][1], "md5 differs")
+
+        with open(os.path.join(self.archive, "checksums_prior_to_pdc.verify_errors")) as f:
+            self.assertEqual([line.split("\t")[0] for line in f.read().splitlines()], rel_paths[:2])
+
+        self.assertEqual(checksums.main([self.archive, "--output", filename, "--verify"]), 1)
@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dsmc.lib.db import connect
+
+
+class TestConnect(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "test.sqlite")
+
+        with connect(self.db_path) as conn:
+            conn.execute("CREATE TABLE numbers (n INTEGER)")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def count(self):
+        with connect(self.db_path) as conn:
+            return conn.execute("SELECT COUNT(*) FROM numbers").fetchone()[0]
+
+    def test_commits(self):
+        with connect(self.db_path) as conn:
+            conn.execute("INSERT INTO numbers VALUES (1)")
+
+        self.assertEqual(self.count(), 1)
+
+    def test_rolls_back_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with connect(self.db_path) as conn:
+                conn.execute("INSERT INTO numbers VALUES (1)")
+                raise RuntimeError("failed")
+
+        self.assertEqual(self.count(), 0)
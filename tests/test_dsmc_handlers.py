@@ -1,7 +1,12 @@
 
+import datetime
 import json
 import mock
+import shutil
 import subprocess
+import tempfile
+import sys
+import threading
 
 from nose.tools import *
 from mockproc import mockprocess
@@ -17,8 +22,15 @@ from arteria.exceptions import ArteriaUsageException
 
 from dsmc.app import routes
 from dsmc import __version__ as dsmc_version
-from dsmc.handlers.dsmc_handlers import VersionHandler, UploadHandler, StatusHandler, ReuploadHandler, CreateDirHandler, GenChecksumsHandler, ReuploadHelper
+from dsmc.handlers.dsmc_handlers import BaseDsmcHandler, VersionHandler, UploadHandler, StatusHandler, ReuploadHandler, CreateDirHandler, GenChecksumsHandler, ReuploadHelper
+from dsmc.lib.catalog import ArchiveCatalog
+from dsmc.lib.inventory import scan_tree
 from dsmc.lib.jobrunner import LocalQAdapter
+from dsmc.lib.jobstore import JobStore
+from dsmc.lib.listing import FileListing
+from dsmc.lib.manifest import Manifest
+from dsmc.lib.progress import DsmcProgress
+from dsmc.lib.query import DsmcQueryError
 from tests.test_utils import DummyConfig
 
 # TODO: Uploadhandler is not correct tested yet. 
@@ -34,6 +46,22 @@ class TestDsmcHandlers(AsyncHTTPTestCase):
 
     runner_service = LocalQAdapter(nbr_of_cores=2, whitelisted_warnings = dummy_config["whitelisted_warnings"], interval = 2, priority_method = "fifo")
 
+    def setUp(self):
+        super(TestDsmcHandlers, self).setUp()
+
+        # Start every test with an empty catalog and no manifests
+        catalog_path = os.path.join(self.dummy_config["dsmc_log_directory"], "pdc_catalog.sqlite")
+        if os.path.exists(catalog_path):
+            os.remove(catalog_path)
+
+        job_store_path = os.path.join(self.dummy_config["dsmc_log_directory"], "jobs.sqlite")
+        if os.path.exists(job_store_path):
+            os.remove(job_store_path)
+
+        manifest_dir = os.path.join(self.dummy_config["dsmc_log_directory"], "manifests")
+        if os.path.exists(manifest_dir):
+            shutil.rmtree(manifest_dir)
+
     def get_app(self):
         return Application(
             routes(
@@ -51,6 +79,16 @@ class TestDsmcHandlers(AsyncHTTPTestCase):
         self.assertEqual(json.loads(response.body), expected_result)    
 
 
+    def test_metrics(self):
+        self.fetch(self.API_BASE + "/version")
+        response = self.fetch(self.API_BASE + "/metrics")
+
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+        self.assertIn('arteria_dsmc_requests_total{handler="version",method="GET",code="200"}', response.body)
+        self.assertIn("# TYPE arteria_dsmc_handler_stage_seconds histogram", response.body)
+        self.assertIn("# TYPE arteria_dsmc_job_run_seconds histogram", response.body)
+
     def test__validate_runfolder_exists_ok(self):
         is_valid = UploadHandler._validate_runfolder_exists("testrunfolder", self.dummy_config["monitored_directory"])
         self.assertTrue(is_valid)
@@ -83,6 +121,57 @@ class TestDsmcHandlers(AsyncHTTPTestCase):
         self.assertTrue(expected_link in json_resp["link"])
         self.assertEqual(json_resp["state"], State.STARTED)
 
+        # The runfolder is measured after the upload has been started
+        self.assertIsNone(mock_start.call_args[1].get("estimated_bytes"))
+
+        # Archives are referred to by their absolute path
+        path_to_archive = os.path.abspath(os.path.join(self.dummy_config["path_to_archive_root"], "test_archive"))
+        self.assertTrue(mock_start.call_args[0][1].startswith("dsmc archive {}/ -subdir=yes".format(path_to_archive)))
+        progress = DsmcProgress([json_resp["dsmc_log"]])
+        UploadHandler._measure(path_to_archive, "descr", 1, progress)
+        self.assertEqual(progress.total_bytes,
+                         sum(local_file.size for local_file in scan_tree(path_to_archive).itervalues()))
+
+
+    @mock.patch("dsmc.lib.jobrunner.LocalQAdapter.start_group", autospec=True)
+    def test_start_sharded_upload(self, mock_start_group):
+        job_id = 25
+        mock_start_group.return_value = job_id
+
+        body = {"sessions": 2}
+        response = self.fetch(self.API_BASE + "/upload/test_archive", method="POST", body=json_encode(body))
+        json_resp = json.loads(response.body)
+
+        self.assertEqual(response.code, 202)
+        self.assertEqual(json_resp["job_id"], job_id)
+        self.assertEqual(len(json_resp["dsmc_log"]), 2)
+
+        jobs = mock_start_group.call_args[0][1]
+        self.assertEqual(len(jobs), 2)
+
+        archived = []
+        for job in jobs:
+            filelist = job["cmd"].split()[2].split("=")[1]
+            with open(filelist) as f:
+                archived.extend(f.readlines())
+            os.remove(filelist)
+
+        path_to_archive = os.path.join(self.dummy_config["path_to_archive_root"], "test_archive")
+        nbr_of_files_and_dirs = sum(len(dirs) + len(files) for _, dirs, files in os.walk(path_to_archive)) + 1
+        self.assertEqual(len(archived), nbr_of_files_and_dirs)
+
+        # What the job uploads is kept for the catalog and the manifest of the archive
+        manifest = Manifest.read(Manifest.pending_path_for(BaseDsmcHandler.manifest_dir(self.dummy_config), job_id))
+        self.assertEqual(len(manifest.files), len(scan_tree(path_to_archive)))
+
+    @mock.patch("dsmc.lib.jobrunner.LocalQAdapter.start", autospec=True)
+    def test_upload_with_invalid_sessions(self, mock_start):
+        for sessions in ("two", None, 0, [2]):
+            response = self.fetch(self.API_BASE + "/upload/test_archive", method="POST",
+                                  body=json_encode({"sessions": sessions}))
+            self.assertEqual(response.code, 400)
+
+        self.assertFalse(mock_start.called)
 
     @mock.patch("dsmc.handlers.dsmc_handlers.UploadHandler._is_valid_log_dir", autospec=True)
     def test_raise_exception_on_log_dir_problem(self, mock__is_valid_log_dir):
@@ -100,6 +189,43 @@ class TestDsmcHandlers(AsyncHTTPTestCase):
         self.assertEqual(json_resp["state"], State.DONE)
         mock_status.assert_called_with(self.runner_service, "1")
 
+    @mock.patch("dsmc.lib.jobrunner.LocalQAdapter.status", autospec=True)
+    def test_progress_of_a_finished_job_is_frozen(self, mock_status):
+        tmp_dir = tempfile.mkdtemp()
+        dsmc_log = os.path.join(tmp_dir, "dsmc.log")
+
+        with open(dsmc_log, "w") as f:
+            f.write("Normal File-->        40 /data/runfolder/a.txt [Sent]\n"
+                    "Total number of objects archived:        1")
+
+        try:
+            BaseDsmcHandler._progress[77] = DsmcProgress([dsmc_log], total_bytes=100)
+
+            mock_status.return_value = State.STARTED
+            response = self.fetch(self.API_BASE + "/status/77")
+            self.assertNotIn("summary", json.loads(response.body)["progress"])
+
+            # Every status request gets the final progress of a finished job, with the last line of its log
+            mock_status.return_value = State.DONE
+            first = json.loads(self.fetch(self.API_BASE + "/status/77").body)["progress"]
+            self.assertEqual(first["summary"], [{"total_number_of_objects_archived": "1"}])
+
+            with open(dsmc_log, "a") as f:
+                f.write("\nNormal File-->        40 /data/runfolder/b.txt [Sent]\n")
+
+            self.assertEqual(json.loads(self.fetch(self.API_BASE + "/status/77").body)["progress"], first)
+
+            # Only the latest finished jobs are remembered
+            with mock.patch.object(BaseDsmcHandler, "FINISHED_PROGRESS_KEPT", 0):
+                BaseDsmcHandler(self.get_app(), mock.MagicMock(), config=self.dummy_config,
+                                runner_service=self.runner_service).track_progress(78, [dsmc_log])
+
+            self.assertNotIn(77, BaseDsmcHandler._progress)
+            self.assertIn(78, BaseDsmcHandler._progress)
+        finally:
+            BaseDsmcHandler._progress.pop(78, None)
+            shutil.rmtree(tmp_dir)
+
     def test_create_dir(self): 
         archive_path = "./tests/resources/archives/testrunfolder_archive/"
 
@@ -115,6 +241,8 @@ class TestDsmcHandlers(AsyncHTTPTestCase):
         self.assertFalse(os.path.exists(os.path.join(archive_path, "directory1")))
         self.assertFalse(os.path.exists(os.path.join(archive_path, "directory2", "file.bar")))
         self.assertTrue(os.path.exists(os.path.join(archive_path, "directory2", "file.bin")))
+        self.assertEqual(json_resp["files"], 3)
+        self.assertEqual(json_resp["excluded"], 4)
 
         # Should fail due to folder already existing
         body = {"remove": "False", "exclude_dirs": "['foo', 'bar']", "exclude_extensions": "['.txt', '.bar']"}
@@ -135,9 +263,92 @@ class TestDsmcHandlers(AsyncHTTPTestCase):
         self.assertTrue(first_created_at < second_created_at)
         self.assertFalse(os.path.exists(os.path.join(archive_path, "remove-me")))
 
-        import shutil
         shutil.rmtree(archive_path)
+
+    def test_create_dir_with_patterns(self):
+        archive_path = "./tests/resources/archives/testrunfolder_archive/"
+
+        body = {"remove": "True", "exclude": ["directory3/**", "*.txt", "directory2/file.bin"]}
+        response = self.fetch(self.API_BASE + "/create_dir/testrunfolder", method="POST", body=json_encode(body))
+        json_resp = json.loads(response.body)
+
+        self.assertEqual(json_resp["state"], State.DONE)
+        self.assertItemsEqual(os.listdir(archive_path), ["directory2", "file.csv", "file.bin"])
+        self.assertEqual(os.listdir(os.path.join(archive_path, "directory2")), ["file.bar"])
+        self.assertEqual(json_resp["files"], 3)
+        self.assertEqual(json_resp["bytes"], sum(os.path.getsize(os.path.join(archive_path, path))
+                                                 for path in ["file.csv", "file.bin", "directory2/file.bar"]))
+
+        body = {"remove": "True", "exclude": ["re:("]}
+        response = self.fetch(self.API_BASE + "/create_dir/testrunfolder", method="POST", body=json_encode(body))
+        self.assertEqual(response.code, 400)
+
+        shutil.rmtree(archive_path)
+
+    def test_create_dir_dry_run(self):
+        archive_path = "./tests/resources/archives/testrunfolder_archive/"
+
+        body = {"dry_run": "True", "exclude_dirs": "['directory3']", "exclude_extensions": "['.txt']"}
+        response = self.fetch(self.API_BASE + "/create_dir/testrunfolder", method="POST", body=json_encode(body))
+        json_resp = json.loads(response.body)
+
+        self.assertEqual(json_resp["state"], State.DONE)
+        self.assertFalse(os.path.exists(archive_path))
+        self.assertFalse(json_resp["archive_exists"])
+        self.assertEqual(json_resp["files"], 4)
+        self.assertEqual(sum(size_class["files"] for size_class in json_resp["size_histogram"]), 4)
+        self.assertItemsEqual([largest["path"] for largest in json_resp["largest_files"]],
+                              ["file.csv", "file.bin", "directory2/file.bar", "directory2/file.bin"])
         
+    @mock.patch("dsmc.lib.jobrunner.LocalQAdapter.status_all", autospec=True)
+    def test_status_all_filtered_and_paged(self, mock_status_all):
+        mock_status_all.return_value = {1: State.DONE, 2: State.STARTED, 3: State.DONE, 4: State.ERROR, 5: State.DONE}
+
+        response = self.fetch(self.API_BASE + "/status/?state=done&state=error&offset=1&limit=2")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), {"3": {"state": State.DONE}, "4": {"state": State.ERROR}})
+        self.assertEqual(response.headers["X-Total-Count"], "4")
+
+        response = self.fetch(self.API_BASE + "/status/")
+        self.assertEqual(len(json.loads(response.body)), 5)
+
+        for query in ("offset=foo", "limit=1.5", "offset=-1", "limit=-2"):
+            response = self.fetch(self.API_BASE + "/status/?" + query)
+            self.assertEqual(response.code, 400)
+
+    @mock.patch("dsmc.lib.jobrunner.LocalQAdapter.warnings", autospec=True)
+    @mock.patch("dsmc.lib.jobrunner.LocalQAdapter.status", autospec=True)
+    def test_watch(self, mock_status, mock_warnings):
+        mock_status.return_value = State.STARTED
+        mock_warnings.return_value = {}
+
+        response = self.fetch(self.API_BASE + "/watch?job_id=1&job_id=2")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), {"1": {"state": State.STARTED, "warnings": {}},
+                                                     "2": {"state": State.STARTED, "warnings": {}}})
+        etag = response.headers["Etag"]
+
+        # Nothing changes before the timeout
+        response = self.fetch(self.API_BASE + "/watch?job_id=1&job_id=2&timeout=0.2",
+                              headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.headers["Etag"], etag)
+
+        # A change is returned as soon as it's seen
+        def status(runner_service, job_id):
+            return State.DONE if job_id == "2" else State.STARTED
+        mock_status.side_effect = status
+
+        response = self.fetch(self.API_BASE + "/watch?job_id=1&job_id=2&timeout=2",
+                              headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)["2"]["state"], State.DONE)
+        self.assertNotEqual(response.headers["Etag"], etag)
+
+        for query in ("timeout=soon", "timeout=nan", "timeout=-1", "job_id=foo"):
+            response = self.fetch(self.API_BASE + "/watch?" + query)
+            self.assertEqual(response.code, 400)
+
     @mock.patch("dsmc.lib.jobrunner.LocalQAdapter.start", autospec=True)
     def test_generate_checksum(self, mock_start):
         job_id = 42
@@ -150,36 +361,49 @@ class TestDsmcHandlers(AsyncHTTPTestCase):
         response = self.fetch(self.API_BASE + "/gen_checksums/test_archive", method="POST", allow_nonstandard_methods=True) #body=json_encode(body))
         json_resp = json.loads(response.body)
 
-        expected_cmd = "cd {} && /usr/bin/find -L . -type f ! -path '{}' -exec /usr/bin/md5sum {{}} + > {}".format(path_to_archive, filename, filename)
+        checksum_cache = os.path.abspath(os.path.join(self.dummy_config["dsmc_log_directory"], "checksum_cache.sqlite"))
+        expected_cmd = "{} -m dsmc.lib.checksums {} --output {} --workers 2 --cache {}".format(sys.executable, path_to_archive, filename, checksum_cache)
 
         self.assertEqual(json_resp["state"], State.STARTED)
         self.assertEqual(json_resp["job_id"], job_id)
-        mock_start.assert_called_with(self.runner_service, expected_cmd, run_dir=os.path.abspath(self.dummy_config["path_to_archive_root"]), nbr_of_cores=1, stderr=checksum_log, stdout=checksum_log)
+        mock_start.assert_called_with(self.runner_service, expected_cmd, run_dir=os.path.abspath(self.dummy_config["path_to_archive_root"]), nbr_of_cores=2, stderr=checksum_log, stdout=checksum_log,
+                                      resources={"checksum_workers": 2})
         #TODO: Check the existance of the md5sumfile. 
+
+    @mock.patch("dsmc.lib.jobrunner.LocalQAdapter.start", autospec=True)
+    def test_generate_checksum_with_several_digests(self, mock_start):
+        mock_start.return_value = 42
+
+        body = {"algorithms": ["md5", "sha256"], "check_gzip": True}
+        response = self.fetch(self.API_BASE + "/gen_checksums/test_archive", method="POST", body=json_encode(body))
+        json_resp = json.loads(response.body)
+
+        self.assertEqual(json_resp["state"], State.STARTED)
+        self.assertEqual(json_resp["checksum_files"], ["checksums_prior_to_pdc.md5", "checksums_prior_to_pdc.sha256"])
+        self.assertEqual(json_resp["gzip_report"], "checksums_prior_to_pdc.gzip_errors")
+
+        cmd = mock_start.call_args[0][1]
+        self.assertTrue(cmd.endswith("--algorithms md5 sha256 --check-gzip"))
+
+        body = {"algorithms": ["md4"]}
+        response = self.fetch(self.API_BASE + "/gen_checksums/test_archive", method="POST", body=json_encode(body))
+        self.assertEqual(response.code, 400)
     
     def test_reupload_handler(self):
         job_id = 27
       
         with \
             mock.patch \
-                ("dsmc.handlers.dsmc_handlers.ReuploadHelper.get_pdc_descr",\
-                autospec=True) as mock_get_pdc_descr, \
-            mock.patch \
-                ("dsmc.handlers.dsmc_handlers.ReuploadHelper.get_pdc_filelist",\
-                autospec=True) as mock_get_pdc_filelist, \
+                ("dsmc.handlers.dsmc_handlers.ReuploadHelper.get_pdc_latest_version",\
+                autospec=True) as mock_get_pdc_latest_version, \
             mock.patch \
                 ("dsmc.handlers.dsmc_handlers.ReuploadHelper.get_local_filelist",\
                 autospec=True) as mock_get_local_filelist, \
-            mock.patch \
-                ("dsmc.handlers.dsmc_handlers.ReuploadHelper.get_files_to_reupload",\
-                autospec=True) as mock_get_files_to_reupload, \
             mock.patch("dsmc.handlers.dsmc_handlers.ReuploadHelper.reupload",\
                 autospec=True) as mock_reupload:
 
-            mock_get_pdc_descr.return_value = "abc123"
-            mock_get_pdc_filelist.return_value = "{'foo': 123}"
-            mock_get_local_filelist.return_value = "{'foo': 123, 'bar': 456}"
-            mock_get_files_to_reupload.return_value = "{'bar': 456}"
+            mock_get_pdc_latest_version.return_value = "abc123", {'foo': 123}
+            mock_get_local_filelist.return_value = {'foo': 123, 'bar': 456}
             mock_reupload.return_value = job_id
             
             resp = self.fetch(self.API_BASE + "/reupload/test_archive", method="POST", 
@@ -188,6 +412,295 @@ class TestDsmcHandlers(AsyncHTTPTestCase):
         json_resp = json.loads(resp.body)
         self.assertEqual(json_resp["state"], State.STARTED)
         self.assertEqual(json_resp["job_id"], job_id)
+        self.assertEqual(mock_reupload.call_args[0][1], ["bar"])
+
+    def test_reupload_handler_does_not_block_other_requests(self):
+        finish_check = threading.Event()
+
+        def slow_check(*args):
+            finish_check.wait(10)
+            return "abc123", [], 0
+
+        def reuploaded(response):
+            reupload_responses.append(response)
+            self.stop()
+
+        with mock.patch("dsmc.handlers.dsmc_handlers.ReuploadHandler._find_files_to_reupload",
+                        side_effect=slow_check):
+            reupload_responses = []
+            self.http_client.fetch(self.get_url(self.API_BASE + "/reupload/test_archive"), reuploaded,
+                                   method="POST", allow_nonstandard_methods=True)
+
+            # The service answers while the reupload check is still running
+            response = self.fetch(self.API_BASE + "/version")
+            self.assertEqual(response.code, 200)
+            self.assertEqual(reupload_responses, [])
+
+            finish_check.set()
+            self.wait()
+
+        self.assertEqual(json.loads(reupload_responses[0].body)["state"], State.DONE)
+
+    def test_reupload_in_chunks(self):
+        path_to_archive = os.path.abspath(os.path.join(self.dummy_config["path_to_archive_root"], "test_archive"))
+
+        with \
+            mock.patch("dsmc.handlers.dsmc_handlers.ReuploadHelper.get_pdc_latest_version",
+                       autospec=True) as mock_get_pdc_latest_version, \
+            mock.patch("dsmc.lib.jobrunner.LocalQAdapter.start_group", autospec=True) as mock_start_group, \
+            mock.patch("dsmc.lib.jobrunner.LocalQAdapter.children", autospec=True) as mock_children:
+
+            # Nothing of the archive reached PDC
+            mock_get_pdc_latest_version.return_value = "abc123", {}
+            mock_start_group.return_value = 30
+            mock_children.return_value = [28, 29]
+
+            body = {"sessions": 2}
+            response = self.fetch(self.API_BASE + "/reupload/test_archive", method="POST", body=json_encode(body))
+            json_resp = json.loads(response.body)
+
+        self.assertEqual(response.code, 202)
+        self.assertEqual(json_resp["job_id"], 30)
+
+        chunks = json_resp["chunks"]
+        self.assertEqual([chunk["job_id"] for chunk in chunks], [28, 29])
+        self.assertEqual(json_resp["dsmc_log"], [chunk["dsmc_log"] for chunk in chunks])
+
+        jobs = mock_start_group.call_args[0][1]
+        reuploaded = []
+
+        for job, chunk in zip(jobs, chunks):
+            self.assertEqual(job["cmd"], "dsmc archive -filelist={} -description=abc123".format(chunk["filelist"]))
+            self.assertEqual(job["estimated_bytes"], chunk["bytes"])
+
+            # The filelists are kept, so that a chunk can be retried
+            with open(chunk["filelist"]) as f:
+                reuploaded.extend(line.strip().strip('"') for line in f)
+            os.remove(chunk["filelist"])
+
+        local_files = ReuploadHelper().get_local_filelist(path_to_archive)
+        self.assertItemsEqual(reuploaded, [path for path, _ in local_files.absolute_items()])
+        self.assertEqual(sum(chunk["bytes"] for chunk in chunks), local_files.total_bytes())
+
+    def test_retry_failed_chunk(self):
+        path_to_archive = os.path.join(self.dummy_config["path_to_archive_root"], "test_archive")
+        dsmc_log = os.path.join(self.dummy_config["dsmc_log_directory"], "dsmc_test_archive-chunk1")
+        filelist = "{}.filelist".format(dsmc_log)
+        cmd = "dsmc archive -filelist={} -description=abc123".format(filelist)
+
+        with open(filelist, "w") as f:
+            f.write('"{}"\n'.format(os.path.join(path_to_archive, "RunInfo.xml")))
+
+        job_store = JobStore(os.path.join(self.dummy_config["dsmc_log_directory"], "jobs.sqlite"))
+        job_store.add_job(8, cmd, "/tmp", dsmc_log)
+        job_store.add_group(9, [8])
+        job_store.describe(9, path_to_archive, "abc123")
+
+        try:
+            with \
+                mock.patch("dsmc.lib.jobrunner.LocalQAdapter.status", autospec=True) as mock_status, \
+                mock.patch("dsmc.lib.jobrunner.LocalQAdapter.start", autospec=True) as mock_start:
+
+                mock_status.return_value = State.DONE
+                response = self.fetch(self.API_BASE + "/retry/8", method="POST", allow_nonstandard_methods=True)
+                self.assertEqual(response.code, 404)
+
+                mock_status.return_value = State.ERROR
+                mock_start.return_value = 31
+                response = self.fetch(self.API_BASE + "/retry/8", method="POST", allow_nonstandard_methods=True)
+                json_resp = json.loads(response.body)
+        finally:
+            os.remove(filelist)
+
+        self.assertEqual(response.code, 202)
+        self.assertEqual(json_resp["job_id"], 31)
+        self.assertEqual(json_resp["retry_of"], 8)
+        self.assertEqual(mock_start.call_args[0][1], cmd)
+        self.assertTrue(mock_start.call_args[1]["stdout"].startswith(dsmc_log + "-retry-"))
+
+    def test_resume_interrupted_upload(self):
+        path_to_archive = os.path.join(self.dummy_config["path_to_archive_root"], "test_archive")
+
+        job_store = JobStore(os.path.join(self.dummy_config["dsmc_log_directory"], "jobs.sqlite"))
+        job_store.add_job(5, "dsmc archive", "/tmp", "dsmc.log")
+        job_store.describe(5, path_to_archive, "abc123")
+        job_store.mark_interrupted()
+
+        response = self.fetch(self.API_BASE + "/resume/")
+        self.assertEqual([job["job_id"] for job in json.loads(response.body)["resumable"]], [5])
+
+        with \
+            mock.patch("dsmc.handlers.dsmc_handlers.ReuploadHelper.get_pdc_filelist",
+                       autospec=True) as mock_get_pdc_filelist, \
+            mock.patch("dsmc.handlers.dsmc_handlers.ReuploadHelper.get_local_filelist",
+                       autospec=True) as mock_get_local_filelist, \
+            mock.patch("dsmc.handlers.dsmc_handlers.ReuploadHelper.reupload",
+                       autospec=True) as mock_reupload:
+
+            mock_get_pdc_filelist.return_value = {"foo": "123"}
+            mock_get_local_filelist.return_value = {"foo": "123", "bar": "456"}
+            mock_reupload.return_value = 27
+
+            response = self.fetch(self.API_BASE + "/resume/5", method="POST", allow_nonstandard_methods=True)
+            json_resp = json.loads(response.body)
+
+            self.assertEqual(response.code, 202)
+            self.assertEqual(json_resp["job_id"], 27)
+            self.assertEqual(mock_get_pdc_filelist.call_args[0][1:], (path_to_archive, "abc123"))
+            self.assertEqual(mock_reupload.call_args[0][1:3], (["bar"], "abc123"))
+
+        # It can only be resumed once
+        self.assertEqual(job_store.resumable(), [])
+        response = self.fetch(self.API_BASE + "/resume/5", method="POST", allow_nonstandard_methods=True)
+        self.assertEqual(response.code, 404)
+
+    def test_retrieve(self):
+        path_to_archive = os.path.abspath(os.path.join(self.dummy_config["path_to_archive_root"], "test_archive"))
+        archived = FileListing(path_to_archive, {"Data": 4096, "Data/a.bcl": 300, "Data/b.bcl": 200,
+                                                 "RunInfo.xml": 100, "checksums_prior_to_pdc.md5": 50})
+
+        with \
+            mock.patch("dsmc.handlers.dsmc_handlers.ReuploadHelper.get_pdc_latest_version",
+                       autospec=True) as mock_get_pdc_latest_version, \
+            mock.patch("dsmc.lib.jobrunner.LocalQAdapter.start_group", autospec=True) as mock_start_group, \
+            mock.patch("dsmc.lib.jobrunner.LocalQAdapter.start_after", autospec=True) as mock_start_after:
+
+            mock_get_pdc_latest_version.return_value = "abc123", archived
+            mock_start_group.return_value = 40
+            mock_start_after.return_value = 41
+
+            body = {"sessions": 2}
+            response = self.fetch(self.API_BASE + "/retrieve/test_archive", method="POST", body=json_encode(body))
+            json_resp = json.loads(response.body)
+
+        self.assertEqual(response.code, 202)
+        self.assertEqual(json_resp["job_id"], 40)
+        self.assertEqual(json_resp["verify_job_id"], 41)
+        self.assertEqual((json_resp["description"], json_resp["files"], json_resp["bytes"]), ("abc123", 4, 650))
+
+        jobs = mock_start_group.call_args[0][1]
+        retrieved = []
+
+        for job, dsmc_log in zip(jobs, json_resp["dsmc_log"]):
+            filelist = "{}.filelist".format(dsmc_log)
+            self.assertEqual(job["cmd"], "dsmc retrieve -filelist={} -description=abc123 -replace=no".format(filelist))
+
+            with open(filelist) as f:
+                retrieved.extend(line.strip().strip('"') for line in f)
+            os.remove(filelist)
+
+        # The directories are created by retrieving their files
+        self.assertEqual(len(jobs), 2)
+        self.assertItemsEqual(retrieved, [path for path, _ in archived.absolute_items()
+                                          if not path.endswith("/Data")])
+        self.assertItemsEqual([job["estimated_bytes"] for job in jobs], [300, 350])
+
+        # The files are checked once the whole group is done
+        after_job_id, cmd = mock_start_after.call_args[0][1:3]
+        self.assertEqual(after_job_id, 40)
+        self.assertTrue(cmd.endswith("-m dsmc.lib.checksums {} --output checksums_prior_to_pdc.md5 --workers 2 "
+                                     "--verify".format(path_to_archive)))
+
+    def test_retrieve_nothing_archived(self):
+        with mock.patch("dsmc.handlers.dsmc_handlers.ReuploadHelper.get_pdc_latest_version",
+                        autospec=True) as mock_get_pdc_latest_version:
+            mock_get_pdc_latest_version.return_value = None, FileListing("/")
+            response = self.fetch(self.API_BASE + "/retrieve/test_archive", method="POST",
+                                  allow_nonstandard_methods=True)
+
+        self.assertEqual(response.code, 404)
+
+    def test_verify(self):
+        path_to_archive_root = os.path.abspath(self.dummy_config["path_to_archive_root"])
+        dsmc_output = []
+
+        def archived(path, size, date, descr):
+            dsmc_output.append("{:>14}  B  {}    {} Never {}".format(size, date, path, descr))
+
+        for archive in ("test_archive", "test_archive_bak"):
+            local_files = ReuploadHelper().get_local_filelist(os.path.join(path_to_archive_root, archive))
+
+            for path, size in sorted(local_files.absolute_items()):
+                name = os.path.basename(path)
+
+                # In the latest upload of test_archive, RunInfo.xml is missing and SampleSheet.csv differs
+                if archive == "test_archive" and name == "RunInfo.xml":
+                    continue
+                if archive == "test_archive" and name == "SampleSheet.csv":
+                    size += 1
+
+                archived(path, size, "2017-07-27 17.48.34", "new-" + archive)
+                archived(path, size, "2017-01-10 16.47.24", "old-" + archive)
+
+        archived(os.path.join(path_to_archive_root, "archive_from_pdc", "file"), 1, "2017-07-27 17.48.34", "other")
+
+        self.scripts = mockprocess.MockProc()
+        self.scripts.append("dsmc", returncode=0, script="#!/bin/bash\ncat <<'EOF'\n{}\nEOF\n".format(
+            "\n".join(dsmc_output)))
+
+        body = {"archives": ["test_archive", "test_archive_bak"], "reupload": "True"}
+
+        with self.scripts, \
+                mock.patch("dsmc.handlers.dsmc_handlers.ReuploadHelper.reupload", autospec=True) as mock_reupload:
+            mock_reupload.return_value = 27
+            response = self.fetch(self.API_BASE + "/verify", method="POST", body=json_encode(body))
+
+        self.assertEqual(response.code, 200)
+        summaries = json.loads(response.body)["archives"]
+
+        self.assertEqual(summaries["test_archive"]["description"], "new-test_archive")
+        self.assertEqual(summaries["test_archive"]["missing"], 1)
+        self.assertEqual(summaries["test_archive"]["size_mismatches"], 1)
+        self.assertEqual(summaries["test_archive"]["job_id"], 27)
+        self.assertEqual(summaries["test_archive_bak"]["missing"], 0)
+        self.assertEqual(summaries["test_archive_bak"]["reupload_bytes"], 0)
+        self.assertNotIn("job_id", summaries["test_archive_bak"])
+
+        # Only test_archive is reuploaded, under the description of its latest upload
+        self.assertEqual(mock_reupload.call_count, 1)
+        reupload_files, descr = mock_reupload.call_args[0][1:3]
+        self.assertItemsEqual([os.path.basename(path) for path in reupload_files], ["RunInfo.xml", "SampleSheet.csv"])
+        self.assertEqual(descr, "new-test_archive")
+
+        response = self.fetch(self.API_BASE + "/verify", method="POST", body=json_encode({"archives": ["nope"]}))
+        self.assertEqual(response.code, 404)
+
+        # Only archives right below the archive root can be verified
+        body = {"archives": [".", "..", "test_archive/..", "test_archive/.", "/tmp", 3]}
+        response = self.fetch(self.API_BASE + "/verify", method="POST", body=json_encode(body))
+        self.assertEqual(response.code, 404)
+        self.assertEqual(json.loads(response.body)["not_found"], body["archives"])
+
+    def test_reupload_handler_unchanged_since_upload(self):
+        path_to_archive = os.path.abspath(os.path.join(self.dummy_config["path_to_archive_root"], "test_archive"))
+        manifest_dir = os.path.join(self.dummy_config["dsmc_log_directory"], "manifests")
+        os.mkdir(manifest_dir)
+
+        manifest, _ = Manifest.create(path_to_archive, "abc123")
+        manifest.write(Manifest.path_for(manifest_dir, path_to_archive))
+
+        with mock.patch("dsmc.handlers.dsmc_handlers.ReuploadHelper.get_pdc_latest_version",
+                        autospec=True) as mock_get_pdc_latest_version:
+            resp = self.fetch(self.API_BASE + "/reupload/test_archive", method="POST",
+                              allow_nonstandard_methods=True)
+
+        json_resp = json.loads(resp.body)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(json_resp["state"], State.DONE)
+        self.assertFalse(mock_get_pdc_latest_version.called)
+
+        # Unless PDC is to be checked again
+        with mock.patch("dsmc.handlers.dsmc_handlers.ReuploadHelper.get_pdc_latest_version",
+                        autospec=True) as mock_get_pdc_latest_version, \
+                mock.patch("dsmc.handlers.dsmc_handlers.ReuploadHelper.reupload", autospec=True) as mock_reupload:
+            mock_get_pdc_latest_version.return_value = ("abc123", FileListing(path_to_archive))
+            mock_reupload.return_value = 28
+            resp = self.fetch(self.API_BASE + "/reupload/test_archive", method="POST",
+                              body=json_encode({"refresh": "True"}))
+
+        self.assertEqual(resp.code, 202)
+        self.assertEqual(json.loads(resp.body)["job_id"], 28)
+        self.assertTrue(mock_get_pdc_latest_version.called)
 
     # Successful test
     # TODO: Write some failing tests 
@@ -215,7 +728,7 @@ cat tests/resources/dsmc_output/dsmc_pdc_filelist.txt
 """)
 
         with self.scripts:
-            filelist = helper.get_pdc_filelist("/data/mm-xart002/runfolders/johanhe_test_150821_M00485_0220_000000000-AG2UJ_archive", "e374bd6b-ab36-4f41-94d3-f4eaea9f30d4")
+            filelist = dict(helper.get_pdc_filelist("/data/mm-xart002/runfolders/johanhe_test_150821_M00485_0220_000000000-AG2UJ_archive", "e374bd6b-ab36-4f41-94d3-f4eaea9f30d4").absolute_items())
 
         with open("tests/resources/dsmc_output/dsmc_pdc_converted_filelist.txt") as f: 
             nr_of_files = 0
@@ -226,6 +739,101 @@ cat tests/resources/dsmc_output/dsmc_pdc_filelist.txt
 
             self.assertEqual(len(filelist.keys()), nr_of_files)
 
+    def test_get_pdc_latest_version(self):
+        self.scripts = mockprocess.MockProc()
+        helper = ReuploadHelper()
+        path_to_archive = "/data/mm-xart002/runfolders/johanhe_test_150821_M00485_0220_000000000-AG2UJ_archive"
+
+        # Three versions, listed out of order, with the latest one neither first nor last
+        self.scripts.append("dsmc", returncode=0,
+                            script="""#!/bin/bash
+cat tests/resources/dsmc_output/dsmc_all_versions.txt
+""")
+
+        catalog = ArchiveCatalog(os.path.join(self.dummy_config["dsmc_log_directory"], "pdc_catalog.sqlite"),
+                                 datetime.timedelta(days=1))
+
+        with self.scripts:
+            descr, filelist = helper.get_pdc_latest_version(path_to_archive, catalog=catalog)
+            descr_without_catalog, _ = helper.get_pdc_latest_version(path_to_archive)
+
+        self.assertEqual(descr, "e374bd6b-ab36-4f41-94d3-f4eaea9f30d4")
+        self.assertEqual(descr_without_catalog, descr)
+
+        with open("tests/resources/dsmc_output/dsmc_pdc_converted_filelist.txt") as f:
+            expected = dict((name, int(size)) for size, name in (line.split() for line in f))
+
+        # Paths are kept relative to the archive, which itself isn't listed
+        self.assertEqual(dict(filelist.absolute_items()), expected)
+        self.assertEqual(filelist["RunInfo.xml"], 0)
+
+        # The catalog gets every version from the same query, the archive itself isn't listed
+        self.assertEqual(catalog.latest_description(path_to_archive), descr)
+        self.assertEqual(len(catalog.filelist(path_to_archive, "a33623ba-55ad-4034-9222-dae8801aa65e")), 3)
+
+    def test_get_pdc_latest_version_leaves_out_siblings(self):
+        helper = ReuploadHelper()
+        catalog = ArchiveCatalog(os.path.join(self.dummy_config["dsmc_log_directory"], "pdc_catalog.sqlite"),
+                                 datetime.timedelta(days=1))
+
+        # foo_archive2 starts with the name of foo_archive, and was uploaded later
+        dsmc_output = "\n".join("{:>14}  B  {}    /data/runfolders/{} Never {}".format(size, date, path, descr)
+                                for size, date, path, descr in (
+                                    (4096, "2017-07-27 17.48.34", "foo_archive", "foo1"),
+                                    (1, "2017-07-27 17.48.34", "foo_archive/a", "foo1"),
+                                    (2, "2017-09-01 10.00.00", "foo_archive2/b", "foo2")))
+
+        self.scripts = mockprocess.MockProc()
+        self.scripts.append("dsmc", returncode=0, script="#!/bin/bash\ncat <<'EOF'\n{}\nEOF\n".format(dsmc_output))
+
+        with self.scripts:
+            descr, filelist = helper.get_pdc_latest_version("/data/runfolders/foo_archive", catalog=catalog)
+
+        self.assertEqual(descr, "foo1")
+        self.assertEqual(dict(filelist.iteritems()), {"a": 1})
+        self.assertEqual(catalog.latest_description("/data/runfolders/foo_archive"), "foo1")
+
+    def test_get_pdc_latest_versions_writes_each_archive_to_the_catalog(self):
+        helper = ReuploadHelper()
+        root = "/data/runfolders"
+        catalog = ArchiveCatalog(os.path.join(self.dummy_config["dsmc_log_directory"], "pdc_catalog.sqlite"),
+                                 datetime.timedelta(days=1))
+
+        # The objects of foo_archive are listed on both sides of those of bar_archive
+        dsmc_output = "\n".join("{:>14}  B  2017-07-27 17.48.34    {}/{} Never {}".format(size, root, path, descr)
+                                for size, path, descr in ((1, "foo_archive/a", "foo1"), (2, "bar_archive/b", "bar1"),
+                                                          (3, "foo_archive/c", "foo1"), (4, "other/d", "other")))
+
+        self.scripts = mockprocess.MockProc()
+        self.scripts.append("dsmc", returncode=0, script="#!/bin/bash\ncat <<'EOF'\n{}\nEOF\n".format(dsmc_output))
+
+        with self.scripts, mock.patch.object(catalog, "replace", wraps=catalog.replace) as mock_replace:
+            versions = helper.get_pdc_latest_versions(root, ["foo_archive", "bar_archive", "baz_archive"],
+                                                      catalog=catalog)
+
+        self.assertEqual(versions[root + "/foo_archive"][0], "foo1")
+        self.assertEqual(dict(versions[root + "/foo_archive"][1].iteritems()), {"a": 1, "c": 3})
+        self.assertEqual(versions[root + "/baz_archive"][0], None)
+
+        # Every archive is replaced once, as dsmc gets to it, and never uploaded ones are catalogued too
+        self.assertItemsEqual([call[0][0] for call in mock_replace.call_args_list],
+                              [root + "/foo_archive", root + "/bar_archive", root + "/baz_archive"])
+        self.assertEqual(dict(catalog.filelist(root + "/foo_archive", "foo1").iteritems()), {"a": 1, "c": 3})
+        self.assertEqual(dict(catalog.filelist(root + "/bar_archive", "bar1").iteritems()), {"b": 2})
+        self.assertTrue(catalog.is_fresh(root + "/baz_archive"))
+        self.assertFalse(catalog.is_fresh(root + "/other"))
+
+        # If dsmc fails half way, what was written can't be trusted
+        self.scripts = mockprocess.MockProc()
+        self.scripts.append("dsmc", returncode=12, script="#!/bin/bash\ncat <<'EOF'\n{}\nEOF\nexit 12\n".format(
+            dsmc_output))
+
+        with self.scripts, self.assertRaises(DsmcQueryError):
+            helper.get_pdc_latest_versions(root, ["foo_archive", "bar_archive"], catalog=catalog)
+
+        self.assertFalse(catalog.is_fresh(root + "/foo_archive"))
+        self.assertFalse(catalog.is_fresh(root + "/bar_archive"))
+
     def test_get_local_filelist(self):
         helper = ReuploadHelper()
         path = "tests/resources/archives/archive_from_pdc"
@@ -236,13 +844,13 @@ cat tests/resources/dsmc_output/dsmc_pdc_filelist.txt
         du_out, du_err = p.communicate()
         du_out = du_out.splitlines()
 
-        files = helper.get_local_filelist(path)
+        files = dict(helper.get_local_filelist(path).absolute_items())
 
         for line in du_out:
             size, filename = line.split()
             path = os.path.join(path, filename)
 
-            self.assertEqual(files[filename], size)
+            self.assertEqual(files[filename], int(size))
 
         self.assertEqual(len(files.keys()), len(du_out))
   
@@ -276,7 +884,8 @@ cat tests/resources/dsmc_output/dsmc_pdc_filelist.txt
         exp_id = 72
 
         class MyRunner(object):
-            def start(self, cmd, nbr_of_cores, run_dir, stdout=dsmc_log_file, stderr=dsmc_log_file): 
+            def start(self, cmd, nbr_of_cores, run_dir, stdout=dsmc_log_file, stderr=dsmc_log_file, resources=None,
+                      estimated_bytes=None):
                 self.components = cmd.split("=")
                 return exp_id
 
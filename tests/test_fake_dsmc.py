@@ -0,0 +1,83 @@
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+from dsmc.lib.progress import DsmcProgress
+from dsmc.lib.query import DsmcQuery
+from tests import fake_dsmc
+
+
+class TestFakeDsmc(unittest.TestCase):
+
+    ARCHIVE = "/fake/runfolders/synthetic_archive"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        self.cmd = "{} {}".format(sys.executable, os.path.abspath(fake_dsmc.__file__).replace(".pyc", ".py"))
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp_dir)
+
+    def query(self, locale):
+        os.environ["FAKE_DSMC_LOCALE"] = locale
+        os.environ["FAKE_DSMC_OBJECTS"] = "500"
+        os.environ["FAKE_DSMC_VERSIONS"] = "2"
+
+        return list(DsmcQuery("{} q ar {} -subdir=yes".format(self.cmd, self.ARCHIVE), path_prefix=self.ARCHIVE))
+
+    def test_query_locales(self):
+        space = self.query("space")
+        comma = self.query("comma")
+
+        files = [archived for archived in space if archived.size != fake_dsmc.DIR_SIZE]
+        expected = dict((os.path.join(self.ARCHIVE, rel_path), size)
+                        for rel_path, size in fake_dsmc.synthetic_files(500))
+
+        # Both versions of every file
+        self.assertEqual(len(files), 2 * 500)
+        self.assertEqual(dict((archived.path, archived.size) for archived in files), expected)
+        self.assertEqual(set(archived.description for archived in space),
+                         set(["fake-description-0000", "fake-description-0001"]))
+
+        self.assertEqual(space, comma)
+
+    def test_query_nothing_found(self):
+        query = DsmcQuery("{} q ar {} -description=foo".format(self.cmd, self.ARCHIVE))
+
+        self.assertEqual(list(query), [])
+        self.assertEqual(query.returncode, 8)
+        self.assertEqual(len(query.warnings), 1)
+
+    def test_warnings(self):
+        os.environ["FAKE_DSMC_WARNINGS"] = "3"
+        out = StringIO.StringIO()
+
+        self.assertEqual(fake_dsmc.main(["q", "ar", self.ARCHIVE, "-subdir=yes"], out), 8)
+        self.assertEqual(out.getvalue().count("ANS1809W"), 3)
+
+    def test_archive_progress(self):
+        os.environ["FAKE_DSMC_LOCALE"] = "space"
+        runfolder = os.path.join(self.tmp_dir, "runfolder")
+        os.makedirs(os.path.join(runfolder, "Data"))
+
+        for name, size in (("a.txt", 100), ("Data/b.bcl", 123456)):
+            with open(os.path.join(runfolder, name), "wb") as f:
+                f.truncate(size)
+
+        log_file = os.path.join(self.tmp_dir, "dsmc.log")
+
+        with open(log_file, "w") as log:
+            self.assertEqual(fake_dsmc.main(["archive", runfolder, "-subdir=yes"], log), 0)
+
+        progress = DsmcProgress([log_file], total_bytes=123556)
+        progress.update()
+
+        self.assertEqual(progress.files_done, 2)
+        self.assertEqual(progress.bytes_transferred, 123556)
+        self.assertEqual(progress.as_dict()["summary"][0]["total_number_of_objects_archived"], "4")
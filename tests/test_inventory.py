@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dsmc.lib.inventory import scan_tree
+
+
+class TestInventory(unittest.TestCase):
+
+    def test_scan_tree(self):
+        path = "tests/resources/testrunfolder"
+
+        expected = {}
+        for root, directories, filenames in os.walk(path):
+            for filename in filenames:
+                full_path = os.path.join(root, filename)
+                expected[full_path] = os.stat(full_path)
+
+        for workers in (1, 4):
+            inventory = scan_tree(path, workers=workers)
+
+            self.assertItemsEqual(inventory.keys(), expected.keys())
+            for full_path, local_file in inventory.iteritems():
+                self.assertEqual(local_file.size, expected[full_path].st_size)
+                self.assertEqual(local_file.inode, expected[full_path].st_ino)
+
+    def test_scan_tree_links(self):
+        tmp_dir = tempfile.mkdtemp()
+
+        try:
+            os.mkdir(os.path.join(tmp_dir, "real"))
+            with open(os.path.join(tmp_dir, "real", "file.txt"), "w") as f:
+                f.write("1234")
+
+            # A linked file is reported with the size of its target
+            os.symlink(os.path.join(tmp_dir, "real", "file.txt"), os.path.join(tmp_dir, "link.txt"))
+            # A linked directory is only followed on request, and loops are only followed once
+            os.symlink(os.path.join(tmp_dir, "real"), os.path.join(tmp_dir, "linked_dir"))
+            os.symlink(tmp_dir, os.path.join(tmp_dir, "real", "loop"))
+
+            inventory = scan_tree(tmp_dir, workers=2)
+            self.assertItemsEqual(inventory.keys(), [os.path.join(tmp_dir, "real", "file.txt"),
+                                                     os.path.join(tmp_dir, "link.txt")])
+            self.assertEqual(inventory[os.path.join(tmp_dir, "link.txt")].size, 4)
+
+            inventory = scan_tree(tmp_dir, workers=2, follow_links=True)
+            self.assertEqual(len(inventory), 3)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_scan_tree_missing_root(self):
+        with self.assertRaises(OSError):
+            scan_tree("tests/resources/non-existant", workers=2)
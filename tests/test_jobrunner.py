@@ -0,0 +1,269 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from arteria.web.state import State
+from localq.localQ_server import Status
+
+from dsmc.lib import jobrunner
+from dsmc.lib.jobrunner import JobScheduler, LocalQAdapter, WarningHistogram
+
+
+class TestLocalQAdapter(unittest.TestCase):
+
+    def test_combine_states(self):
+        self.assertEqual(LocalQAdapter.combine_states([State.DONE, State.DONE]), State.DONE)
+        self.assertEqual(LocalQAdapter.combine_states([State.DONE, State.STARTED, State.ERROR]), State.STARTED)
+        self.assertEqual(LocalQAdapter.combine_states([State.DONE, State.PENDING]), State.PENDING)
+        self.assertEqual(LocalQAdapter.combine_states([State.DONE, State.ERROR]), State.ERROR)
+        self.assertEqual(LocalQAdapter.combine_states([State.DONE, State.NONE]), State.ERROR)
+        self.assertEqual(LocalQAdapter.combine_states([State.DONE, State.CANCELLED]), State.CANCELLED)
+
+    def test_status_classifies_warnings_once(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        dsmc_log = os.path.join(tmp_dir, "dsmc.log")
+        with open(dsmc_log, "w") as f:
+            f.write("ANS1809W a session was lost\nANS1809W again\nANS2000W\n")
+
+        adapter = LocalQAdapter(nbr_of_cores=1, whitelisted_warnings='["ANS1809W", "ANS2000W"]', interval=3600)
+        adapter.server = mock.MagicMock()
+        adapter.server.add.return_value = 1
+        adapter.server.get_status.return_value = Status.FAILED
+        adapter.server.get_job_with_id.return_value.proc.returncode = 8
+
+        job_id = adapter.start("dsmc archive", 1, tmp_dir, stdout=dsmc_log, stderr=dsmc_log)
+
+        self.assertEqual(adapter.status(job_id), State.DONE)
+        self.assertEqual(adapter.warnings(job_id), {"ANS1809W": 2, "ANS2000W": 1})
+
+        # The log of a finished job isn't read again
+        with open(dsmc_log, "a") as f:
+            f.write("ANS9999W\n")
+
+        self.assertEqual(adapter.status(job_id), State.DONE)
+        self.assertEqual(adapter.warnings(job_id), {"ANS1809W": 2, "ANS2000W": 1})
+
+    def test_warning_histogram_is_incremental(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        dsmc_log = os.path.join(tmp_dir, "dsmc.log")
+        histogram = WarningHistogram(dsmc_log)
+
+        # The job hasn't written its log yet
+        self.assertEqual(histogram.update(), {})
+
+        with open(dsmc_log, "w") as f:
+            f.write("ANS1809W\nANS18")
+
+        self.assertEqual(histogram.update(), {"ANS1809W": 1})
+
+        with open(dsmc_log, "a") as f:
+            f.write("09W\nANS9999W")
+
+        self.assertEqual(histogram.update(final=True), {"ANS1809W": 2, "ANS9999W": 1})
+
+    def test_status_all_agrees_with_status(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        dsmc_log = os.path.join(tmp_dir, "dsmc.log")
+        with open(dsmc_log, "w") as f:
+            f.write("ANS1809W a session was lost\n")
+
+        adapter = LocalQAdapter(nbr_of_cores=1, whitelisted_warnings=["ANS1809W"], interval=3600)
+        adapter.server = mock.MagicMock()
+        adapter.server.add.side_effect = [1, 2]
+        adapter.server.get_status_all.return_value = {1: Status.FAILED, 2: Status.RUNNING}
+        adapter.server.get_job_with_id.return_value.proc.returncode = 8
+
+        finished = adapter.start("dsmc archive", 1, tmp_dir, stdout=dsmc_log, stderr=dsmc_log)
+        running = adapter.start("dsmc archive", 1, tmp_dir, stdout=dsmc_log, stderr=dsmc_log)
+
+        # Warnings that are whitelisted are rewritten to done here as well
+        self.assertEqual(adapter.status_all(), {finished: State.DONE, running: State.STARTED})
+
+        # The finished job is remembered, localq is only asked about the running one
+        adapter.server.get_status_all.return_value = {2: Status.COMPLETED}
+        self.assertEqual(adapter.status_all(), {finished: State.DONE, running: State.DONE})
+
+        adapter.server.get_status_all.reset_mock()
+        adapter.server.get_status.reset_mock()
+        self.assertEqual(adapter.status(finished), State.DONE)
+        self.assertEqual(adapter.status_all(), {finished: State.DONE, running: State.DONE})
+        self.assertFalse(adapter.server.get_status_all.called)
+        self.assertFalse(adapter.server.get_status.called)
+
+    def test_metrics_of_finished_jobs(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        dsmc_log = os.path.join(tmp_dir, "dsmc.log")
+        with open(dsmc_log, "w") as f:
+            f.write("Normal File-->               1,000 /data/runfolder/a.txt [Sent]\n"
+                    "Normal File-->               2 000 /data/runfolder/b.txt [Sent]\n"
+                    "ANS1809W a session was lost\n")
+
+        adapter = LocalQAdapter(nbr_of_cores=1, whitelisted_warnings=["ANS1809W"], interval=3600)
+        adapter.server = mock.MagicMock()
+        adapter.server.add.return_value = 1
+        adapter.server.get_job_with_id.return_value.proc.returncode = 8
+
+        files = jobrunner.FILES_ARCHIVED.labels().value
+        bytes_archived = jobrunner.BYTES_ARCHIVED.labels().value
+        warnings = jobrunner.DSMC_WARNINGS.labels("ANS1809W").value
+        return_codes = jobrunner.JOB_RETURN_CODES.labels("dsmc", "8").value
+        finished = jobrunner.JOBS_FINISHED.labels("dsmc", State.DONE).value
+        run_times = sum(jobrunner.JOB_RUN_SECONDS.labels("dsmc", State.DONE).counts)
+
+        job_id = adapter.start("dsmc archive", 1, tmp_dir, stdout=dsmc_log, stderr=dsmc_log)
+
+        adapter.server.get_status.return_value = Status.RUNNING
+        self.assertEqual(adapter.status(job_id), State.STARTED)
+        adapter.server.get_status.return_value = Status.FAILED
+        self.assertEqual(adapter.status(job_id), State.DONE)
+
+        # Asking again doesn't count the job twice
+        self.assertEqual(adapter.status(job_id), State.DONE)
+
+        self.assertEqual(jobrunner.FILES_ARCHIVED.labels().value - files, 2)
+        self.assertEqual(jobrunner.BYTES_ARCHIVED.labels().value - bytes_archived, 3000)
+        self.assertEqual(jobrunner.DSMC_WARNINGS.labels("ANS1809W").value - warnings, 1)
+        self.assertEqual(jobrunner.JOB_RETURN_CODES.labels("dsmc", "8").value - return_codes, 1)
+        self.assertEqual(jobrunner.JOBS_FINISHED.labels("dsmc", State.DONE).value - finished, 1)
+        self.assertEqual(sum(jobrunner.JOB_RUN_SECONDS.labels("dsmc", State.DONE).counts) - run_times, 1)
+
+    def test_scheduler_holds_jobs_until_resources_are_released(self):
+        adapter = LocalQAdapter(nbr_of_cores=1, whitelisted_warnings=[], interval=3600,
+                                scheduler=JobScheduler({"dsmc_sessions": 1}))
+        adapter.server = mock.MagicMock()
+        adapter.server.add.side_effect = [11, 12]
+        adapter.server.get_status.return_value = Status.COMPLETED
+        adapter.server.get_job_with_id.return_value.proc.returncode = 0
+
+        first = adapter.start("dsmc archive a", 1, "/tmp", resources={"dsmc_sessions": 1}, estimated_bytes=10)
+        second = adapter.start("dsmc archive b", 1, "/tmp", resources={"dsmc_sessions": 1}, estimated_bytes=10)
+
+        self.assertEqual(adapter.server.add.call_count, 1)
+        self.assertEqual(adapter.status(second), State.PENDING)
+        self.assertEqual(adapter.status_all()[second], State.PENDING)
+
+        # Once the first job has finished, the second one is handed to localq
+        self.assertEqual(adapter.status(first), State.DONE)
+        self.assertEqual(adapter.server.add.call_count, 2)
+        self.assertEqual(adapter.localq_jobs[second], 12)
+
+    def test_job_being_handed_to_localq_is_pending(self):
+        adapter = LocalQAdapter(nbr_of_cores=1, whitelisted_warnings=[], interval=3600,
+                                scheduler=JobScheduler({"dsmc_sessions": 1}))
+        adapter.server = mock.MagicMock()
+        adapter.server.get_status.return_value = Status.PENDING
+        states = []
+
+        # Another thread asks for the state of the group while localq is given its jobs
+        def add(cmd, *args, **kwargs):
+            if adapter.groups:
+                states.append((adapter.status(2), adapter.status(3)))
+            return 10 + len(states)
+
+        adapter.server.add.side_effect = add
+        group = adapter.start_group([{"cmd": "dsmc archive", "nbr_of_cores": 1, "run_dir": "/tmp",
+                                      "resources": {"dsmc_sessions": 1}} for _ in range(2)])
+        self.assertEqual(group, 3)
+
+        with adapter.scheduler_lock:
+            adapter.scheduler.release(1)
+        adapter._dispatch()
+
+        self.assertEqual(states, [(State.PENDING, State.PENDING)])
+        self.assertNotIn(group, adapter.final_states)
+
+    def test_start_after(self):
+        adapter = LocalQAdapter(nbr_of_cores=1, whitelisted_warnings=[], interval=3600)
+        adapter.server = mock.MagicMock()
+        adapter.server.add.side_effect = [11, 12, 13, 14]
+        adapter.server.get_job_with_id.return_value.proc.returncode = 1
+
+        retrieve = adapter.start_group([{"cmd": "dsmc retrieve", "nbr_of_cores": 1, "run_dir": "/tmp"}] * 2)
+        check = adapter.start_after(retrieve, "python -m dsmc.lib.checksums", 2, "/tmp")
+
+        # It waits until the whole group is done
+        adapter.server.get_status.side_effect = lambda localq_id: Status.COMPLETED if localq_id == 11 \
+            else Status.RUNNING
+        self.assertEqual(adapter.status(check), State.PENDING)
+        self.assertEqual(adapter.server.add.call_count, 2)
+
+        adapter.server.get_status.side_effect = lambda localq_id: Status.COMPLETED if localq_id < 13 \
+            else Status.RUNNING
+        self.assertEqual(adapter.status(check), State.STARTED)
+        self.assertEqual(adapter.server.add.call_args[0][:2], ("python -m dsmc.lib.checksums", 2))
+
+        # A job waiting for a job that fails is cancelled
+        failing = adapter.start("dsmc retrieve", 1, "/tmp")
+        never = adapter.start_after(failing, "python -m dsmc.lib.checksums", 2, "/tmp")
+
+        adapter.server.get_status.side_effect = lambda localq_id: Status.FAILED
+        self.assertEqual(adapter.status(never), State.CANCELLED)
+        self.assertEqual(adapter.status_all()[never], State.CANCELLED)
+        self.assertEqual(adapter.server.add.call_count, 4)
+
+
+class TestJobScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.scheduler = JobScheduler({"dsmc_sessions": 2, "bandwidth": None}, max_wait=100,
+                                      clock=lambda: self.now)
+
+    def test_smallest_jobs_first(self):
+        self.scheduler.submit(1, {"dsmc_sessions": 1}, estimated_bytes=None)
+        self.scheduler.submit(2, {"dsmc_sessions": 1}, estimated_bytes=1000)
+        self.scheduler.submit(3, {"dsmc_sessions": 1}, estimated_bytes=10)
+
+        self.assertEqual(self.scheduler.admit(), [3, 2])
+
+        self.scheduler.release(3)
+        self.assertEqual(self.scheduler.admit(), [1])
+
+    def test_capacity_is_respected(self):
+        self.scheduler.submit(1, {"dsmc_sessions": 2, "bandwidth": 500}, estimated_bytes=10)
+        self.scheduler.submit(2, {"dsmc_sessions": 1, "bandwidth": 500}, estimated_bytes=10)
+        self.scheduler.submit(3, {"checksum_workers": 8}, estimated_bytes=10)
+
+        # Unlimited resources, and resources without a limit, never hold a job back
+        self.assertEqual(self.scheduler.admit(), [1, 3])
+        self.assertEqual(self.scheduler.admit(), [])
+
+        self.scheduler.release(1)
+        self.assertEqual(self.scheduler.admit(), [2])
+
+    def test_job_larger_than_capacity_runs_alone(self):
+        self.scheduler.submit(1, {"dsmc_sessions": 4}, estimated_bytes=10)
+        self.scheduler.submit(2, {"dsmc_sessions": 1}, estimated_bytes=20)
+
+        self.assertEqual(self.scheduler.admit(), [1])
+        self.scheduler.release(1)
+        self.assertEqual(self.scheduler.admit(), [2])
+
+    def test_starved_job_goes_first(self):
+        self.scheduler.submit(1, {"dsmc_sessions": 2}, estimated_bytes=10)
+        self.assertEqual(self.scheduler.admit(), [1])
+
+        self.scheduler.submit(2, {"dsmc_sessions": 2}, estimated_bytes=1000)
+        self.now = 200
+        self.scheduler.submit(3, {"dsmc_sessions": 1}, estimated_bytes=10)
+        self.scheduler.release(1)
+
+        # The large job has waited too long, so the small one waits behind it
+        self.assertEqual(self.scheduler.admit(), [2])
+        self.scheduler.release(2)
+        self.assertEqual(self.scheduler.admit(), [3])
+
+    def test_release_waiting_job(self):
+        self.scheduler.submit(1, {"dsmc_sessions": 1})
+        self.assertTrue(self.scheduler.release(1))
+        self.assertEqual(self.scheduler.admit(), [])
@@ -0,0 +1,94 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from arteria.web.state import State
+from localq.localQ_server import Status
+
+from dsmc.lib.jobrunner import LocalQAdapter
+from dsmc.lib.jobstore import JobStore
+
+
+class TestJobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "jobs.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def adapter(self):
+        adapter = LocalQAdapter(nbr_of_cores=1, whitelisted_warnings=[], interval=3600,
+                                 job_store=JobStore(self.db_path))
+        adapter.server = mock.MagicMock()
+        adapter.server.add.side_effect = range(1, 100)
+        return adapter
+
+    def test_jobs_survive_a_restart(self):
+        adapter = self.adapter()
+        adapter.server.get_status.return_value = Status.COMPLETED
+
+        done = adapter.start("md5sum", 1, self.tmp_dir)
+        self.assertEqual(adapter.status(done), State.DONE)
+
+        shards = [{"cmd": "dsmc archive", "nbr_of_cores": 1, "run_dir": self.tmp_dir} for _ in range(2)]
+        upload = adapter.start_group(shards)
+        JobStore(self.db_path).describe(upload, "/data/runfolder_archive", "descr")
+
+        # The service is restarted while the upload is running
+        adapter = self.adapter()
+
+        self.assertEqual(adapter.status(done), State.DONE)
+        self.assertEqual(adapter.status(upload), State.ERROR)
+        self.assertEqual(adapter.status_all(), {done: State.DONE, upload: State.ERROR,
+                                                upload - 1: State.ERROR, upload - 2: State.ERROR})
+
+        # Job ids carry on where they were
+        self.assertEqual(adapter.start("md5sum", 1, self.tmp_dir), upload + 1)
+
+        job_store = JobStore(self.db_path)
+        resumable = job_store.resumable()
+        self.assertEqual([(job["job_id"], job["archive"], job["description"]) for job in resumable],
+                         [(upload, "/data/runfolder_archive", "descr")])
+
+        job_store.mark_resumed(upload, upload + 2)
+        self.assertEqual(job_store.resumable(), [])
+
+    def test_finished_group_survives_a_restart_without_being_polled(self):
+        adapter = self.adapter()
+        adapter.server.get_status.return_value = Status.COMPLETED
+        finished = []
+        adapter.add_finished_callback(lambda job_id, state: finished.append((job_id, state)))
+
+        shards = [{"cmd": "dsmc archive", "nbr_of_cores": 1, "run_dir": self.tmp_dir} for _ in range(2)]
+        upload = adapter.start_group(shards)
+        JobStore(self.db_path).describe(upload, "/data/runfolder_archive", "descr")
+
+        # The monitor sees the shards finish, nobody asks for the status of the upload
+        adapter.check_jobs()
+        self.assertEqual(finished, [(upload - 2, State.DONE), (upload - 1, State.DONE), (upload, State.DONE)])
+
+        adapter.check_jobs()
+        self.assertEqual(len(finished), 3)
+
+        adapter = self.adapter()
+
+        self.assertEqual(adapter.status(upload), State.DONE)
+        self.assertEqual(JobStore(self.db_path).resumable(), [])
+
+    def test_job_is_described_by_its_group(self):
+        job_store = JobStore(self.db_path)
+        job_store.add_job(1, "dsmc archive -filelist=chunk0", self.tmp_dir, "dsmc.log-chunk0")
+        job_store.add_job(2, "dsmc archive -filelist=chunk1", self.tmp_dir, "dsmc.log-chunk1")
+        job_store.add_group(3, [1, 2])
+        job_store.describe(3, "/data/runfolder_archive", "descr")
+        job_store.set_state(2, State.ERROR)
+
+        job = job_store.job(2)
+        self.assertEqual((job["cmd"], job["stdout"], job["parent"], job["state"]),
+                         ("dsmc archive -filelist=chunk1", "dsmc.log-chunk1", 3, State.ERROR))
+        self.assertEqual((job["archive"], job["description"]), ("/data/runfolder_archive", "descr"))
+        self.assertIsNone(job_store.job(4))
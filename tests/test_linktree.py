@@ -0,0 +1,123 @@
+import mock
+import os
+import tarfile
+import shutil
+import tempfile
+import unittest
+
+from dsmc.lib.linktree import ExcludePatterns, create_link_tree, plan_link_tree
+
+
+class TestLinkTree(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+        self.src = os.path.join(self.tmp_dir, "runfolder")
+        self.dest = os.path.join(self.tmp_dir, "runfolder_archive")
+
+        for path in ["RunInfo.xml", "Thumbnail_Images/L001/C1.1/s_1_a.jpg", "Data/Intensities/L001/C1.1/s_1.cif",
+                     "Data/Intensities/L001/s_1.filter", "Data/Intensities/L002/s_2.filter",
+                     "Unaligned/Project_A/Sample_1/sample_1.fastq.gz", "Unaligned/Project_A/Sample_1/core",
+                     "Logs/log.txt"]:
+            full_path = os.path.join(self.src, path)
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            with open(full_path, "w") as f:
+                f.write("1234")
+
+        os.mkdir(self.dest)
+
+    def linked(self):
+        return sorted(os.path.relpath(os.path.join(root, name), self.dest)
+                      for root, _, names in os.walk(self.dest) for name in names)
+
+    def test_create_link_tree(self):
+        stats = create_link_tree(self.src, self.dest, workers=2)
+
+        self.assertEqual(stats.files, 8)
+        self.assertEqual(stats.bytes, 32)
+        self.assertEqual(stats.excluded, 0)
+        self.assertTrue(os.path.islink(os.path.join(self.dest, "RunInfo.xml")))
+        self.assertEqual(os.readlink(os.path.join(self.dest, "RunInfo.xml")), os.path.join(self.src, "RunInfo.xml"))
+
+    def test_exclude_patterns(self):
+        excludes = ExcludePatterns(["Thumbnail_Images/**", "*.cif", "Data/Intensities/L002", "core", "re:.*\\.txt"],
+                                   exclude_dirs=["Logs"], exclude_extensions=[".xml"])
+
+        stats = create_link_tree(self.src, self.dest, excludes)
+
+        self.assertEqual(self.linked(), ["Data/Intensities/L001/s_1.filter",
+                                         "Unaligned/Project_A/Sample_1/sample_1.fastq.gz"])
+        self.assertEqual(stats.files, 2)
+        self.assertEqual(stats.bytes, 8)
+        self.assertEqual(stats.excluded, 6)
+        # Excluded directories aren't created at all
+        self.assertFalse(os.path.exists(os.path.join(self.dest, "Thumbnail_Images")))
+
+    def test_globs(self):
+        excludes = ExcludePatterns(["Data/*/L00?/C*", "**/Sample_1/*.fastq.gz", "Unaligned/Project_[AB]/"])
+        self.assertEqual(excludes.regexes["dir"].match("Data/Intensities/L001/C1.1").group(0),
+                         "Data/Intensities/L001/C1.1")
+        self.assertFalse(excludes.regexes["dir"].match("Data/Intensities/L001/x/C1.1"))
+
+        create_link_tree(self.src, self.dest, excludes)
+
+        self.assertEqual(self.linked(), ["Data/Intensities/L001/s_1.filter", "Data/Intensities/L002/s_2.filter",
+                                         "Logs/log.txt", "RunInfo.xml", "Thumbnail_Images/L001/C1.1/s_1_a.jpg"])
+
+    def test_multi_part_suffix(self):
+        excludes = ExcludePatterns(["*.fastq.gz"])
+        self.assertEqual(excludes.excludes("sample_1.fastq.gz", "sample_1.fastq.gz", False, excludes.root())[0], True)
+        self.assertEqual(excludes.excludes("sample_1.gz", "sample_1.gz", False, excludes.root())[0], False)
+
+    def test_linked_directories_are_followed(self):
+        os.symlink(os.path.join(self.src, "Unaligned"), os.path.join(self.src, "Unaligned_link"))
+        os.symlink(self.src, os.path.join(self.src, "Logs", "loop"))
+
+        stats = create_link_tree(self.src, self.dest)
+
+        self.assertEqual(stats.files, 10)
+        self.assertTrue(os.path.isdir(os.path.join(self.dest, "Unaligned_link", "Project_A")))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, "Logs", "loop")))
+
+    def test_plan_link_tree(self):
+        with open(os.path.join(self.src, "Unaligned", "large.fastq.gz"), "w") as f:
+            f.write("x" * 2048)
+
+        plan = plan_link_tree(self.src, ExcludePatterns(["Thumbnail_Images/"]), largest=2)
+
+        self.assertEqual(os.listdir(self.dest), [])
+        self.assertEqual(plan["files"], 8)
+        self.assertEqual(plan["bytes"], 7 * 4 + 2048)
+        self.assertEqual(plan["excluded"], 1)
+        self.assertEqual([(size_class["files"], size_class["bytes"]) for size_class in plan["size_histogram"][:3]],
+                         [(7, 28), (1, 2048), (0, 0)])
+        self.assertEqual(plan["largest_files"][0], {"path": "Unaligned/large.fastq.gz", "bytes": 2048})
+        self.assertEqual(len(plan["largest_files"]), 2)
+
+    def test_bundle_small_files(self):
+        with open(os.path.join(self.src, "Unaligned", "large.fastq.gz"), "w") as f:
+            f.write("x" * 2048)
+
+        stats = create_link_tree(self.src, self.dest, ExcludePatterns(["Logs/"]), bundle_below=1024)
+
+        self.assertEqual(self.linked(), ["Unaligned/large.fastq.gz", "small_files.index", "small_files_0001.tar"])
+        self.assertEqual((stats.files, stats.bundled_files, stats.bundled_bytes, stats.bundles), (1, 7, 28, 1))
+
+        with tarfile.open(os.path.join(self.dest, "small_files_0001.tar")) as tar:
+            self.assertIn("Unaligned/Project_A/Sample_1/core", tar.getnames())
+
+        plan = plan_link_tree(self.src, ExcludePatterns(["Logs/"]), bundle_below=1024)
+        self.assertEqual((plan["files"], plan["bundled_files"], plan["bundles"]), (1, 7, 1))
+        self.assertEqual(sum(size_class["files"] for size_class in plan["size_histogram"]), 8)
+
+    def test_bundles_that_dont_match_their_index_fail_the_tree(self):
+        with mock.patch("dsmc.lib.linktree.verify_bundles", autospec=True) as mock_verify_bundles:
+            mock_verify_bundles.return_value = [("Unaligned/Project_A/Sample_1/core", "md5 differs")]
+
+            with self.assertRaises(IOError):
+                create_link_tree(self.src, self.dest, ExcludePatterns(["Logs/"]), bundle_below=1024)
+
+        mock_verify_bundles.assert_called_once_with(self.dest)
@@ -0,0 +1,49 @@
+import unittest
+
+from dsmc.lib.inventory import LocalFile
+from dsmc.lib.listing import FileListing, as_listing, diff_listings
+
+
+class TestFileListing(unittest.TestCase):
+
+    ARCHIVE = "/data/mm-xart002/runfolders/foo_archive"
+
+    def test_paths_are_relative_to_the_archive(self):
+        listing = FileListing(self.ARCHIVE + "/")
+
+        self.assertTrue(listing.add(self.ARCHIVE + "/Data/a.bcl", 10))
+        self.assertTrue(listing.add(self.ARCHIVE + "/RunInfo.xml", 20))
+
+        # The archive itself, and siblings with the same prefix, aren't part of it
+        self.assertFalse(listing.add(self.ARCHIVE, 4096))
+        self.assertFalse(listing.add(self.ARCHIVE + "_bak/RunInfo.xml", 20))
+
+        self.assertEqual(dict(listing.iteritems()), {"Data/a.bcl": 10, "RunInfo.xml": 20})
+        self.assertEqual(listing.absolute("Data/a.bcl"), self.ARCHIVE + "/Data/a.bcl")
+        self.assertEqual(listing.total_bytes(), 30)
+        self.assertEqual(listing.total_bytes(["RunInfo.xml"]), 20)
+
+    def test_from_inventory(self):
+        inventory = {self.ARCHIVE + "/a.txt": LocalFile(5, 0, 1, 1)}
+        listing = FileListing.from_inventory(self.ARCHIVE, inventory)
+
+        self.assertEqual(dict(listing.absolute_items()), {self.ARCHIVE + "/a.txt": 5})
+
+    def test_as_listing(self):
+        listing = as_listing({"foo": "23"})
+
+        self.assertEqual(listing["foo"], 23)
+        self.assertEqual(listing.absolute("foo"), "foo")
+        self.assertIs(as_listing(listing), listing)
+
+    def test_diff(self):
+        local = FileListing(self.ARCHIVE, {"a.txt": 1, "b.txt": 2, "Data/c.bcl": 3})
+        remote = FileListing(self.ARCHIVE, {"a.txt": 1, "b.txt": 20, "Data": 4096, "Data/d.bcl": 4, "Empty": 4096})
+
+        difference = diff_listings(local, remote)
+
+        self.assertEqual(difference.missing, ["Data/c.bcl"])
+        self.assertEqual(difference.size_mismatch, ["b.txt"])
+
+        # Directories with anything in them aren't reported as only found in PDC
+        self.assertEqual(difference.remote_only, ["Data/d.bcl", "Empty"])
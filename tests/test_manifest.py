@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from dsmc.lib.inventory import scan_tree
+from dsmc.lib.manifest import Manifest
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.tmp_dir, "foo_archive")
+        shutil.copytree("tests/resources/testrunfolder", self.archive)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_and_read(self):
+        manifest, inventory = Manifest.create(self.archive, "descr", workers=2)
+        path = Manifest.path_for(self.tmp_dir, self.archive)
+        manifest.write(path)
+
+        self.assertEqual(path, os.path.join(self.tmp_dir, "foo_archive.manifest.gz"))
+
+        read_manifest = Manifest.read(path)
+        self.assertEqual(read_manifest.root, self.archive)
+        self.assertEqual(read_manifest.description, "descr")
+        self.assertEqual(read_manifest.dirs, manifest.dirs)
+        self.assertEqual(read_manifest.files, manifest.files)
+        self.assertEqual(len(read_manifest.files), len(inventory))
+
+    def test_incremental_scan(self):
+        manifest, inventory = Manifest.create(self.archive, "descr")
+
+        new_inventory, changed = manifest.incremental_scan(workers=2)
+        self.assertEqual(new_inventory, inventory)
+        self.assertEqual(changed, set())
+
+        # Make sure that the directory mtime differs from the one in the manifest
+        time.sleep(0.01)
+        new_file = os.path.join(self.archive, "directory2", "new.txt")
+        with open(new_file, "w") as f:
+            f.write("new")
+
+        new_inventory, changed = manifest.incremental_scan(workers=2)
+        self.assertEqual(changed, set([new_file]))
+        self.assertEqual(new_inventory, scan_tree(self.archive))
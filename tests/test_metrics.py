@@ -0,0 +1,55 @@
+import unittest
+
+from dsmc.lib.metrics import Registry
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter("jobs_total", "Jobs", ["state"])
+        counter.labels("done").inc()
+        counter.labels("done").inc(2)
+        counter.labels("error").inc()
+
+        self.assertEqual(self.registry.expose(),
+                         "# HELP jobs_total Jobs\n"
+                         "# TYPE jobs_total counter\n"
+                         'jobs_total{state="done"} 3.0\n'
+                         'jobs_total{state="error"} 1.0\n')
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("stage_seconds", "Seconds", ["stage"], buckets=[1, 10])
+
+        for value in (0.5, 1, 5, 100):
+            histogram.labels("diff").observe(value)
+
+        self.assertEqual(self.registry.expose().splitlines()[2:],
+                         ['stage_seconds_bucket{stage="diff",le="1.0"} 2.0',
+                          'stage_seconds_bucket{stage="diff",le="10.0"} 3.0',
+                          'stage_seconds_bucket{stage="diff",le="+Inf"} 4.0',
+                          'stage_seconds_sum{stage="diff"} 106.5',
+                          'stage_seconds_count{stage="diff"} 4.0'])
+
+    def test_timer(self):
+        histogram = self.registry.histogram("stage_seconds", "Seconds", ["stage"])
+
+        with histogram.labels("diff").time():
+            pass
+
+        self.assertEqual(sum(histogram.labels("diff").counts), 1)
+
+    def test_labels(self):
+        counter = self.registry.counter("requests_total", "Requests", ["handler", "code"])
+
+        # The same metric is returned when registered again
+        self.assertIs(self.registry.counter("requests_total", "Requests", ["handler", "code"]), counter)
+        self.assertIs(counter.labels("verify", "200"), counter.labels("verify", "200"))
+
+        with self.assertRaises(ValueError):
+            counter.labels("verify")
+
+        counter.labels('a "quoted"\nhandler', "200").inc()
+        self.assertIn('requests_total{handler="a \\"quoted\\"\\nhandler",code="200"} 1.0', self.registry.expose())
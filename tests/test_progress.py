@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dsmc.lib.progress import DsmcProgress
+
+
+class TestDsmcProgress(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.tmp_dir, "dsmc.log")
+        self.now = 1000.0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def clock(self):
+        return self.now
+
+    def append(self, text):
+        with open(self.log_file, "a") as f:
+            f.write(text)
+
+    def test_progress(self):
+        progress = DsmcProgress([self.log_file], total_bytes=4000, clock=self.clock)
+
+        # Nothing has been logged yet
+        progress.update()
+        self.assertEqual(progress.as_dict()["files_done"], 0)
+        self.assertEqual(progress.as_dict()["eta_seconds"], None)
+
+        self.now += 10
+        self.append("Archive function invoked.\n"
+                    "Directory-->                 4,096 /data/runfolder [Sent]\n"
+                    "Normal File-->               1,000 /data/runfolder/a.txt [Sent]\n"
+                    "Normal File-->               1,000 /data/runfolder/b")
+        progress.update()
+
+        # The line that is still being written isn't counted yet
+        self.assertEqual(progress.files_done, 1)
+        self.assertEqual(progress.bytes_transferred, 1000)
+        self.assertEqual(progress.throughput(), 100.0)
+        self.assertEqual(progress.eta(), 30.0)
+
+        self.now += 10
+        self.append(".txt [Sent]\n")
+        progress.update()
+
+        self.assertEqual(progress.files_done, 2)
+        self.assertEqual(progress.bytes_transferred, 2000)
+        self.assertEqual(progress.eta(), 20.0)
+
+    def test_sent_bytes(self):
+        self.assertEqual(DsmcProgress.sent_bytes("Normal File-->        40 960 /data/runfolder/a.txt [Sent]"), 40960)
+        self.assertIsNone(DsmcProgress.sent_bytes("Directory-->          4,096 /data/runfolder [Sent]"))
+        self.assertIsNone(DsmcProgress.sent_bytes("Normal File-->        40,960 /data/runfolder/a.txt ** Unsuccessful **"))
+
+    def test_summary(self):
+        progress = DsmcProgress([self.log_file], clock=self.clock)
+
+        self.append("Normal File-->               1,000 /data/runfolder/a.txt [Sent]\n"
+                    "Archive processing of '/data/runfolder/*' finished without failure.\n"
+                    "\n"
+                    "Total number of objects archived:         1\n"
+                    "Total number of bytes transferred:     1000  B\n"
+                    "Elapsed processing time:           00:00:05\n")
+        self.now += 5
+        progress.update()
+
+        as_dict = progress.as_dict()
+        self.assertEqual(as_dict["files_done"], 1)
+        self.assertEqual(as_dict["total_bytes"], None)
+        self.assertEqual(as_dict["summary"], [{"total_number_of_objects_archived": "1",
+                                               "total_number_of_bytes_transferred": "1000  B",
+                                               "elapsed_processing_time": "00:00:05"}])
+
+    def test_throughput_window(self):
+        progress = DsmcProgress([self.log_file], clock=self.clock)
+
+        # A fast start, then nothing for a long time
+        self.now += 10
+        self.append("Normal File-->         100,000 /data/runfolder/a.txt [Sent]\n")
+        progress.update()
+
+        for _ in range(10):
+            self.now += 30
+            progress.update()
+
+        self.assertEqual(progress.throughput(), 0.0)
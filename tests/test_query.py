@@ -0,0 +1,89 @@
+import datetime
+import unittest
+
+from mockproc import mockprocess
+
+from dsmc.lib.query import DsmcQuery, DsmcQueryError, parse_line
+
+
+class TestQuery(unittest.TestCase):
+
+    ARCHIVE = "/data/mm-xart002/runfolders/johanhe_test_150821_M00485_0220_000000000-AG2UJ_archive"
+
+    def test_parse_line_space_separated(self):
+        line = "        14 861  B  2017-07-27 17.48.34    {}/foo.tar.gz Never e374bd6b-ab36-4f41-94d3-f4eaea9f30d4".format(self.ARCHIVE)
+        archived = parse_line(line)
+
+        self.assertEqual(archived.size, 14861)
+        self.assertEqual(archived.archived_at, datetime.datetime(2017, 7, 27, 17, 48, 34))
+        self.assertEqual(archived.path, "{}/foo.tar.gz".format(self.ARCHIVE))
+        self.assertEqual(archived.description, "e374bd6b-ab36-4f41-94d3-f4eaea9f30d4")
+
+    def test_parse_line_comma_separated(self):
+        line = "4,096  B  01/10/2017 16:47:24    {} Never a33623ba-55ad-4034-9222-dae8801aa65e".format(self.ARCHIVE)
+        archived = parse_line(line)
+
+        self.assertEqual(archived.size, 4096)
+        self.assertEqual(archived.archived_at, datetime.datetime(2017, 1, 10, 16, 47, 24))
+        self.assertEqual(archived.path, self.ARCHIVE)
+        self.assertEqual(archived.description, "a33623ba-55ad-4034-9222-dae8801aa65e")
+
+    def test_parse_line_not_matching(self):
+        self.assertIsNone(parse_line("             Size  Archive Date - Time    File - Expires on - Description"))
+        self.assertIsNone(parse_line(" test with compression"))
+
+    def test_parse_line_day_first(self):
+        line = "4,096  B  27/07/2017 16:47:24    {} Never a33623ba-55ad-4034-9222-dae8801aa65e".format(self.ARCHIVE)
+        self.assertIsNone(parse_line(line))
+
+    def test_query(self):
+        scripts = mockprocess.MockProc()
+        scripts.append("dsmc", returncode=0,
+                       script="""#!/bin/bash
+cat tests/resources/dsmc_output/dsmc_pdc_filelist.txt
+""")
+
+        with scripts:
+            query = DsmcQuery("dsmc q ar {} -subdir=yes".format(self.ARCHIVE), path_prefix=self.ARCHIVE)
+            archived = list(query)
+
+        self.assertEqual(len(archived), 18)
+        self.assertEqual(query.returncode, 0)
+
+    def test_query_error(self):
+        scripts = mockprocess.MockProc()
+        scripts.append("dsmc", returncode=12,
+                       script="""#!/bin/bash
+echo "ANS1017E Session rejected: TCP/IP connection failure."
+exit 12
+""")
+
+        with scripts:
+            query = DsmcQuery("dsmc q ar {}".format(self.ARCHIVE))
+
+            with self.assertRaises(DsmcQueryError) as context:
+                list(query)
+
+        self.assertEqual(context.exception.returncode, 12)
+        self.assertEqual(len(context.exception.errors), 1)
+
+    def test_query_with_unparsable_objects(self):
+        scripts = mockprocess.MockProc()
+        scripts.append("dsmc", returncode=0,
+                       script="""#!/bin/bash
+echo "4,096  B  01/10/2017 16:47:24    {0}/a Never descr"
+echo "4,096  B  27/07/2017 16:47:24    {0}/b Never descr"
+echo "4,096  B  27.07.2017 16:47:24    {0}/c Never descr"
+""".format(self.ARCHIVE))
+
+        with scripts:
+            query = DsmcQuery("dsmc q ar {}".format(self.ARCHIVE))
+
+            with self.assertRaises(DsmcQueryError) as context:
+                list(query)
+
+        self.assertIn("-dateformat=3", query.cmd)
+        self.assertEqual(query.unparsed, 2)
+        self.assertEqual(context.exception.errors,
+                         ["2 archived objects could not be parsed, e.g. '4,096  B  27/07/2017 16:47:24    "
+                          "{}/b Never descr'".format(self.ARCHIVE)])
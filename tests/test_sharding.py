@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from dsmc.lib.sharding import balance_by_bytes, read_filelist, start_sharded, write_filelist
+
+
+class TestSharding(unittest.TestCase):
+
+    def test_balance_by_bytes(self):
+        files = [("a", 100), ("b", 100), ("c", 50), ("d", 50), ("e", 30), ("f", 30)]
+        shards = balance_by_bytes(files, 2)
+
+        sizes = dict(files)
+        self.assertEqual(len(shards), 2)
+        self.assertItemsEqual([path for shard in shards for path in shard], sizes.keys())
+        self.assertItemsEqual([sum(sizes[path] for path in shard) for shard in shards], [180, 180])
+
+    def test_balance_by_bytes_few_files(self):
+        shards = balance_by_bytes([("a", 100)], 4)
+        self.assertEqual(shards, [["a"]])
+
+    def test_balance_by_bytes_empty_files(self):
+        shards = balance_by_bytes([("a", 0), ("b", 0), ("c", 0), ("d", 0)], 2)
+        self.assertEqual([len(shard) for shard in shards], [2, 2])
+
+    def test_read_filelist(self):
+        tmp_dir = tempfile.mkdtemp()
+
+        try:
+            path = os.path.join(tmp_dir, "filelist")
+            write_filelist(path, ["/foo/a b", "/foo/c"])
+            self.assertEqual(read_filelist(path), ["/foo/a b", "/foo/c"])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_write_filelist(self):
+        tmp_dir = tempfile.mkdtemp()
+
+        try:
+            path = os.path.join(tmp_dir, "filelist")
+            write_filelist(path, ["/foo/a b", "/foo/c"])
+
+            with open(path) as f:
+                self.assertEqual(f.readlines(), ['"/foo/a b"\n', '"/foo/c"\n'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_start_sharded(self):
+        tmp_dir = tempfile.mkdtemp()
+        runner_service = mock.MagicMock()
+        runner_service.start_group.return_value = 3
+        runner_service.children.return_value = [1, 2]
+
+        try:
+            dsmc_log = os.path.join(tmp_dir, "dsmc.log")
+            job_id, shards = start_sharded(runner_service, "dsmc retrieve", [("/foo/a", 100), ("/foo/b", 60),
+                                                                             ("/foo/c", 40)],
+                                           "descr", tmp_dir, dsmc_log, 2, options="-replace=no",
+                                           first_shard_extra=["/foo"])
+
+            self.assertEqual(job_id, 3)
+            self.assertEqual([(shard["job_id"], shard["files"], shard["bytes"]) for shard in shards],
+                             [(1, 2, 100), (2, 2, 100)])
+            self.assertEqual(read_filelist(shards[0]["filelist"]), ["/foo/a", "/foo"])
+            self.assertEqual(read_filelist(shards[1]["filelist"]), ["/foo/b", "/foo/c"])
+
+            jobs = runner_service.start_group.call_args[0][0]
+            self.assertEqual(jobs[1]["cmd"], "dsmc retrieve -filelist={}-shard1.filelist -description=descr "
+                                             "-replace=no".format(dsmc_log))
+            self.assertEqual((jobs[1]["stdout"], jobs[1]["estimated_bytes"]), ("{}-shard1".format(dsmc_log), 100))
+        finally:
+            shutil.rmtree(tmp_dir)
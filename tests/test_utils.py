@@ -5,7 +5,17 @@ class TestUtils:
         "monitored_directory": "tests/resources/",
         "whitelisted_warnings": "[\"ANS1809W\", \"ANS2000W\"]", 
         "dsmc_log_directory": "tests/resources/dsmc_output/", 
-        "path_to_archive_root": "tests/resources/archives/"
+        "path_to_archive_root": "tests/resources/archives/",
+        "pdc_catalog_max_age_hours": 168,
+        "inventory_workers": 2,
+        "max_dsmc_sessions": 4,
+        "number_of_cores": 2,
+        "checksum_workers": 4,
+        "handler_threads": 2,
+        "max_concurrent_dsmc_sessions": 4,
+        "max_checksum_workers": 4,
+        "bandwidth_budget_mb_per_second": None,
+        "dsmc_session_mb_per_second": 100
     }
 
 class DummyConfig: